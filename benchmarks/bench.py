@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""QuickShare 基准测试
+
+在本机启动 quickshare.py，对生成的测试目录执行脚本化的负载（文件列表、主页、
+登录、上传、下载、Range 请求），统计每秒请求数、p50/p99 延迟、MB/s 以及服务器
+进程的 CPU 和内存占用，结果写成 JSON，便于比较不同版本。startup 场景反复启动
+quickshare.py --no-qr，统计从创建进程到端口可以连接的时间。
+
+示例:
+  python benchmarks/bench.py                                  # 默认场景，threaded 服务器
+  python benchmarks/bench.py --server threaded async --files 10 10k 100k --large-size 2G
+  python benchmarks/bench.py --scenarios listing range -o new.json --compare old.json
+  python benchmarks/bench.py --server threaded async --scenarios startup --startup-runs 20
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUICKSHARE = os.path.join(ROOT, 'quickshare.py')
+PASSWORD = 'bench'
+SMALL_FILE_SIZE = 4096
+LARGE_FILE_NAME = 'large.bin'
+RANGE_SIZE = 64 * 1024
+READ_BUFFER = 1024 * 1024
+FIXTURE_MARKER = '.bench-fixture'
+
+# 场景: (说明, 使用哪些测试目录, 默认并发数)
+# 'all' 表示每个测试目录都跑一遍，'first' 只用文件数最少的目录（大文件也放在那里）
+SCENARIOS = {
+    'startup': ('启动 quickshare.py --no-qr 到端口可以连接', 'first', 1),
+    'listing': ('GET /api/files 完整列表', 'all', None),
+    'listing-page': ('GET /api/files?limit=200 分页', 'all', None),
+    'index': ('GET / 渲染主页', 'all', None),
+    'login': ('POST /login', 'first', None),
+    'download-small': ('GET /download/ 随机小文件', 'first', None),
+    'download-large': ('GET /download/ 完整下载大文件', 'first', 4),
+    'range': ('GET /download/ 大文件中随机 64 KB 区间', 'first', None),
+    'upload-single': ('PUT /upload/ 单个连接上传', 'first', 1),
+    'upload-concurrent': ('PUT /upload/ 多个连接同时上传', 'first', None),
+}
+DEFAULT_SCENARIOS = ['startup', 'listing', 'listing-page', 'index', 'login', 'download-small', 'download-large',
+                     'range', 'upload-single', 'upload-concurrent']
+
+
+def parse_count(text):
+    """解析 10、10k、100k 这样的文件数"""
+    match = re.fullmatch(r'(\d+)([km]?)', text.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f'无效的文件数: {text}')
+    return int(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2)]
+
+
+def parse_size(text):
+    """解析 64M、2G 这样的字节数（1024 进制）"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([kmgt]?)i?b?', text.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f'无效的大小: {text}')
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2) or ' '))
+
+
+def format_count(count):
+    if count >= 1000 and count % 1000 == 0:
+        return f'{count // 1000}k'
+    return str(count)
+
+
+def write_random_file(path, size, block=8 * 1024 * 1024):
+    """写入 size 字节不可压缩的数据（重复使用一块随机数据，生成几 GB 的文件也很快）"""
+    data = os.urandom(min(block, max(size, 1)))
+    with open(path + '.tmp', 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, len(data))
+            f.write(data[:n])
+            remaining -= n
+    os.replace(path + '.tmp', path)
+
+
+def prepare_fixture(base, count, large_size=0):
+    """生成（或复用）包含 count 个小文件的测试目录，large_size 非 0 时再放一个大文件"""
+    path = os.path.join(base, f'files-{format_count(count)}')
+    marker = os.path.join(path, FIXTURE_MARKER)
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists(marker):
+        print(f'生成测试目录 {path} ({count} 个文件)...', flush=True)
+        payload = os.urandom(SMALL_FILE_SIZE)
+        for i in range(count):
+            with open(os.path.join(path, f'file-{i:06d}.txt'), 'wb') as f:
+                f.write(payload)
+        with open(marker, 'w') as f:
+            f.write(str(count))
+    large = os.path.join(path, LARGE_FILE_NAME)
+    if large_size and (not os.path.exists(large) or os.path.getsize(large) != large_size):
+        print(f'生成大文件 {large} ({large_size / 1024 ** 3:.2f} GB)...', flush=True)
+        write_random_file(large, large_size)
+    return path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """在子进程中运行 quickshare.py，并统计它（及 prefork 工作进程）的 CPU 和内存"""
+
+    def __init__(self, directory, server, extra_args=(), python=sys.executable):
+        self.port = free_port()
+        self.cmd = [python, QUICKSHARE, '--dir', directory, '--port', str(self.port), '--no-qr',
+                    '--auth', PASSWORD, '--server', server, *extra_args]
+        self.proc = None
+        self.log = None
+
+    def start(self, timeout=60.0):
+        self.log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(self.cmd, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+                conn.request('GET', '/api/files?limit=1', headers=auth_headers())
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        self.log.seek(0)
+        raise RuntimeError('服务器启动失败:\n' + self.log.read().decode(errors='replace'))
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+    def _pids(self):
+        """服务器进程及其所有子进程"""
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        pids, stack = [], [self.proc.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            stack.extend(children.get(pid, ()))
+        return pids
+
+    def usage(self):
+        """返回 (累计 CPU 秒数, RSS 字节数)；没有 /proc 的系统上返回 (None, None)"""
+        if not os.path.isdir('/proc'):
+            return None, None
+        ticks = os.sysconf('SC_CLK_TCK')
+        page = os.sysconf('SC_PAGE_SIZE')
+        cpu = rss = 0
+        for pid in self._pids():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                with open(f'/proc/{pid}/statm') as f:
+                    resident = int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += resident * page
+        return cpu, rss
+
+
+class UsageSampler:
+    """场景运行期间定期采样服务器的 CPU 时间和峰值 RSS"""
+
+    def __init__(self, server, interval=0.25):
+        self.server = server
+        self.interval = interval
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            _, rss = self.server.usage()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def __enter__(self):
+        self.cpu_start, self.peak_rss = self.server.usage()
+        self.wall_start = time.monotonic()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        cpu_end, rss = self.server.usage()
+        self.wall = time.monotonic() - self.wall_start
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        self.cpu_percent = None
+        if cpu_end is not None:
+            self.cpu_percent = round((cpu_end - self.cpu_start) / self.wall * 100, 1)
+
+
+def auth_headers():
+    return {'Cookie': f'auth_token={PASSWORD}'}
+
+
+def make_request(scenario, rng, ctx, worker):
+    """返回 (method, path, headers, body, 期望状态码)"""
+    headers = auth_headers()
+    if scenario == 'listing':
+        return 'GET', '/api/files', headers, None, (200,)
+    if scenario == 'listing-page':
+        return 'GET', '/api/files?limit=200', headers, None, (200,)
+    if scenario == 'index':
+        return 'GET', '/', headers, None, (200,)
+    if scenario == 'login':
+        body = urlencode({'password': PASSWORD}).encode()
+        return 'POST', '/login', {'Content-Type': 'application/x-www-form-urlencoded'}, body, (302,)
+    if scenario == 'download-small':
+        name = f'file-{rng.randrange(ctx["count"]):06d}.txt'
+        return 'GET', '/download/' + quote(name), headers, None, (200,)
+    if scenario == 'download-large':
+        return 'GET', '/download/' + LARGE_FILE_NAME, headers, None, (200,)
+    if scenario == 'range':
+        start = rng.randrange(max(ctx['large_size'] - RANGE_SIZE, 1))
+        headers['Range'] = f'bytes={start}-{start + RANGE_SIZE - 1}'
+        return 'GET', '/download/' + LARGE_FILE_NAME, headers, None, (206,)
+    if scenario in ('upload-single', 'upload-concurrent'):
+        # 每个连接覆盖写同一个文件，磁盘占用不会随测试时间增长
+        return 'PUT', f'/upload/bench-upload-{worker}.bin?overwrite=1', headers, ctx['payload'], (200,)
+    raise ValueError(scenario)
+
+
+def run_connection(port, scenario, ctx, deadline, worker, max_requests):
+    """在一个 keep-alive 连接上循环发送请求直到 deadline，返回 (延迟列表, 收发字节数, 错误数)"""
+    rng = random.Random(worker)
+    latencies, nbytes, errors = [], 0, 0
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    while time.monotonic() < deadline and len(latencies) + errors < max_requests:
+        method, path, headers, body, expected = make_request(scenario, rng, ctx, worker)
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            received = 0
+            while True:
+                chunk = resp.read(READ_BUFFER)
+                if not chunk:
+                    break
+                received += len(chunk)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if resp.status not in expected:
+            errors += 1
+        nbytes += received + (len(body) if body else 0)
+        if resp.will_close:
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.close()
+    return latencies, nbytes, errors
+
+
+def run_client(port, scenario, ctx, deadline, workers, max_requests):
+    """负载进程：用多个线程各开一个连接"""
+    results = [None] * len(workers)
+
+    def target(i, worker):
+        results[i] = run_connection(port, scenario, ctx, deadline, worker, max_requests)
+
+    threads = [threading.Thread(target=target, args=(i, w)) for i, w in enumerate(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(pool, clients, server, scenario, ctx, concurrency, duration, max_requests):
+    """用 clients 个负载进程共 concurrency 个连接运行一个场景"""
+    workers = list(range(concurrency))
+    groups = [workers[i::clients] for i in range(clients)]
+    groups = [g for g in groups if g]
+    with UsageSampler(server) as usage:
+        deadline = time.monotonic() + duration
+        futures = [pool.submit(run_client, server.port, scenario, ctx, deadline, g, max_requests) for g in groups]
+        results = [r for f in futures for r in f.result()]
+    latencies = sorted(x for r in results for x in r[0])
+    nbytes = sum(r[1] for r in results)
+    errors = sum(r[2] for r in results)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'concurrency': concurrency,
+        'duration': round(usage.wall, 3),
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / usage.wall, 1),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.5)),
+            'p90': ms(percentile(latencies, 0.9)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'mb_per_s': round(nbytes / usage.wall / 1024 ** 2, 2),
+        'server_cpu_percent': usage.cpu_percent,
+        'server_rss_mb': round(usage.peak_rss / 1024 ** 2, 1) if usage.peak_rss else None,
+    }
+
+
+def measure_startup(directory, server_mode, extra_args, runs):
+    """启动 runs 次服务器，统计从创建进程到监听端口可以连接的时间（不经过 HTTP 请求）"""
+    latencies = []
+    errors = 0
+    wall = time.monotonic()
+    for _ in range(runs):
+        server = ServerProcess(directory, server_mode, extra_args)
+        started = time.perf_counter()
+        server.proc = subprocess.Popen(server.cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                if server.proc.poll() is not None or time.perf_counter() - started > 60:
+                    errors += 1
+                    break
+                try:
+                    socket.create_connection(('127.0.0.1', server.port), timeout=1).close()
+                except OSError:
+                    time.sleep(0.002)
+                    continue
+                latencies.append(time.perf_counter() - started)
+                break
+        finally:
+            server.stop()
+    latencies.sort()
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'concurrency': 1,
+        'duration': round(time.monotonic() - wall, 3),
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.5)),
+            'p90': ms(percentile(latencies, 0.9)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'mb_per_s': None,
+        'server_cpu_percent': None,
+        'server_rss_mb': None,
+    }
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def result_key(result):
+    return result['server'], result['fixture'], result['scenario']
+
+
+def compare(old_path, results, threshold):
+    """与旧结果对比，打印变化并返回是否有超过 threshold 的退化"""
+    with open(old_path, encoding='utf-8') as f:
+        old = {result_key(r): r for r in json.load(f)['results']}
+    regressed = False
+    print(f'\n与 {old_path} 对比（退化阈值 {threshold:.0%}）:')
+    print(f'{"server":<9} {"fixture":<8} {"scenario":<18} {"rps":>18} {"p99 ms":>20} {"MB/s":>18}')
+    for result in results:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        cells = []
+        for path, higher_is_better in ((('rps',), True), (('latency_ms', 'p99'), False), (('mb_per_s',), True)):
+            a, b = before, result
+            for part in path:
+                a, b = a.get(part), b.get(part)
+            if not a or b is None:
+                cells.append(f'{"-":>18}')
+                continue
+            change = (b - a) / a
+            worse = -change if higher_is_better else change
+            flag = ' !' if worse > threshold else ''
+            regressed = regressed or bool(flag)
+            cells.append(f'{b:>9g} ({change:+6.1%}){flag}'.rjust(18))
+        print(f'{result["server"]:<9} {result["fixture"]:<8} {result["scenario"]:<18} ' + ' '.join(cells))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='QuickShare 基准测试：启动本地服务器，运行脚本化负载并输出 JSON 结果',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='场景:\n' + '\n'.join(f'  {name:<18} {info[0]}' for name, info in SCENARIOS.items()))
+    parser.add_argument('--server', nargs='+', default=['threaded'],
+                        choices=['dev', 'threaded', 'prefork', 'async'], help='要测试的服务器模式 (默认: threaded)')
+    parser.add_argument('--scenarios', nargs='+', default=DEFAULT_SCENARIOS, choices=list(SCENARIOS),
+                        metavar='SCENARIO', help='要运行的场景 (默认: 全部)')
+    parser.add_argument('--files', nargs='+', type=parse_count, default=[10, 10000],
+                        help='测试目录的文件数，如 10 10k 100k (默认: 10 10k)')
+    parser.add_argument('--large-size', type=parse_size, default=parse_size('1G'),
+                        help='下载和 Range 场景使用的大文件大小，如 4G (默认: 1G)')
+    parser.add_argument('--upload-size', type=parse_size, default=parse_size('16M'),
+                        help='上传场景每个请求的大小 (默认: 16M)')
+    parser.add_argument('--concurrency', type=int, default=16, help='默认并发连接数 (默认: 16)')
+    parser.add_argument('--clients', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help='产生负载的进程数 (默认: CPU 核数的一半，最多 4)')
+    parser.add_argument('--duration', type=float, default=5.0, help='每个场景的运行时间，秒 (默认: 5)')
+    parser.add_argument('--max-requests', type=int, default=1000000, help='每个连接的最大请求数')
+    parser.add_argument('--startup-runs', type=int, default=10, help='startup 场景的启动次数 (默认: 10)')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'quickshare-bench'),
+                        help='测试目录的位置，生成后会复用 (默认: 系统临时目录下的 quickshare-bench)')
+    parser.add_argument('--server-args', default='', help='传给 quickshare.py 的其他参数，如 "--cache-mb 256"')
+    parser.add_argument('-o', '--output', default='bench-results.json', help='结果文件 (默认: bench-results.json)')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='与之前的结果文件对比')
+    parser.add_argument('--threshold', type=float, default=0.1, help='对比时视为退化的变化比例 (默认: 0.1)')
+    args = parser.parse_args()
+
+    counts = sorted(set(args.files))
+    fixtures = [(format_count(count), prepare_fixture(args.workdir, count, args.large_size if i == 0 else 0), count)
+                for i, count in enumerate(counts)]
+    payload = os.urandom(min(args.upload_size, 8 * 1024 * 1024))
+    payload = (payload * (args.upload_size // len(payload) + 1))[:args.upload_size]
+
+    results = []
+    with ProcessPoolExecutor(args.clients) as pool:
+        for server_mode in args.server:
+            for index, (label, directory, count) in enumerate(fixtures):
+                scenarios = [s for s in args.scenarios if SCENARIOS[s][1] == 'all' or index == 0]
+                if 'startup' in scenarios:
+                    scenarios.remove('startup')
+                    result = measure_startup(directory, server_mode, args.server_args.split(), args.startup_runs)
+                    results.append({'server': server_mode, 'fixture': label, 'scenario': 'startup', **result})
+                    latency = result['latency_ms']
+                    print(f'{server_mode:<9} {label:<6} {"startup":<18} mean {latency["mean"]} ms  '
+                          f'p50 {latency["p50"]} ms  p99 {latency["p99"]} ms'
+                          + (f'  错误 {result["errors"]}' if result['errors'] else ''), flush=True)
+                if not scenarios:
+                    continue
+                server = ServerProcess(directory, server_mode, args.server_args.split())
+                server.start()
+                try:
+                    for scenario in scenarios:
+                        ctx = {'count': count, 'large_size': args.large_size,
+                               'payload': payload if scenario.startswith('upload') else None}
+                        concurrency = SCENARIOS[scenario][2] or args.concurrency
+                        result = run_scenario(pool, args.clients, server, scenario, ctx, concurrency,
+                                              args.duration, args.max_requests)
+                        result = {'server': server_mode, 'fixture': label, 'scenario': scenario, **result}
+                        results.append(result)
+                        latency = result['latency_ms']
+                        print(f'{server_mode:<9} {label:<6} {scenario:<18} {result["rps"]:>9.1f} req/s  '
+                              f'p50 {latency["p50"]} ms  p99 {latency["p99"]} ms  {result["mb_per_s"]:>8.1f} MB/s  '
+                              f'CPU {result["server_cpu_percent"]}%  RSS {result["server_rss_mb"]} MB'
+                              + (f'  错误 {result["errors"]}' if result['errors'] else ''), flush=True)
+                finally:
+                    server.stop()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('compare', 'output')},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'\n结果已写入 {args.output}')
+    if args.compare and compare(args.compare, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
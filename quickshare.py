@@ -6,20 +6,148 @@
 """
 
 import os
+import posixpath
 import sys
 import socket
 import argparse
+import contextvars
+import http.server
+import selectors
+import signal
+import shutil
+import struct
+import traceback
 import secrets
+import stat
+import bisect
+import gzip
+import zlib
+import itertools
+import threading
+import time
+import json
+import heapq
+import hashlib
+import hmac
+import re
+import mimetypes
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import (
+    parse_qsl, quote as url_quote, unquote as url_unquote, unquote_to_bytes as url_unquote_to_bytes, urlencode,
+    urlsplit,
+)
 from pathlib import Path
-from functools import wraps
-from flask import Flask, request, send_file, jsonify, render_template_string, Response
-import qrcode
-from io import BytesIO
+from functools import lru_cache, wraps
+from contextlib import contextmanager, nullcontext
+from flask import Flask, request, jsonify, redirect, Response
+from werkzeug.datastructures import Headers
+from werkzeug.http import (
+    http_date, parse_accept_header, parse_cookie, parse_date, parse_options_header, parse_etags, parse_range_header,
+    quote_etag, unquote_etag,
+)
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import base64
 
+
 app = Flask(__name__)
 UPLOAD_DIR = os.getcwd()
 AUTH_TOKEN = None
+LISTING_TTL = 30.0
+TREE_MAX_DIRS = 1024
+SEARCH_INTERVAL = 10.0
+SEARCH_LIMIT = 50
+SSE_HEARTBEAT = 15.0
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+STATE_DIR_NAME = '.quickshare'
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 3600
+COPY_BUFFER = 1024 * 1024
+MAX_RANGES = 64
+TAR_BATCH_FILES = 256
+TAR_BATCH_BYTES = 64 * 1024 * 1024
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ARCHIVE_COMPRESSLEVEL = 1
+DEDUP_MODE = 'auto'  # auto（同 reflink）/ reflink / hardlink / off
+HASH_INDEX_INTERVAL = 60.0
+CATALOG_NAME = 'catalog.sqlite3'
+CATALOG_HASH_WORKERS = 2
+CATALOG_FLUSH_INTERVAL = 5.0
+INSTANT_UPLOAD_MAX = 256 * 1024 * 1024
+DELTA_MIN_BLOCK = 4 * 1024
+DELTA_MAX_BLOCK = 1024 * 1024
+DELTA_MAGIC = b'QSD1'
+SIGNATURE_CACHE_MB = 64
+CLIENT_JOBS = 4
+CLIENT_SPLIT_SIZE = 32 * 1024 * 1024
+CLIENT_PART_SIZE = 8 * 1024 * 1024
+CLIENT_RETRIES = 5
+CLUSTER_PORT = 8765
+CLUSTER_INTERVAL = 2.0
+CLUSTER_PEER_TTL = 10.0
+CLUSTER_TICKET_TTL = 300  # 重定向到其它节点的下载票据有效期，秒
+CLUSTER_LISTINGS = 64
+CLUSTER_REPLICATE_HITS = 3
+CLUSTER_REPLICATE_MAX = 1024 * 1024 * 1024
+HOT_FILE_MAX = 8 * 1024 * 1024
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_CACHE_MB = 500
+COMPRESS_SAMPLE = 64 * 1024
+SCHED_QUANTUM = 256 * 1024
+SCHED_SMALL = 1024 * 1024
+SCHED_BURST = 0.25
+MAX_UPLOADS = 16
+MIN_FREE_SPACE = 256 * 1024 * 1024
+SPACE_CHECK_BYTES = 64 * 1024 * 1024  # 超出声明大小的上传每收到这么多字节重新检查一次磁盘空间
+ADMISSION_WAIT = 5.0
+ADMISSION_QUEUE = 256
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = tuple(float(2 ** n * 64 * 1024) for n in range(0, 16, 2))  # 64 KiB/s ~ 1 GiB/s
+THROUGHPUT_MIN = 1024 * 1024
+COMPRESSIBLE_TYPES = frozenset([
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/markdown', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+])
+THUMB_SIZE = 256
+THUMB_CACHE_MB = 200
+THUMB_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+THUMB_TIMEOUT = 30.0
+THUMB_EXTENSIONS = frozenset(['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'])
+# 已经压缩过的格式，再压缩只会浪费 CPU
+COMPRESSED_EXTENSIONS = frozenset('''
+    .jpg .jpeg .png .gif .webp .heic .heif .avif
+    .mp4 .mov .m4v .mkv .avi .webm .3gp .mp3 .m4a .aac .ogg .opus .flac .wma .wmv
+    .zip .gz .tgz .bz2 .xz .zst .7z .rar .lz4 .br
+    .apk .ipa .dmg .iso .jar .whl .docx .xlsx .pptx .odt .ods .odp .epub .pdf
+'''.split())
+FILE_CACHE = None
+CONTENT_INDEX = None
+SEARCH_INDEX = None
+CATALOG = None
+THUMB_CACHE = None
+HOT_CACHE = None
+VARIANT_CACHE = None
+SIGNATURE_CACHE = None
+SCHEDULER = None
+ADMISSION = None
+METRICS = None
+CLUSTER = None
+SHUTDOWN = threading.Event()
 
 
 def get_local_ip():
@@ -42,304 +170,4585 @@ def check_auth(token):
     return token == AUTH_TOKEN
 
 
+def download_ticket(path, ttl=CLUSTER_TICKET_TTL):
+    """只对 URL 路径 path 有效、ttl 秒后过期的访问票据，代替密码放进重定向地址"""
+    expires = int(time.time() + ttl)
+    mac = hmac.new(AUTH_TOKEN.encode(), f'{path}\n{expires}'.encode(), hashlib.sha256).hexdigest()
+    return f'{expires}.{mac}'
+
+
+def check_ticket(path, ticket):
+    """检查 download_ticket 生成的票据是否对 path 有效且未过期"""
+    if AUTH_TOKEN is None or not ticket:
+        return False
+    expires, _, mac = str(ticket).partition('.')
+    try:
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    expected = hmac.new(AUTH_TOKEN.encode(), f'{path}\n{expires}'.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(mac, expected)
+
+
 def requires_auth(f):
     """认证装饰器"""
     @wraps(f)
     def decorated(*args, **kwargs):
         if AUTH_TOKEN is not None:
             token = request.cookies.get('auth_token') or request.args.get('token')
-            if not token or not check_auth(token):
+            if (not token or not check_auth(token)) and not check_ticket(request.path, request.args.get('ticket')):
                 if request.path.startswith('/api/'):
                     return jsonify({'error': 'Unauthorized'}), 401
-                return render_template_string(LOGIN_PAGE), 401
+                return LOGIN_TEMPLATE.render(), 401
         return f(*args, **kwargs)
     return decorated
 
 
-def generate_qr_code(url):
-    """生成二维码并返回 base64 编码的图片"""
-    qr = qrcode.QRCode(version=1, box_size=2, border=2)
+@lru_cache(maxsize=32)
+def qr_matrix(url):
+    """url 的二维码模块矩阵（不含空白边框，True 为深色），同一 URL 只编码一次"""
+    import qrcode
+    qr = qrcode.QRCode(border=0)
     qr.add_data(url)
     qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return img_str
+    return tuple(tuple(bool(module) for module in row) for row in qr.modules)
 
 
-def print_qr_in_terminal(url):
-    """在终端打印二维码（使用 ASCII 字符）"""
+def print_qr_in_terminal(url, border=4):
+    """在终端打印二维码（使用 ASCII 字符，深色背景的终端上为白底黑码）"""
     try:
-        qr = qrcode.QRCode()
-        qr.add_data(url)
-        qr.make()
-        qr.print_ascii(invert=True)
+        matrix = qr_matrix(url)
+        side = len(matrix) + 2 * border
+        light = (False,) * side
+        rows = [light] * border + [light[:border] + row + light[:border] for row in matrix] + [light] * border
+        # 每个字符表示上下两个模块；最后一行不成对时下半用终端背景色
+        codes = ('\u2588', '\u2584', '\u2580', '\xa0')
+        for top, bottom in zip(rows[::2], rows[1::2] + [(True,) * side]):
+            print(''.join(codes[t + 2 * b] for t, b in zip(top, bottom)))
     except Exception:
         # 如果打印失败，至少显示 URL
         print(f"\n访问地址: {url}\n")
 
 
-# HTML 模板
-LOGIN_PAGE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>QuickShare - 需要认证</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-            background: #1a1a1a;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            min-height: 100vh;
-            padding: 20px;
-        }
-        .login-container {
-            background: #ffffff;
-            padding: 48px 40px;
-            border-radius: 4px;
-            box-shadow: 0 2px 8px rgba(0,0,0,0.15);
-            max-width: 420px;
-            width: 100%;
-            border: 1px solid #e5e5e5;
-        }
-        h1 { 
-            color: #1a1a1a; 
-            margin-bottom: 8px; 
-            text-align: center; 
-            font-size: 24px;
-            font-weight: 600;
-            letter-spacing: -0.5px;
-        }
-        p { 
-            color: #666666; 
-            margin-bottom: 32px; 
-            text-align: center; 
-            font-size: 14px;
-        }
-        input {
-            width: 100%;
-            padding: 12px 16px;
-            border: 1px solid #d0d0d0;
-            border-radius: 4px;
-            font-size: 14px;
-            margin-bottom: 20px;
-            background: #ffffff;
-            color: #1a1a1a;
-            transition: border-color 0.2s;
-        }
-        input:focus { 
-            outline: none; 
-            border-color: #1a1a1a; 
-        }
-        input::placeholder {
-            color: #999999;
-        }
-        button {
-            width: 100%;
-            padding: 12px 16px;
-            background: #1a1a1a;
-            color: #ffffff;
-            border: none;
-            border-radius: 4px;
-            font-size: 14px;
-            font-weight: 500;
-            cursor: pointer;
-            transition: background-color 0.2s;
-        }
-        button:hover { background: #2d2d2d; }
-        button:active { background: #0d0d0d; }
-        .error { 
-            color: #d32f2f; 
-            margin-top: 12px; 
-            text-align: center; 
-            font-size: 13px;
-        }
-    </style>
-</head>
-<body>
-    <div class="login-container">
-        <h1>QuickShare</h1>
-        <p>请输入访问密码</p>
-        <form method="POST" action="/login">
-            <input type="password" name="password" placeholder="密码" required autofocus>
-            <button type="submit">登录</button>
-        </form>
-        <div id="error" class="error">{% if error %}{{ error }}{% endif %}</div>
-    </div>
-</body>
-</html>
-"""
+SORT_FIELDS = ('name', 'size', 'mtime')
 
-MAIN_PAGE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>QuickShare - 文件快传</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-            background: #f5f5f5;
-            min-height: 100vh;
-            padding: 24px;
-        }
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-        }
-        .header {
-            background: #ffffff;
-            padding: 32px;
-            border-radius: 4px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-            margin-bottom: 24px;
-            border: 1px solid #e5e5e5;
-        }
-        h1 { 
-            color: #1a1a1a; 
-            margin-bottom: 8px; 
-            font-size: 28px;
-            font-weight: 600;
-            letter-spacing: -0.5px;
-        }
-        .info { 
-            color: #666666; 
-            font-size: 13px; 
-            font-weight: 400;
-        }
-        .main-content {
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 24px;
-        }
-        @media (max-width: 768px) {
-            .main-content { grid-template-columns: 1fr; }
-        }
-        .card {
-            background: #ffffff;
-            padding: 32px;
-            border-radius: 4px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-            border: 1px solid #e5e5e5;
-        }
-        .card h2 { 
-            color: #1a1a1a; 
-            margin-bottom: 24px; 
-            font-size: 18px;
-            font-weight: 600;
-            letter-spacing: -0.3px;
+
+def _sort_key(sort, name, entry):
+    """排序索引中使用的键：(name,) / (size, name) / (mtime, name)"""
+    if sort == 'name':
+        return (name,)
+    if sort == 'size':
+        return (entry[0], name)
+    return (entry[1], name)
+
+
+def encode_cursor(sort, key):
+    """把排序键编码成不透明的分页游标"""
+    raw = json.dumps([sort, list(key)], ensure_ascii=False).encode('utf-8', 'surrogateescape')
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """解析分页游标，游标无效或与排序方式不符时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key = json.loads(raw.decode('utf-8', 'surrogateescape'))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if cursor_sort != sort or not isinstance(key, list):
+        raise ValueError('invalid cursor')
+    if len(key) != (1 if sort == 'name' else 2) or not isinstance(key[-1], str):
+        raise ValueError('invalid cursor')
+    if sort != 'name' and (isinstance(key[0], bool) or not isinstance(key[0], (int, float))):
+        raise ValueError('invalid cursor')
+    return tuple(key)
+
+
+def page_keys(keys, item, sort='name', reverse=False, cursor=None, limit=100, prefix='', query=''):
+    """在有序的排序键列表 keys 上取一页，item(name) 生成列表项；参数和返回值见 DirectoryCache.page"""
+    query = query.casefold()
+    lo, hi = 0, len(keys)
+    if prefix and sort == 'name':
+        # 按名称排序时前缀对应一个连续区间，直接二分得到边界
+        lo = bisect.bisect_left(keys, (prefix,))
+        hi = bisect.bisect_left(keys, (prefix + '\U0010ffff',))
+        prefix = ''
+    if reverse:
+        pos = hi - 1 if cursor is None else min(hi, bisect.bisect_left(keys, cursor)) - 1
+        positions = range(pos, lo - 1, -1)
+    else:
+        pos = lo if cursor is None else max(lo, bisect.bisect_right(keys, cursor))
+        positions = range(pos, hi)
+
+    items, last_key, more = [], None, False
+    for i in positions:
+        key = keys[i]
+        name = key[-1]
+        if prefix and not name.startswith(prefix):
+            continue
+        if query and query not in name.casefold():
+            continue
+        if len(items) == limit:
+            more = True
+            break
+        items.append(item(name))
+        last_key = key
+    total = hi - lo if not (prefix or query) else None
+    return items, (last_key if more else None), total
+
+
+class DirectoryCache:
+    """目录列表缓存
+
+    使用 os.scandir 扫描目录，所有请求共享同一份结果。每隔 check_interval 秒
+    检查一次目录 mtime，变化时重新扫描；目录 mtime 不会反映已有文件内容的
+    变化，因此超过 ttl 秒后无论如何都会重新扫描一次。
+
+    每次内容变化都会递增 version，并把增量（新增/删除/变化的条目）记入
+    一个有限长度的变更日志，供 /api/events 推送给浏览器。子目录单独记录
+    （不递归扫描），目录集合变化时增量中带上完整的 dirs 列表。
+
+    按名称、大小、修改时间分别维护有序索引，分页查询只需二分定位游标，
+    代价与页大小成正比；少量变化时索引原地增删，大量变化时延迟重建。
+    """
+
+    def __init__(self, path, ttl=LISTING_TTL, check_interval=1.0, log_size=1000, on_change=None):
+        self.path = path
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.version = 0
+        self.epoch = secrets.token_hex(4)
+        self._cond = threading.Condition(threading.Lock())
+        self._entries = {}  # name -> (size, mtime)
+        self._dirs = {}  # 子目录名 -> mtime
+        self._index = {}  # sort -> 有序的排序键列表
+        self._listing = None
+        self._etag = None
+        self._changes = deque(maxlen=log_size)  # (version, changes)
+        self._pending = deque()  # 等待在锁外交给 on_change 的增量
+        self._notify_lock = threading.Lock()  # 保证 on_change 按版本顺序调用
+        self._dir_mtime = None
+        self._scanned_at = 0.0
+        self._checked_at = 0.0
+        self.scans = 0
+        self.scan_seconds = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _scan(self):
+        entries, dirs = {}, {}
+        try:
+            it = os.scandir(self.path)
+        except FileNotFoundError:
+            # 子目录已被删除
+            return entries, dirs
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != STATE_DIR_NAME:
+                            dirs[entry.name] = entry.stat(follow_symlinks=False).st_mtime
+                        continue
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = (st.st_size, st.st_mtime)
+        return entries, dirs
+
+    @staticmethod
+    def _item(name, entry):
+        return {'name': name, 'size': format_size(entry[0]),
+                'bytes': entry[0], 'mtime': entry[1]}
+
+    def _dir_items(self):
+        return [{'name': name, 'mtime': mtime} for name, mtime in sorted(self._dirs.items())]
+
+    def _apply_locked(self, updates, dirs=None, notify=True):
+        """应用 {name: entry 或 None} 形式的更新（dirs 为新的子目录集合），有变化时递增版本号并唤醒等待者
+
+        增量只记入 _pending，由调用方释放 _cond 之后调用 _notify 交给 on_change。
+        """
+        entries = self._entries
+        changes = {'added': [], 'changed': [], 'removed': []}
+        if dirs is not None and dirs.keys() != self._dirs.keys():
+            self._dirs = dirs
+            changes['dirs'] = self._dir_items()
+        elif dirs is not None:
+            self._dirs = dirs
+        changed = []
+        for name in sorted(updates):
+            before, after = entries.get(name), updates[name]
+            if before == after:
+                continue
+            changed.append((name, before, after))
+            if after is None:
+                changes['removed'].append(name)
+            else:
+                kind = 'added' if before is None else 'changed'
+                changes[kind].append(self._item(name, after))
+        if not changed and 'dirs' not in changes:
+            return
+
+        # 变化较少时原地维护有序索引，否则丢弃索引等下次查询时重建
+        rebuild = len(changed) > 64 + len(entries) // 16
+        for sort, keys in list(self._index.items()):
+            if rebuild:
+                del self._index[sort]
+                continue
+            for name, before, after in changed:
+                if before is not None:
+                    del keys[bisect.bisect_left(keys, _sort_key(sort, name, before))]
+                if after is not None:
+                    bisect.insort(keys, _sort_key(sort, name, after))
+        for name, _, after in changed:
+            if after is None:
+                del entries[name]
+            else:
+                entries[name] = after
+
+        self._listing = None
+        self._etag = None
+        self.version += 1
+        self._changes.append((self.version, changes))
+        if notify and self.on_change is not None:
+            self._pending.append(changes)
+        self._cond.notify_all()
+
+    def _notify(self):
+        """在 _cond 之外依次把记录下的增量交给 on_change，回调不会阻塞列表查询"""
+        if not self._pending:
+            return
+        with self._notify_lock:
+            while True:
+                with self._cond:
+                    if not self._pending:
+                        return
+                    changes = self._pending.popleft()
+                self.on_change(changes)
+
+    def _refresh_locked(self, now):
+        self._checked_at = now
+        try:
+            dir_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if (dir_mtime is not None and dir_mtime == self._dir_mtime
+                and now - self._scanned_at < self.ttl):
+            return
+        started = time.perf_counter()
+        scanned, dirs = self._scan()
+        self.scans += 1
+        self.scan_seconds += time.perf_counter() - started
+        updates = {name: None for name in self._entries.keys() - scanned.keys()}
+        updates.update(scanned)
+        self._apply_locked(updates, dirs)
+        self._dir_mtime = dir_mtime
+        self._scanned_at = now
+
+    def preload(self, entries, dirs, dir_mtime):
+        """用目录 mtime 与当前一致的持久化记录（见 Catalog.listing）代替第一次扫描"""
+        with self._cond:
+            if self.version:
+                return
+            self._apply_locked(entries, dirs, notify=False)
+            self._dir_mtime = dir_mtime
+            self._scanned_at = self._checked_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """按需重新扫描目录"""
+        now = time.monotonic()
+        with self._cond:
+            if force or now - self._checked_at >= self.check_interval:
+                self._refresh_locked(now)
+        self._notify()
+
+    def dir_mtime(self):
+        """目录当前的 mtime（纳秒），写入之前记下交给 update"""
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def update(self, name, before=None):
+        """上传完成后原地更新单个条目（文件或新建的子目录），无需重新扫描
+
+        before 为写入之前的目录 mtime：与上次扫描时一致说明期间没有别的变化，
+        可以把写入后的 mtime 记为已扫描；否则留给下次 refresh 重新扫描。
+        """
+        path = os.path.join(self.path, name)
+        entry = subdir = None
+        try:
+            st = os.stat(path)
+            if stat.S_ISREG(st.st_mode):
+                entry = (st.st_size, st.st_mtime)
+            elif stat.S_ISDIR(st.st_mode) and name != STATE_DIR_NAME and not os.path.islink(path):
+                subdir = st.st_mtime
+        except OSError:
+            pass
+        with self._cond:
+            dirs = None
+            if (subdir is not None) != (name in self._dirs):
+                dirs = dict(self._dirs)
+                if subdir is None:
+                    del dirs[name]
+                else:
+                    dirs[name] = subdir
+            self._apply_locked({name: entry}, dirs)
+            # 这次写入引起的目录 mtime 变化不必再触发一次全量扫描
+            if before is not None and before == self._dir_mtime:
+                self._dir_mtime = self.dir_mtime()
+        self._notify()
+
+    def snapshot(self):
+        """返回 (文件列表, ETag, 版本号)，文件列表按名称排序"""
+        self.refresh()
+        with self._cond:
+            if self._listing is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._listing = [self._item(name, entry)
+                                 for name, entry in sorted(self._entries.items())]
+                digest = hashlib.blake2b(digest_size=12)
+                for name, (size, mtime) in sorted(self._entries.items()):
+                    digest.update(f'{name}\0{size}\0{mtime}\n'.encode('utf-8', 'surrogateescape'))
+                for name in sorted(self._dirs):
+                    digest.update(f'{name}/\n'.encode('utf-8', 'surrogateescape'))
+                self._etag = digest.hexdigest()
+            return self._listing, self._etag, self.version
+
+    def stats(self):
+        with self._cond:
+            return {'entries': len(self._entries), 'version': self.version, 'scans': self.scans,
+                    'scan_seconds': round(self.scan_seconds, 6), 'hits': self.hits, 'misses': self.misses}
+
+    def files(self):
+        """返回按文件名排序的文件列表"""
+        return self.snapshot()[0]
+
+    def dirs(self):
+        """返回按名称排序的子目录列表"""
+        self.refresh()
+        with self._cond:
+            return self._dir_items()
+
+    def has_dir(self, name):
+        with self._cond:
+            return name in self._dirs
+
+    def _sorted_keys(self, sort):
+        keys = self._index.get(sort)
+        if keys is None:
+            keys = sorted(_sort_key(sort, name, entry) for name, entry in self._entries.items())
+            self._index[sort] = keys
+        return keys
+
+    def page(self, sort='name', reverse=False, cursor=None, limit=100, prefix='', query=''):
+        """分页查询
+
+        cursor 为上一页最后一项的排序键（见 decode_cursor）；prefix 为文件名前缀，
+        query 为不区分大小写的子串。返回 (文件列表, 下一页排序键或 None, 总数或 None)，
+        带 query 时总数未知。
+        """
+        self.refresh()
+        with self._cond:
+            return page_keys(self._sorted_keys(sort), lambda name: self._item(name, self._entries[name]),
+                             sort, reverse, cursor, limit, prefix, query)
+
+    def changes_since(self, version):
+        """返回 version 之后的增量列表；日志已被截断或版本未知时返回 None"""
+        with self._cond:
+            if version == self.version:
+                return []
+            if version > self.version or not self._changes or self._changes[0][0] > version + 1:
+                return None
+            return [(v, c) for v, c in self._changes if v > version]
+
+    def wait_for_change(self, version, timeout):
+        """阻塞直到版本号不同于 version 或超时，返回当前版本号"""
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            with self._cond:
+                remaining = deadline - time.monotonic()
+                if self.version != version or remaining <= 0 or SHUTDOWN.is_set():
+                    return self.version
+                # 没有文件系统通知，所以最多等到下一次目录检查
+                self._cond.wait(min(self.check_interval, remaining))
+
+
+class TreeIndex:
+    """共享目录树的索引
+
+    每个目录一个 DirectoryCache，第一次访问时才创建并扫描这一层，打开深层
+    目录不需要遍历整棵树。已加载的目录按最近访问顺序最多保留 max_dirs 个
+    （根目录常驻）；上传完成后只原地更新所在目录以及已加载的上级目录。
+    """
+
+    def __init__(self, path, ttl=LISTING_TTL, max_dirs=TREE_MAX_DIRS):
+        self.path = path
+        self.ttl = ttl
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        self._caches = OrderedDict()  # 相对路径 -> DirectoryCache
+        self._evicted = {'scans': 0, 'scan_seconds': 0.0, 'hits': 0, 'misses': 0}
+
+    def get(self, rel=''):
+        """返回相对路径 rel（已经过 safe_path）对应目录的列表缓存，目录无效时返回 None"""
+        path = resolve_dir(rel)
+        with self._lock:
+            cache = self._caches.get(rel)
+            if path is None:
+                if cache is not None and rel:
+                    self._evict_locked(rel)
+                return None
+            created = cache is None
+            if created:
+                cache = self._caches[rel] = DirectoryCache(
+                    path, ttl=self.ttl, on_change=lambda changes, rel=rel: listing_changed(rel, changes))
+                while len(self._caches) > self.max_dirs:
+                    oldest = next(k for k in self._caches if k)
+                    self._evict_locked(oldest)
+            self._caches.move_to_end(rel)
+        if created and CATALOG is not None:
+            listing = CATALOG.listing(rel)
+            if listing is not None:
+                cache.preload(*listing)
+        return cache
+
+    def _evict_locked(self, rel):
+        cache = self._caches.pop(rel)
+        stats = cache.stats()
+        for key in self._evicted:
+            self._evicted[key] += stats[key]
+
+    def loaded(self):
+        """返回 [(相对路径, DirectoryCache)]，只包含已经加载过的目录"""
+        with self._lock:
+            return list(self._caches.items())
+
+    def dir_mtimes(self, name):
+        """写入 name（相对路径）之前调用：返回已加载的各级上级目录当前的 mtime，交给 update"""
+        parts = name.split('/')
+        with self._lock:
+            caches = [(rel, self._caches.get(rel)) for rel in ('/'.join(parts[:i]) for i in range(len(parts)))]
+        return {rel: cache.dir_mtime() for rel, cache in caches if cache is not None}
+
+    def update(self, name, before=None):
+        """上传完成后更新文件 name（相对路径）所在目录，以及新建目录时已加载的上级目录
+
+        before 为写入之前 dir_mtimes 的结果。
+        """
+        parts = name.split('/')
+        before = before or {}
+        with self._lock:
+            caches = [self._caches.get('/'.join(parts[:i])) for i in range(len(parts))]
+        for i, cache in enumerate(caches):
+            if cache is None:
+                continue
+            child = parts[i]
+            if i == len(parts) - 1 or not cache.has_dir(child):
+                cache.update(child, before.get('/'.join(parts[:i])))
+
+    def stats(self):
+        totals = dict(self._evicted)
+        totals['entries'] = 0
+        for _, cache in self.loaded():
+            stats = cache.stats()
+            for key in totals:
+                totals[key] += stats[key]
+        totals['scan_seconds'] = round(totals['scan_seconds'], 6)
+        totals['directories'] = len(self._caches)
+        return totals
+
+
+def listing_changed(rel, changes):
+    """目录列表缓存发现变化时通知文件名搜索索引和文件目录数据库"""
+    get_search_index().apply(rel, changes)
+    if CATALOG is not None:
+        CATALOG.apply(rel, changes)
+
+
+def get_tree():
+    """返回当前共享目录的目录树索引"""
+    global FILE_CACHE
+    if FILE_CACHE is None or FILE_CACHE.path != UPLOAD_DIR:
+        FILE_CACHE = TreeIndex(UPLOAD_DIR)
+    return FILE_CACHE
+
+
+def get_file_cache(rel=''):
+    """返回共享目录下子目录 rel 的列表缓存，目录无效时返回 None"""
+    return get_tree().get(rel)
+
+
+def state_dir(*parts):
+    """返回共享目录下的内部状态目录（是目录，所以不会出现在文件列表中），必要时创建"""
+    path = os.path.join(UPLOAD_DIR, STATE_DIR_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def safe_path(name):
+    """把客户端给出的相对路径规范成 "a/b/c" 的形式以防止路径遍历
+
+    空路径表示共享目录本身，返回 ''；含 ..、内部状态目录或 NUL 时返回 None。
+    """
+    parts = []
+    for part in (name or '').replace('\\', '/').split('/'):
+        if part in ('', '.'):
+            continue
+        if part in ('..', STATE_DIR_NAME) or '\0' in part:
+            return None
+        parts.append(part)
+    return '/'.join(parts)
+
+
+def resolve_dir(rel):
+    """返回相对路径 rel 对应的目录路径；不存在、不是目录或经符号链接指向共享目录之外时返回 None"""
+    path = os.path.join(UPLOAD_DIR, *rel.split('/')) if rel else UPLOAD_DIR
+    root = os.path.realpath(UPLOAD_DIR)
+    real = os.path.realpath(path)
+    if real != root and not real.startswith(root.rstrip(os.sep) + os.sep):
+        return None
+    if not os.path.isdir(real):
+        return None
+    return path
+
+
+def resolve_file(name):
+    """返回相对路径 name 对应的文件路径（不检查文件本身是否存在），所在目录无效时返回 None"""
+    parent, _, base = name.rpartition('/')
+    parent_path = resolve_dir(parent)
+    if parent_path is None or not base:
+        return None
+    return os.path.join(parent_path, base)
+
+
+def check_parent(name):
+    """检查相对路径 name 的上级目录能否使用：已存在的部分必须是共享目录内的目录，其余部分稍后创建"""
+    parts = name.split('/')[:-1]
+    for i in range(1, len(parts) + 1):
+        rel = '/'.join(parts[:i])
+        if not os.path.lexists(os.path.join(UPLOAD_DIR, *parts[:i])):
+            return True
+        if resolve_dir(rel) is None:
+            return False
+    return True
+
+
+def make_parent(name):
+    """逐级创建相对路径 name 的上级目录并返回其路径，路径不可用时抛出 ValueError"""
+    parent = name.rpartition('/')[0]
+    path = resolve_dir(parent)
+    if path is not None:
+        return path
+    parts = parent.split('/')
+    for i in range(1, len(parts) + 1):
+        rel = '/'.join(parts[:i])
+        if resolve_dir(rel) is None:
+            try:
+                os.mkdir(os.path.join(UPLOAD_DIR, *parts[:i]))
+            except FileExistsError:
+                pass
+            except OSError as e:
+                raise ValueError(f'无法创建目录 {rel}: {e.strerror}')
+            if resolve_dir(rel) is None:
+                raise ValueError(f'无效的路径 {rel}')
+    return resolve_dir(parent)
+
+
+def merge_ranges(ranges):
+    """合并 [start, end) 区间列表"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class UploadSession:
+    """可续传的分块上传会话
+
+    数据直接写入预先分配好大小的 <id>.part 文件，已收到的区间追加记录在
+    <id>.ranges 中，会话信息保存在 <id>.json。三者都位于 .quickshare/uploads，
+    因此断线重连、多进程部署以及服务器重启后都能继续上传。
+    """
+
+    ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, session_id, name, size, created):
+        self.id = session_id
+        self.name = name
+        self.size = size
+        self.created = created
+        base = os.path.join(state_dir('uploads'), session_id)
+        self.part_path = base + '.part'
+        self.meta_path = base + '.json'
+        self.log_path = base + '.ranges'
+
+    @classmethod
+    def create(cls, name, size):
+        """新建会话并预分配目标文件"""
+        cls.cleanup()
+        session = cls(secrets.token_hex(16), name, size, time.time())
+        # 整个会话期间预留声明的大小，并行的多个会话不会都通过空间检查后再一块块写满磁盘
+        admission = get_upload_admission()
+        admission.reserve_session(session.id, size)
+        try:
+            fd = os.open(session.part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                         0o666)
+            try:
+                if size and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(fd, 0, size)
+                    except OSError:
+                        os.ftruncate(fd, size)
+                else:
+                    os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+            with open(session.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'name': name, 'size': size, 'created': session.created}, f)
+        except BaseException:
+            session.discard()
+            raise
+        admission.update_session(session.id, session.outstanding())
+        return session
+
+    @classmethod
+    def load(cls, session_id):
+        """按 id 读取会话，不存在时返回 None"""
+        if not cls.ID_PATTERN.match(session_id):
+            return None
+        path = os.path.join(state_dir('uploads'), session_id + '.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(session_id, meta['name'], meta['size'], meta['created'])
+
+    @classmethod
+    def cleanup(cls, max_age=None):
+        """删除超过 max_age 秒未完成的会话"""
+        max_age = UPLOAD_SESSION_TTL if max_age is None else max_age
+        directory = state_dir('uploads')
+        now = time.time()
+        for entry in os.scandir(directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    cls(entry.name[:-5], None, 0, 0).discard()
+            except OSError:
+                pass
+
+    def received(self):
+        """返回已收到的 [start, end) 区间列表"""
+        ranges = []
+        try:
+            with open(self.log_path, encoding='ascii') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        ranges.append((int(parts[0]), int(parts[1])))
+        except OSError:
+            pass
+        return merge_ranges(ranges)
+
+    def is_complete(self):
+        return self.size == 0 or self.received() == [[0, self.size]]
+
+    def outstanding(self):
+        """目标文件还没有占用磁盘空间的字节数（预分配成功时为 0）"""
+        try:
+            st = os.stat(self.part_path)
+        except OSError:
+            return 0
+        if hasattr(st, 'st_blocks'):
+            return max(0, self.size - st.st_blocks * 512)
+        return self.size - sum(end - start for start, end in self.received())
+
+    def status(self):
+        received = self.received()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.size,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'received': received,
+            'complete': self.size == 0 or received == [[0, self.size]],
         }
-        .upload-area {
-            border: 2px dashed #d0d0d0;
-            border-radius: 4px;
-            padding: 48px 32px;
-            text-align: center;
-            cursor: pointer;
-            transition: all 0.2s;
-            background: #fafafa;
-        }
-        .upload-area:hover { 
-            border-color: #1a1a1a; 
-            background: #f5f5f5; 
-        }
-        .upload-area.dragover { 
-            border-color: #1a1a1a; 
-            background: #f0f0f0; 
-        }
-        .upload-icon { 
-            font-size: 32px; 
-            margin-bottom: 12px; 
-            opacity: 0.4;
-            font-weight: 300;
-        }
-        .upload-area p {
-            color: #666666;
-            font-size: 14px;
-            font-weight: 400;
-        }
-        .file-input { display: none; }
-        .file-list {
-            list-style: none;
-            margin-top: 0;
-        }
-        .file-item {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            padding: 14px 16px;
-            background: #fafafa;
-            border-radius: 4px;
-            margin-bottom: 8px;
-            border: 1px solid #e5e5e5;
-            transition: all 0.2s;
-        }
-        .file-item:hover { 
-            background: #f5f5f5; 
-            border-color: #d0d0d0;
-        }
-        .file-name { 
-            flex: 1; 
-            color: #1a1a1a; 
-            font-size: 14px;
-            font-weight: 400;
-        }
-        .file-size { 
-            color: #999999; 
-            font-size: 12px; 
-            margin-right: 16px;
-            font-weight: 400;
-        }
-        .file-actions a {
-            color: #1a1a1a;
-            text-decoration: none;
-            padding: 6px 16px;
-            border-radius: 4px;
-            transition: all 0.2s;
-            font-size: 13px;
-            border: 1px solid #d0d0d0;
-            background: #ffffff;
-            display: inline-block;
-        }
-        .file-actions a:hover { 
-            background: #1a1a1a; 
-            color: #ffffff;
-            border-color: #1a1a1a;
-        }
-        .progress-bar {
-            width: 100%;
-            height: 4px;
-            background: #e5e5e5;
-            border-radius: 2px;
-            margin-top: 16px;
-            overflow: hidden;
-            display: none;
-        }
-        .progress-fill {
-            height: 100%;
-            background: #1a1a1a;
-            width: 0%;
-            transition: width 0.3s;
-        }
-        .upload-status {
-            margin-top: 16px;
-            padding: 12px 16px;
-            border-radius: 4px;
-            display: none;
-            font-size: 13px;
+
+    def write_chunk(self, offset, stream):
+        """从 stream 读取数据写到 offset 处，返回写入的字节数，越界时抛出 ValueError"""
+        if offset < 0 or offset > self.size:
+            raise ValueError('offset')
+        written = 0
+        try:
+            with open(self.part_path, 'r+b') as f:
+                f.seek(offset)
+                while True:
+                    buf = stream.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    if offset + written + len(buf) > self.size:
+                        raise ValueError('size')
+                    f.write(buf)
+                    written += len(buf)
+        finally:
+            # 即使连接中途断开，已写入的部分也记下来，续传时不必重发
+            if written:
+                with open(self.log_path, 'a', encoding='ascii') as f:
+                    f.write(f'{offset} {offset + written}\n')
+                get_upload_admission().update_session(self.id, self.outstanding())
+        return written
+
+    def finalize(self, dest_name, overwrite=False, uploader=None):
+        """把完整的文件原子地移动到共享目录，返回最终文件名"""
+        # 分块是乱序并行到达的，只能在最后整体算一次哈希（刚写完的数据大多还在页缓存里）
+        digest = ContentIndex.hash_file(self.part_path)
+        final = store_file(self.part_path, dest_name, digest, overwrite, uploader)
+        self.discard()
+        return final
+
+    def discard(self):
+        get_upload_admission().release_session(self.id)
+        for path in (self.part_path, self.meta_path, self.log_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ContentIndex:
+    """共享目录的内容哈希索引
+
+    记录 文件名 -> (大小, mtime, sha256) 以及 sha256 -> 文件名集合。上传的文件
+    在接收时顺便算好哈希，目录中原有的文件由后台线程逐个补算；索引保存在
+    .quickshare/hashes.json，重启后只需重算大小或修改时间变化过的文件。
+    查找时总会重新 stat 一次，记录过期的文件不会被当作副本。
+    """
+
+    def __init__(self, path, interval=HASH_INDEX_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._files = {}  # name -> (size, mtime, digest)
+        self._by_hash = {}  # digest -> {name}
+        self._dirty = False
+        self._saved_at = 0.0
+        self._thread = None
+        self._db_path = os.path.join(path, STATE_DIR_NAME, 'hashes.json')
+        self._load()
+
+    @staticmethod
+    def hash_file(path):
+        """计算文件的 sha256"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(COPY_BUFFER)
+                if not buf:
+                    break
+                digest.update(buf)
+        return digest.hexdigest()
+
+    def _set_locked(self, name, record):
+        old = self._files.pop(name, None)
+        if old is not None:
+            names = self._by_hash.get(old[2])
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._by_hash[old[2]]
+        if record is not None:
+            self._files[name] = record
+            self._by_hash.setdefault(record[2], set()).add(name)
+        self._dirty = True
+
+    def _load(self):
+        """合并磁盘上保存的索引（其它进程可能已经算好了一部分）"""
+        try:
+            with open(self._db_path, encoding='utf-8') as f:
+                saved = json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            dirty = self._dirty
+            for name, record in saved.items():
+                if name not in self._files and isinstance(record, list) and len(record) == 3:
+                    self._set_locked(name, tuple(record))
+            self._dirty = dirty
+
+    def save(self):
+        """有变化时把索引写回磁盘"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'files': {name: list(record) for name, record in self._files.items()}}
+            self._dirty = False
+        tmp = os.path.join(state_dir('tmp'), secrets.token_hex(16) + '.json')
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self._db_path)
+        except OSError:
+            with self._lock:
+                self._dirty = True
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        self._saved_at = time.monotonic()
+
+    def record(self, name, digest):
+        """登记刚写入共享目录的文件"""
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return
+        with self._lock:
+            self._set_locked(name, (st.st_size, st.st_mtime, digest))
+
+    def known_digest(self, name, size, mtime):
+        """返回已登记的 name 的 sha256，记录不存在或与 size、mtime 不符时返回 None（不计算）"""
+        with self._lock:
+            record = self._files.get(name)
+        return record[2] if record is not None and record[:2] == (size, mtime) else None
+
+    def records(self):
+        """返回全部登记记录的副本 {name: (size, mtime, sha256)}"""
+        with self._lock:
+            return dict(self._files)
+
+    def digest_of(self, name, size=None):
+        """返回共享目录中 name 的 sha256，尚未登记时当场计算；文件不存在或大小不是 size 时返回 None"""
+        path = os.path.join(self.path, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or (size is not None and st.st_size != size):
+            return None
+        with self._lock:
+            record = self._files.get(name)
+        if record is not None and record[:2] == (st.st_size, st.st_mtime):
+            return record[2]
+        # 文件目录数据库的后台线程可能已经算过
+        digest = CATALOG.digest(name, st) if CATALOG is not None else None
+        if digest is None:
+            digest = self.hash_file(path)
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime) != (st.st_size, st.st_mtime):
+                return digest
+            if CATALOG is not None:
+                CATALOG.store_digest(name, st, digest)
+        with self._lock:
+            self._set_locked(name, (st.st_size, st.st_mtime, digest))
+        return digest
+
+    def find(self, digest, size):
+        """查找内容为 digest 的文件，返回文件名或 None"""
+        with self._lock:
+            names = sorted(self._by_hash.get(digest, ()))
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                st = None
+            with self._lock:
+                record = self._files.get(name)
+                if record is None or record[2] != digest:
+                    continue
+                if st is not None and (st.st_size, st.st_mtime) == record[:2]:
+                    if st.st_size == size:
+                        return name
+                    continue
+                self._set_locked(name, None)
+        # 本进程只索引了打开过的目录，文件目录数据库里有整棵目录树的哈希
+        if CATALOG is not None:
+            for name, recorded in CATALOG.find(digest, size):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                if (st.st_size, st.st_mtime) == recorded:
+                    return name
+        return None
+
+    def scan(self):
+        """补算新文件和变化过的文件的哈希，清理已删除文件的记录"""
+        self._load()
+        # 只处理已经有人打开过的目录，不为补算哈希遍历整棵目录树
+        loaded = get_tree().loaded()
+        files = [dict(item, name=posixpath.join(rel, item['name']))
+                 for rel, cache in loaded for item in cache.files()]
+        present = {item['name'] for item in files}
+        loaded = {rel for rel, _ in loaded}
+        with self._lock:
+            for name in self._files.keys() - present:
+                if posixpath.dirname(name) in loaded:
+                    self._set_locked(name, None)
+        for item in files:
+            if SHUTDOWN.is_set():
+                break
+            with self._lock:
+                record = self._files.get(item['name'])
+            if record is None or record[:2] != (item['bytes'], item['mtime']):
+                try:
+                    self.digest_of(item['name'])
+                except OSError:
+                    pass
+                if time.monotonic() - self._saved_at > self.interval:
+                    self.save()
+        self.save()
+
+    def _run(self):
+        while not SHUTDOWN.is_set():
+            try:
+                self.scan()
+            except OSError:
+                pass
+            SHUTDOWN.wait(self.interval)
+
+    def start(self):
+        """启动后台哈希线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='quickshare-hash', daemon=True)
+            self._thread.start()
+
+
+def get_content_index():
+    """返回当前共享目录的内容哈希索引（每个进程一份）"""
+    global CONTENT_INDEX
+    if CONTENT_INDEX is None or CONTENT_INDEX.path != UPLOAD_DIR or CONTENT_INDEX.pid != os.getpid():
+        CONTENT_INDEX = ContentIndex(UPLOAD_DIR)
+        CONTENT_INDEX.start()
+    return CONTENT_INDEX
+
+
+class Catalog:
+    """可选的文件目录数据库（SQLite，保存在 .quickshare/catalog.sqlite3）
+
+    记录每个目录的 mtime，以及每个文件的大小、修改时间、sha256、上传时间、
+    上传者 IP 和下载次数。后台线程启动时按目录 mtime 与文件系统对账，只重新
+    扫描 mtime 变化过的目录，之后定期重复；缺少或过期的哈希由线程池补算。
+    目录 mtime 与记录一致时，文件列表和搜索索引直接从数据库加载，不必扫描。
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT,
+            hashed_size INTEGER,
+            hashed_mtime REAL,
+            uploaded_at REAL,
+            uploader TEXT,
+            downloads INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            parent TEXT,
+            mtime_ns INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+    '''
+
+    def __init__(self, path, workers=CATALOG_HASH_WORKERS, interval=HASH_INDEX_INTERVAL):
+        self.path = path
+        self.workers = workers
+        self.interval = interval
+        os.makedirs(os.path.join(path, STATE_DIR_NAME), exist_ok=True)
+        self.db_path = os.path.join(path, STATE_DIR_NAME, CATALOG_NAME)
+        self.ready = threading.Event()
+        self.rescanned = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._downloads = {}  # 相对路径 -> 尚未写入的下载次数
+        self._flushed_at = time.monotonic()
+        self._failed = set()  # 无法读取、不再重试哈希的文件
+        self._thread = None
+        self._db().executescript(self.SCHEMA)
+
+    def _db(self):
+        """每个线程（fork 后的每个进程）一个连接"""
+        import sqlite3
+
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self, write=False):
+        db = self._db()
+        # 写事务一开始就拿写锁，避免多个进程读后升级时互相等待
+        db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _abspath(self, rel):
+        return os.path.join(self.path, *rel.split('/')) if rel else self.path
+
+    @staticmethod
+    def _delete_tree(db, rel):
+        # rel + '/' 到 rel + '0' 之间恰好是 rel 下的所有路径（'0' 紧跟在 '/' 之后），可以用上索引
+        low, high = rel + '/', rel + '0'
+        db.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (rel, low, high))
+        db.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))
+
+    def _sync_subdirs(self, db, rel, names):
+        old = {posixpath.basename(p) for (p,) in db.execute('SELECT path FROM dirs WHERE parent = ?', (rel,))}
+        for name in old - names:
+            self._delete_tree(db, posixpath.join(rel, name))
+        db.executemany('INSERT OR IGNORE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, NULL)',
+                       [(posixpath.join(rel, name), rel) for name in names - old])
+
+    def _upsert_files(self, db, rel, entries):
+        db.executemany(
+            'INSERT INTO files (path, dir, name, size, mtime) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime',
+            [(posixpath.join(rel, name), rel, name, size, mtime) for name, (size, mtime) in entries])
+
+    def _reconcile_dir(self, rel):
+        """对账一个目录，返回其子目录的相对路径列表"""
+        path = self._abspath(rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        db = self._db()
+        row = db.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (rel,)).fetchone()
+        if mtime is not None and row is not None and row[0] == mtime:
+            return [p for (p,) in db.execute('SELECT path FROM dirs WHERE parent = ?', (rel,))]
+        files, subdirs = {}, set()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != STATE_DIR_NAME:
+                                subdirs.add(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime)
+                    except OSError:
+                        continue
+        except OSError:
+            with self._transaction(write=True) as db:
+                self._delete_tree(db, rel)
+            return []
+        self.rescanned += 1
+        with self._transaction(write=True) as db:
+            known = {name: (size, mt) for name, size, mt in
+                     db.execute('SELECT name, size, mtime FROM files WHERE dir = ?', (rel,))}
+            db.executemany('DELETE FROM files WHERE path = ?',
+                           [(posixpath.join(rel, name),) for name in known.keys() - files.keys()])
+            self._upsert_files(db, rel, [(name, entry) for name, entry in files.items() if known.get(name) != entry])
+            self._sync_subdirs(db, rel, subdirs)
+            db.execute('INSERT INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?) '
+                       'ON CONFLICT (path) DO UPDATE SET mtime_ns = excluded.mtime_ns',
+                       (rel, posixpath.dirname(rel) if rel else None, mtime))
+        return [posixpath.join(rel, name) for name in subdirs]
+
+    def reconcile(self):
+        """与文件系统对账：目录 mtime 没变的目录直接沿用记录，只检查它的子目录"""
+        stack = ['']
+        while stack and not SHUTDOWN.is_set():
+            stack.extend(self._reconcile_dir(stack.pop()))
+
+    def _hash_one(self, rel):
+        path = self._abspath(rel)
+        try:
+            st = os.stat(path)
+            digest = ContentIndex.hash_file(path)
+            after = os.stat(path)
+        except FileNotFoundError:
+            with self._transaction(write=True) as db:
+                db.execute('DELETE FROM files WHERE path = ?', (rel,))
+            return
+        except OSError:
+            self._failed.add(rel)
+            return
+        if (after.st_size, after.st_mtime) == (st.st_size, st.st_mtime):
+            self.store_digest(rel, st, digest)
+
+    def fill_hashes(self):
+        """用线程池补算缺少或已过期的哈希"""
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='quickshare-catalog') as pool:
+            while not SHUTDOWN.is_set():
+                rows = self._db().execute(
+                    'SELECT path FROM files WHERE sha256 IS NULL OR hashed_size IS NOT size '
+                    'OR hashed_mtime IS NOT mtime LIMIT ?', (256 + len(self._failed),)).fetchall()
+                paths = [rel for (rel,) in rows if rel not in self._failed]
+                if not paths:
+                    break
+                list(pool.map(self._hash_one, paths))
+
+    def listing(self, rel):
+        """目录 mtime 与记录一致时返回 ({文件名: (size, mtime)}, {子目录名: mtime}, 目录 mtime_ns)，否则返回 None"""
+        import sqlite3
+
+        try:
+            mtime = os.stat(self._abspath(rel)).st_mtime_ns
+            with self._transaction() as db:
+                row = db.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (rel,)).fetchone()
+                if row is None or row[0] != mtime:
+                    return None
+                files = {name: (size, mt) for name, size, mt in
+                         db.execute('SELECT name, size, mtime FROM files WHERE dir = ?', (rel,))}
+                dirs = {posixpath.basename(p): (ns or 0) / 1e9 for p, ns in
+                        db.execute('SELECT path, mtime_ns FROM dirs WHERE parent = ?', (rel,))}
+        except (OSError, sqlite3.Error):
+            return None
+        return files, dirs, mtime
+
+    def apply(self, rel, changes):
+        """记录列表缓存发现的变化（格式见 DirectoryCache）；目录本身的 mtime 留给下次对账"""
+        import sqlite3
+
+        try:
+            with self._transaction(write=True) as db:
+                db.executemany('DELETE FROM files WHERE path = ?',
+                               [(posixpath.join(rel, name),) for name in changes['removed']])
+                self._upsert_files(db, rel, [(item['name'], (item['bytes'], item['mtime']))
+                                             for item in changes['added'] + changes['changed']])
+                if 'dirs' in changes:
+                    self._sync_subdirs(db, rel, {item['name'] for item in changes['dirs']})
+        except sqlite3.Error:
+            pass
+
+    def record_upload(self, name, digest, uploader):
+        """登记上传完成的文件：哈希、上传时间和上传者"""
+        import sqlite3
+
+        try:
+            st = os.stat(self._abspath(name))
+            parent, _, base = name.rpartition('/')
+            with self._transaction(write=True) as db:
+                db.execute(
+                    'INSERT INTO files (path, dir, name, size, mtime, sha256, hashed_size, hashed_mtime, '
+                    'uploaded_at, uploader) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                    'sha256 = excluded.sha256, hashed_size = excluded.hashed_size, '
+                    'hashed_mtime = excluded.hashed_mtime, uploaded_at = excluded.uploaded_at, '
+                    'uploader = excluded.uploader',
+                    (name, parent, base, st.st_size, st.st_mtime, digest, st.st_size, st.st_mtime,
+                     time.time(), uploader))
+        except (OSError, sqlite3.Error):
+            pass
+
+    def store_digest(self, name, st, digest):
+        """记录 name 在大小、修改时间为 st 时的 sha256"""
+        import sqlite3
+
+        parent, _, base = name.rpartition('/')
+        try:
+            with self._transaction(write=True) as db:
+                db.execute(
+                    'INSERT INTO files (path, dir, name, size, mtime, sha256, hashed_size, hashed_mtime) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+                    'sha256 = excluded.sha256, hashed_size = excluded.hashed_size, '
+                    'hashed_mtime = excluded.hashed_mtime',
+                    (name, parent, base, st.st_size, st.st_mtime, digest, st.st_size, st.st_mtime))
+        except sqlite3.Error:
+            pass
+
+    def digest(self, name, st):
+        """返回与 st 的大小、修改时间一致的 sha256 记录，没有时返回 None"""
+        import sqlite3
+
+        try:
+            row = self._db().execute('SELECT sha256, hashed_size, hashed_mtime FROM files WHERE path = ?',
+                                     (name,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is not None and row[0] and tuple(row[1:]) == (st.st_size, st.st_mtime):
+            return row[0]
+        return None
+
+    def find(self, digest, size):
+        """返回 [(相对路径, 算哈希时的 (size, mtime))]，调用方需要重新 stat 确认"""
+        import sqlite3
+
+        try:
+            rows = self._db().execute('SELECT path, hashed_size, hashed_mtime FROM files '
+                                      'WHERE sha256 = ? AND hashed_size = ? ORDER BY path', (digest, size))
+            return [(rel, (hsize, hmtime)) for rel, hsize, hmtime in rows]
+        except sqlite3.Error:
+            return []
+
+    def record_download(self, name):
+        """下载次数先在内存中累加，每隔 CATALOG_FLUSH_INTERVAL 秒批量写入"""
+        with self._lock:
+            self._downloads[name] = self._downloads.get(name, 0) + 1
+            due = time.monotonic() - self._flushed_at >= CATALOG_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        import sqlite3
+
+        with self._lock:
+            pending, self._downloads = self._downloads, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            with self._transaction(write=True) as db:
+                db.executemany('UPDATE files SET downloads = downloads + ? WHERE path = ?',
+                               [(n, rel) for rel, n in pending.items()])
+        except sqlite3.Error:
+            with self._lock:
+                for rel, n in pending.items():
+                    self._downloads[rel] = self._downloads.get(rel, 0) + n
+
+    def info(self, name):
+        """返回文件的全部记录，没有记录时返回 None；哈希已过期时 sha256 为 None"""
+        self.flush()
+        row = self._db().execute(
+            'SELECT size, mtime, sha256, hashed_size, hashed_mtime, uploaded_at, uploader, downloads '
+            'FROM files WHERE path = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        size, mtime, digest, hashed_size, hashed_mtime, uploaded_at, uploader, downloads = row
+        if (hashed_size, hashed_mtime) != (size, mtime):
+            digest = None
+        return {'path': name, 'name': posixpath.basename(name), 'size': format_size(size), 'bytes': size,
+                'mtime': mtime, 'sha256': digest, 'uploaded_at': uploaded_at, 'uploader': uploader,
+                'downloads': downloads}
+
+    def _run(self):
+        import sqlite3
+
+        while not SHUTDOWN.is_set():
+            try:
+                self.reconcile()
+                self.ready.set()
+                self.fill_hashes()
+                self.flush()
+            except (OSError, sqlite3.Error) as e:
+                print(f'文件目录数据库更新失败: {e}', file=sys.stderr)
+            SHUTDOWN.wait(self.interval)
+        self.flush()
+
+    def start(self):
+        """启动后台对账和补算哈希的线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='quickshare-catalog', daemon=True)
+            self._thread.start()
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """整个共享目录（含子目录）的文件名搜索索引
+
+    按相对路径（不区分大小写）的三字符片段建立倒排表，另按文件名的前一两个字符
+    分桶，供更短的关键词做前缀查询。后台线程先遍历一次目录树，之后每 interval
+    秒只 stat 已知目录、重新扫描 mtime 变化过的目录；上传完成以及已加载目录的
+    列表缓存发现变化时即时更新。
+    """
+
+    def __init__(self, path, interval=SEARCH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.pid = os.getpid()
+        self.ready = threading.Event()
+        self.version = 0  # 文件集合或任一文件的大小、mtime 变化时递增
+        self._lock = threading.Lock()
+        self._files = {}  # 相对路径 -> (size, mtime)
+        # 相对路径 -> (层级深度, 文件名长度, 小写路径, 小写文件名, 相对路径)；倒排表中直接存放
+        # 这个元组，查询时不必再查字典，元组本身的顺序就是同一档内的排序
+        self._records = {}
+        self._grams = {}  # trigram -> 记录集合
+        self._prefixes = {}  # 文件名前一、两个字符 -> 记录集合
+        self._dirs = {}  # 相对目录 -> mtime_ns，None 表示等待扫描
+        self._children = {}  # 相对目录 -> 其中的文件名集合
+        self._subdirs = {}  # 相对目录 -> 子目录名集合
+        self._wake = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _keys(record):
+        return _trigrams(record[2]), {record[3][:1], record[3][:2]}
+
+    def _add_locked(self, rel, entry):
+        known = rel in self._files
+        if known and self._files[rel] == entry:
+            return
+        self._files[rel] = entry
+        self.version += 1
+        if known:
+            return
+        folded = rel.casefold()
+        name = posixpath.basename(folded)
+        record = self._records[rel] = (folded.count('/'), len(name), folded, name, rel)
+        grams, prefixes = self._keys(record)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(record)
+        for prefix in prefixes:
+            self._prefixes.setdefault(prefix, set()).add(record)
+        parent, _, name = rel.rpartition('/')
+        self._children.setdefault(parent, set()).add(name)
+
+    def _remove_locked(self, rel):
+        if self._files.pop(rel, None) is None:
+            return
+        self.version += 1
+        record = self._records.pop(rel)
+        grams, prefixes = self._keys(record)
+        for table, keys in ((self._grams, grams), (self._prefixes, prefixes)):
+            for key in keys:
+                postings = table.get(key)
+                if postings is not None:
+                    postings.discard(record)
+                    if not postings:
+                        del table[key]
+        parent, _, name = rel.rpartition('/')
+        children = self._children.get(parent)
+        if children is not None:
+            children.discard(name)
+
+    def _drop_dir_locked(self, rel):
+        for name in self._subdirs.pop(rel, ()):
+            self._drop_dir_locked(posixpath.join(rel, name))
+        for name in list(self._children.get(rel, ())):
+            self._remove_locked(posixpath.join(rel, name))
+        self._children.pop(rel, None)
+        self._dirs.pop(rel, None)
+
+    def _scan_dir(self, rel):
+        """重新扫描一个目录，新出现的子目录标记为待扫描"""
+        path = os.path.join(self.path, *rel.split('/')) if rel else self.path
+        files, subdirs = {}, set()
+        listing = CATALOG.listing(rel) if CATALOG is not None else None
+        if listing is not None:
+            # 目录没变，直接用文件目录数据库里的记录
+            files, dirs, mtime = listing
+            subdirs = set(dirs)
+        else:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name != STATE_DIR_NAME:
+                                    subdirs.add(entry.name)
+                            elif entry.is_file():
+                                st = entry.stat()
+                                files[entry.name] = (st.st_size, st.st_mtime)
+                        except OSError:
+                            continue
+            except OSError:
+                with self._lock:
+                    self._drop_dir_locked(rel)
+                return
+        with self._lock:
+            for name in self._children.get(rel, set()) - files.keys():
+                self._remove_locked(posixpath.join(rel, name))
+            for name, entry in files.items():
+                self._add_locked(posixpath.join(rel, name), entry)
+            old = self._subdirs.get(rel, set())
+            for name in old - subdirs:
+                self._drop_dir_locked(posixpath.join(rel, name))
+            for name in subdirs - old:
+                self._dirs[posixpath.join(rel, name)] = None
+            self._subdirs[rel] = subdirs
+            self._dirs[rel] = mtime
+
+    def sync(self):
+        """一轮增量同步：重新扫描 mtime 变化过的目录，新发现的子目录随即扫描"""
+        with self._lock:
+            self._dirs.setdefault('', None)
+            known = list(self._dirs.items())
+        stale = []
+        for rel, mtime in known:
+            if mtime is not None:
+                try:
+                    if os.stat(os.path.join(self.path, *rel.split('/'))).st_mtime_ns == mtime:
+                        continue
+                except OSError:
+                    pass
+            stale.append(rel)
+        while stale and not SHUTDOWN.is_set():
+            for rel in stale:
+                self._scan_dir(rel)
+            with self._lock:
+                stale = [rel for rel, mtime in self._dirs.items() if mtime is None]
+
+    def apply(self, rel, changes):
+        """应用已加载目录 rel 的列表缓存发现的变化（格式见 DirectoryCache）"""
+        with self._lock:
+            if rel not in self._dirs:
+                # 还没遍历到的目录，留给后台线程
+                return
+            for name in changes['removed']:
+                self._remove_locked(posixpath.join(rel, name))
+            for item in changes['added'] + changes['changed']:
+                self._add_locked(posixpath.join(rel, item['name']), (item['bytes'], item['mtime']))
+            if 'dirs' in changes:
+                self._dirs[rel] = None
+                self._wake.set()
+
+    def update(self, name):
+        """上传完成后更新单个文件（相对路径）；新建的上级目录由下一轮同步补扫"""
+        try:
+            st = os.stat(os.path.join(self.path, *name.split('/')))
+        except OSError:
+            st = None
+        with self._lock:
+            if st is not None and stat.S_ISREG(st.st_mode):
+                self._add_locked(name, (st.st_size, st.st_mtime))
+            else:
+                self._remove_locked(name)
+
+    def search(self, query, limit=SEARCH_LIMIT, under=''):
+        """按空格分隔的关键词搜索（全部命中才算匹配），under 限定子目录
+
+        返回 (按相关度排序的前 limit 个结果, 匹配总数)。文件名等于、以关键词开头、
+        包含关键词、仅路径包含关键词的结果依次靠后，同一档内浅层、短名优先。
+        关键词都不足三个字符时按文件名前缀匹配最长的关键词。
+        """
+        terms = query.casefold().split()
+        if not terms:
+            return [], 0
+        phrase = ' '.join(terms)
+        scope = under.casefold() + '/' if under else ''
+        with self._lock:
+            grams = [self._grams.get(gram, frozenset()) for term in terms if len(term) >= 3 for gram in _trigrams(term)]
+            if grams:
+                grams.sort(key=len)
+                matches = grams[0].intersection(*grams[1:])
+            else:
+                matches = self._prefixes.get(max(terms, key=len), ())
+            # trigram 只是候选，逐个确认子串
+            for term in terms:
+                matches = [rec for rec in matches if term in rec[2]]
+            if scope:
+                matches = [rec for rec in matches if rec[2].startswith(scope)]
+            total = len(matches)
+            # 各档逐层嵌套，从宽到窄依次过滤；取结果时从最窄的一档开始，
+            # 宽泛的关键词也只需几次线性过滤和一次部分排序
+            named = matches
+            for term in terms:
+                named = [rec for rec in named if term in rec[3]]
+            contains = [rec for rec in named if phrase in rec[3]] if len(terms) > 1 else named
+            prefixed = [rec for rec in contains if rec[3].startswith(phrase)]
+            dotted = phrase + '.'
+            exact = [rec for rec in prefixed if rec[3] == phrase or rec[3].startswith(dotted)]
+            picked, taken = [], set()
+            for level in (exact, prefixed, contains, named, matches):
+                if len(picked) >= limit:
+                    break
+                if taken:
+                    level = [rec for rec in level if id(rec) not in taken]
+                best = heapq.nsmallest(limit - len(picked), level)
+                picked.extend(best)
+                taken.update(map(id, best))
+            results = []
+            for *_, rel in picked:
+                size, mtime = self._files[rel]
+                parent, _, name = rel.rpartition('/')
+                results.append({'path': rel, 'name': name, 'dir': parent,
+                                'size': format_size(size), 'bytes': size, 'mtime': mtime})
+        return results, total
+
+    def snapshot(self):
+        """返回 (版本号, {相对路径: (size, mtime)})，即整个共享目录的文件清单"""
+        with self._lock:
+            return self.version, dict(self._files)
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'directories': len(self._dirs), 'grams': len(self._grams),
+                    'ready': self.ready.is_set()}
+
+    def _run(self):
+        while not SHUTDOWN.is_set():
+            try:
+                self.sync()
+            except OSError:
+                pass
+            self.ready.set()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        """启动后台索引线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='quickshare-search', daemon=True)
+            self._thread.start()
+
+
+def get_search_index():
+    """返回当前共享目录的文件名搜索索引（每个进程一份）"""
+    global SEARCH_INDEX
+    if SEARCH_INDEX is None or SEARCH_INDEX.path != UPLOAD_DIR or SEARCH_INDEX.pid != os.getpid():
+        SEARCH_INDEX = SearchIndex(UPLOAD_DIR)
+        SEARCH_INDEX.start()
+    return SEARCH_INDEX
+
+
+FICLONE = 0x40049409  # Linux: ioctl(dest_fd, FICLONE, src_fd)
+
+
+def clone_file(source, dest):
+    """在 dest 新建一个与 source 共享数据块的文件，返回所用方式，做不到时返回 None
+
+    auto 只用 reflink（写时复制，两个文件互不影响），不支持时由调用方保存独立副本；
+    硬链接会让两个文件名指向同一份数据，只有明确指定 --dedup hardlink 时才使用。
+    """
+    if DEDUP_MODE in ('auto', 'reflink') and fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(dest, 'xb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            try:
+                os.remove(dest)
+            except OSError:
+                pass
+    if DEDUP_MODE == 'hardlink':
+        try:
+            os.link(source, dest)
+            return 'hardlink'
+        except OSError:
+            pass
+    return None
+
+
+def place_file(tmp_path, name, overwrite=False):
+    """把临时文件移动到共享目录（name 为相对路径，上级目录按需创建），返回最终文件名
+
+    overwrite 为假时不覆盖已有文件，依次尝试 "name (1).ext"、"name (2).ext"……
+    """
+    parent = make_parent(name)
+    prefix, _, base = name.rpartition('/')
+    if overwrite and not os.path.isdir(os.path.join(parent, base)):
+        os.replace(tmp_path, os.path.join(parent, base))
+        return name
+    stem, ext = os.path.splitext(base)
+    for n in itertools.count():
+        candidate = base if n == 0 else f'{stem} ({n}){ext}'
+        dest = os.path.join(parent, candidate)
+        candidate = posixpath.join(prefix, candidate)
+        try:
+            # link 不会覆盖已有文件，同时上传的同名文件不会互相覆盖
+            os.link(tmp_path, dest)
+        except FileExistsError:
+            continue
+        except OSError:
+            # 文件系统不支持硬链接（如 FAT32/exFAT）
+            if os.path.lexists(dest):
+                continue
+            os.replace(tmp_path, dest)
+            return candidate
+        os.remove(tmp_path)
+        return candidate
+
+
+def store_file(tmp_path, name, digest, overwrite=False, uploader=None):
+    """把写好的临时文件放入共享目录并登记哈希，返回最终文件名
+
+    同名文件内容相同时直接丢弃临时文件；其它文件已有相同内容时换成它的
+    reflink/硬链接，不再占用额外空间。uploader 为上传者 IP，记入文件目录数据库。
+    """
+    index = get_content_index()
+    size = os.path.getsize(tmp_path)
+    if index.digest_of(name, size) == digest:
+        os.remove(tmp_path)
+        if CATALOG is not None:
+            CATALOG.record_upload(name, digest, uploader)
+        return name
+    source = index.find(digest, size)
+    if source is not None:
+        link_path = tmp_path + '.link'
+        if clone_file(os.path.join(UPLOAD_DIR, source), link_path):
+            # 不用 os.replace：两者已经是同一文件的硬链接时 rename 什么也不做
+            os.remove(tmp_path)
+            os.rename(link_path, tmp_path)
+    tree = get_tree()
+    before = tree.dir_mtimes(name)
+    final = place_file(tmp_path, name, overwrite)
+    index.record(final, digest)
+    tree.update(final, before)
+    get_search_index().update(final)
+    if CATALOG is not None:
+        CATALOG.record_upload(final, digest, uploader)
+    get_thumbnail_cache().schedule(final)
+    return final
+
+
+def arg_flag(args, name):
+    """查询参数中的开关，如 ?overwrite=1"""
+    return args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def wants_overwrite(args):
+    """?overwrite=1 表示覆盖同名文件，默认另存为新名称"""
+    return arg_flag(args, 'overwrite')
+
+
+class UploadWriter:
+    """上传文件写入器
+
+    数据写入 .quickshare/tmp 下的临时文件（与共享目录在同一文件系统），
+    commit 时原子地改名到共享目录，因此每个字节只落盘一次，下载方也不会
+    读到写了一半的文件。写入的同时计算 sha256，用于去重。
+    """
+
+    def __init__(self, name, uploader=None):
+        self.name = name
+        self.uploader = uploader
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self.tmp_path = os.path.join(state_dir('tmp'), secrets.token_hex(16) + '.tmp')
+        fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        self._file = open(fd, 'wb', buffering=COPY_BUFFER)
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        """已写入内容的 sha256"""
+        return self._hash.hexdigest()
+
+    def sync(self):
+        """把已写入的内容刷到磁盘（commit 之前调用）"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def copy_from(self, stream):
+        """把 stream 剩余的内容全部写入"""
+        while True:
+            buf = stream.read(COPY_BUFFER)
+            if not buf:
+                break
+            self.write(buf)
+
+    def commit(self, overwrite=False):
+        """完成写入并移动到共享目录，返回最终文件名（见 store_file）"""
+        self._file.close()
+        return store_file(self.tmp_path, self.name, self._hash.hexdigest(), overwrite, self.uploader)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._file.closed:
+            self.abort()
+
+
+class MultipartUpload:
+    """不依赖具体 I/O 的 multipart/form-data 上传解析器
+
+    调用方不断 feed() 请求体数据，field 字段中的每个文件边解析边写入
+    UploadWriter，不经过 Werkzeug 的表单解析和临时文件。文件名可以带相对
+    路径（上传文件夹时），保存到 directory 下对应的子目录中。
+    """
+
+    def __init__(self, boundary, field='files', overwrite=False, directory='', uploader=None):
+        self.field = field
+        self.overwrite = overwrite
+        self.directory = directory
+        self.uploader = uploader
+        self.uploaded = []
+        self.seen = False
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'))
+        self._writer = None
+
+    def feed(self, chunk):
+        """输入一段请求体（b'' 表示结束），解析到结尾边界时返回 True"""
+        self._decoder.receive_data(chunk or None)
+        event = self._decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, File):
+                if event.name == self.field:
+                    self.seen = True
+                    # 防止路径遍历攻击
+                    name = safe_path(event.filename)
+                    self._writer = UploadWriter(posixpath.join(self.directory, name), self.uploader) if name else None
+            elif isinstance(event, Data) and self._writer is not None:
+                self._writer.write(event.data)
+                if not event.more_data:
+                    self.uploaded.append(self._writer.commit(self.overwrite))
+                    self._writer = None
+            event = self._decoder.next_event()
+        if isinstance(event, Epilogue):
+            return True
+        if not chunk:
+            raise ValueError('请求体不完整')
+        return False
+
+    def close(self):
+        """丢弃未写完的文件"""
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+    def result(self):
+        """返回已保存的文件名列表；请求中没有该字段时返回 None"""
+        return self.uploaded if self.seen else None
+
+
+def save_multipart_stream(stream, boundary, field='files', overwrite=False, directory='', uploader=None):
+    """从同步流读取并保存 multipart/form-data 上传，返回值同 MultipartUpload.result"""
+    upload = MultipartUpload(boundary, field, overwrite, directory, uploader)
+    try:
+        while not upload.feed(stream.read(COPY_BUFFER)):
+            pass
+    finally:
+        upload.close()
+    return upload.result()
+
+
+def fsync_dir(path):
+    """把目录项的变化（新建、改名的文件）写入磁盘；不支持打开目录的平台（Windows）上忽略"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _PrefixedReader:
+    """先返回已经读出的 prefix，再继续读 stream"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+class ChunkPipe:
+    """把事件循环收到的数据块交给工作线程中按 read() 读取的消费者
+
+    缓存的数据超过 limit 时 put 阻塞，形成反压；消费者提前结束时调用 close，之后的
+    数据直接丢弃，之后的 read 返回 b''。put(b'') 表示数据结束。
+    """
+
+    def __init__(self, limit=4 * COPY_BUFFER):
+        self.limit = limit
+        self.closed = False
+        self._chunks = deque()
+        self._size = 0
+        self._eof = False
+        self._cond = threading.Condition()
+
+    def put(self, chunk):
+        with self._cond:
+            while self._size >= self.limit and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return
+            if chunk:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            else:
+                self._eof = True
+            self._cond.notify_all()
+
+    def read(self, size=-1):
+        with self._cond:
+            while not self._chunks and not self._eof and not self.closed:
+                self._cond.wait()
+            if not self._chunks:
+                return b''
+            chunk = self._chunks.popleft()
+            if 0 <= size < len(chunk):
+                self._chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            self._size -= len(chunk)
+            self._cond.notify_all()
+            return chunk
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+
+class TarIngest:
+    """把 tar 流（可以是 gzip/bz2/xz 压缩的，装有 zstandard 时也支持 zstd）边接收边解包到 directory
+
+    成员路径经 safe_path 规范化，含 .. 的成员以及符号链接、硬链接、设备文件等一律跳过。
+    每个文件写入 .quickshare/tmp 下的临时文件；攒够一批后先逐个 fsync，再依次移入共享
+    目录，最后 fsync 涉及的目录，因此每个文件只有写数据和改名的开销，也不会在断电后留下
+    只写了一半的文件。
+    """
+
+    def __init__(self, directory='', overwrite=False, uploader=None):
+        self.directory = directory
+        self.overwrite = overwrite
+        self.uploader = uploader
+        self.files = []
+        self.skipped = []
+        self._pending = []
+        self._pending_bytes = 0
+
+    @staticmethod
+    def _open(stream):
+        # tarfile 只凭第一次 read 的结果判断压缩格式，所以先凑满一个 tar 块
+        import tarfile
+
+        head = b''
+        while len(head) < tarfile.BLOCKSIZE:
+            data = stream.read(tarfile.BLOCKSIZE - len(head))
+            if not data:
+                break
+            head += data
+        stream = _PrefixedReader(head, stream)
+        if head.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError('服务器未安装 zstandard，无法解压 zstd')
+            stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        return tarfile.open(fileobj=stream, mode='r|*', bufsize=COPY_BUFFER)
+
+    def run(self, stream):
+        """读完整个 tar 流，返回 (已保存的文件名列表, 跳过的成员列表)；数据无效时抛出 ValueError"""
+        import tarfile
+
+        try:
+            with self._open(stream) as tar:
+                for member in tar:
+                    self._extract(tar, member)
+            self._flush()
+        except (tarfile.TarError, EOFError, zlib.error) as e:
+            raise ValueError(f'无效的 tar 数据: {e}')
+        finally:
+            for writer in self._pending:
+                writer.abort()
+        return self.files, self.skipped
+
+    def _extract(self, tar, member):
+        rel = safe_path(member.name)
+        if rel == '' and member.isdir():
+            return
+        name = posixpath.join(self.directory, rel) if rel else None
+        if name is None or not (member.isreg() or member.isdir()):
+            self.skipped.append(member.name)
+            return
+        if member.isdir():
+            try:
+                make_parent(posixpath.join(name, ''))
+            except ValueError:
+                self.skipped.append(member.name)
+            return
+        if not check_parent(name):
+            self.skipped.append(member.name)
+            return
+        writer = UploadWriter(name, self.uploader)
+        self._pending.append(writer)
+        writer.copy_from(tar.extractfile(member))
+        if writer.size != member.size:
+            raise ValueError(f'{member.name} 不完整')
+        self._pending_bytes += writer.size
+        if len(self._pending) >= TAR_BATCH_FILES or self._pending_bytes >= TAR_BATCH_BYTES:
+            self._flush()
+
+    def _flush(self):
+        """一批文件落盘：先 fsync 所有临时文件，再移入共享目录，最后 fsync 涉及的目录"""
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        try:
+            for writer in pending:
+                writer.sync()
+        except OSError:
+            for writer in pending:
+                writer.abort()
+            raise
+        dirs = set()
+        for i, writer in enumerate(pending):
+            try:
+                name = writer.commit(self.overwrite)
+            except ValueError:
+                writer.abort()
+                self.skipped.append(writer.name)
+                continue
+            except OSError:
+                # 磁盘满、权限不足等：这一批剩下的临时文件不能留在 .quickshare/tmp 里
+                for rest in pending[i:]:
+                    rest.abort()
+                raise
+            self.files.append(name)
+            dirs.add(name.rpartition('/')[0])
+        for rel in dirs:
+            path = resolve_dir(rel)
+            if path is not None:
+                fsync_dir(path)
+
+
+class Histogram:
+    """固定分桶的直方图（桶上界 le 包含在内）"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """返回 [(上界, 累计次数)]，最后一项上界为 inf"""
+        return list(zip((*self.buckets, float('inf')), itertools.accumulate(self.counts)))
+
+    def quantile(self, q):
+        """按桶上界估计分位数，没有数据时返回 None"""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound if bound != float('inf') else self.buckets[-1]
+
+
+class Metrics:
+    """进程内的请求和传输指标
+
+    请求按路由模板（如 /download/<filename>）统计到响应头发出为止的耗时；
+    传输按 Flow 统计字节数和吞吐量，进行中的传输在导出时才累加，
+    收发数据的路径上只有一次整数加法。
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._latency = {}  # (route, method) -> Histogram
+        self._statuses = {}  # (route, method, status) -> 次数
+        self._active = set()
+        self._bytes = {'in': 0, 'out': 0}
+        self._transfers = {'in': 0, 'out': 0}
+        self._throughput = {'in': Histogram(THROUGHPUT_BUCKETS), 'out': Histogram(THROUGHPUT_BUCKETS)}
+
+    def observe_request(self, route, method, status, seconds):
+        with self._lock:
+            histogram = self._latency.get((route, method))
+            if histogram is None:
+                histogram = self._latency[route, method] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            key = (route, method, status)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def transfer_started(self, flow):
+        with self._lock:
+            self._active.add(flow)
+
+    def active_transfers(self, direction):
+        """进行中的传输数，direction 为 'in' 或 'out'"""
+        with self._lock:
+            return sum(1 for flow in self._active if flow.direction == direction)
+
+    def transfer_finished(self, flow):
+        elapsed = time.monotonic() - flow.started
+        with self._lock:
+            self._active.discard(flow)
+            self._bytes[flow.direction] += flow.transferred
+            self._transfers[flow.direction] += 1
+            if flow.transferred >= THROUGHPUT_MIN and elapsed > 0:
+                self._throughput[flow.direction].observe(flow.transferred / elapsed)
+
+    def _collect(self):
+        """在锁内复制当前计数，进行中传输的字节数计入总量"""
+        with self._lock:
+            latency = {key: (h.cumulative(), h.sum, h.count, [h.quantile(q) for q in (0.5, 0.95, 0.99)])
+                       for key, h in self._latency.items()}
+            statuses = dict(self._statuses)
+            nbytes = dict(self._bytes)
+            active = {'in': 0, 'out': 0}
+            for flow in self._active:
+                nbytes[flow.direction] += flow.transferred
+                active[flow.direction] += 1
+            transfers = dict(self._transfers)
+            throughput = {d: (h.cumulative(), h.sum, h.count, [h.quantile(q) for q in (0.5, 0.95, 0.99)])
+                          for d, h in self._throughput.items()}
+        return latency, statuses, nbytes, active, transfers, throughput
+
+    @staticmethod
+    def _components():
+        """各缓存和准入控制的统计"""
+        caches = {}
+        if HOT_CACHE is not None:
+            caches['hot'] = HOT_CACHE.stats()
+        if THUMB_CACHE is not None:
+            caches['thumbnail'] = THUMB_CACHE.stats()
+        if VARIANT_CACHE is not None:
+            caches['compressed'] = VARIANT_CACHE.stats()
+        listing = FILE_CACHE.stats() if FILE_CACHE is not None else None
+        uploads = ADMISSION.stats() if ADMISSION is not None else None
+        return caches, listing, uploads
+
+    def snapshot(self):
+        """JSON 格式的全部指标"""
+        latency, statuses, nbytes, active, transfers, throughput = self._collect()
+        caches, listing, uploads = self._components()
+        routes = []
+        for (route, method), (_, total, count, quantiles) in sorted(latency.items()):
+            routes.append({
+                'route': route,
+                'method': method,
+                'count': count,
+                'avg_ms': round(total / count * 1000, 3),
+                'p50_ms': quantiles[0] * 1000,
+                'p95_ms': quantiles[1] * 1000,
+                'p99_ms': quantiles[2] * 1000,
+                'status': {str(s): n for (r, m, s), n in sorted(statuses.items()) if (r, m) == (route, method)},
+            })
+        return {
+            'pid': self.pid,
+            'uptime': round(time.time() - self.started, 3),
+            'requests': routes,
+            'transfers': {
+                direction: {
+                    'bytes': nbytes[direction],
+                    'active': active[direction],
+                    'completed': transfers[direction],
+                    'throughput_p50': throughput[direction][3][0],
+                    'throughput_p95': throughput[direction][3][1],
+                } for direction in ('in', 'out')
+            },
+            'listing': listing,
+            'caches': caches,
+            'uploads': uploads,
         }
-        .upload-status.success {
-            background: #e8f5e9;
-            color: #2e7d32;
-            display: block;
+
+    def render(self):
+        """Prometheus 文本格式（0.0.4）"""
+        latency, statuses, nbytes, active, transfers, throughput = self._collect()
+        caches, listing, uploads = self._components()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP quickshare_{name} {help_text}')
+            lines.append(f'# TYPE quickshare_{name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{_label_value(v)}"' for k, v in labels)
+                lines.append(f'quickshare_{name}{suffix}{{{label_text}}} {_number(value)}'
+                             if label_text else f'quickshare_{name}{suffix} {_number(value)}')
+
+        def histogram_samples(labels, data):
+            buckets, total, count, _ = data
+            samples = [('_bucket', (*labels, ('le', _number(bound))), n) for bound, n in buckets]
+            return samples + [('_sum', labels, total), ('_count', labels, count)]
+
+        metric('http_request_duration_seconds', 'histogram', '请求处理耗时（到响应头发出为止）',
+               [s for (route, method), data in sorted(latency.items())
+                for s in histogram_samples((('route', route), ('method', method)), data)])
+        metric('http_requests_total', 'counter', '请求数',
+               [('', (('route', r), ('method', m), ('status', s)), n) for (r, m, s), n in sorted(statuses.items())])
+        directions = ('in', 'out')
+        metric('transfer_bytes_total', 'counter', '上传 (in) 和下载 (out) 的字节数',
+               [('', (('direction', d),), nbytes[d]) for d in directions])
+        metric('transfers_active', 'gauge', '进行中的传输数',
+               [('', (('direction', d),), active[d]) for d in directions])
+        metric('transfers_total', 'counter', '已完成的传输数',
+               [('', (('direction', d),), transfers[d]) for d in directions])
+        metric('transfer_throughput_bytes_per_second', 'histogram', '单个传输的平均速度（1 MB 以上的传输）',
+               [s for d in directions for s in histogram_samples((('direction', d),), throughput[d])])
+        if listing is not None:
+            metric('listing_entries', 'gauge', '已加载目录中的文件数', [('', (), listing['entries'])])
+            metric('listing_directories', 'gauge', '已加载到目录树索引中的目录数', [('', (), listing['directories'])])
+            metric('listing_scans_total', 'counter', '目录全量扫描次数', [('', (), listing['scans'])])
+            metric('listing_scan_seconds_total', 'counter', '目录扫描累计耗时', [('', (), listing['scan_seconds'])])
+            metric('listing_requests_total', 'counter', '文件列表快照请求数，result 为 hit 表示复用了已生成的列表',
+                   [('', (('result', 'hit'),), listing['hits']), ('', (('result', 'miss'),), listing['misses'])])
+        metric('cache_requests_total', 'counter', '缓存查找次数',
+               [('', (('cache', name), ('result', result)), stats[key])
+                for name, stats in sorted(caches.items()) for result, key in (('hit', 'hits'), ('miss', 'misses'))])
+        metric('cache_bytes', 'gauge', '缓存占用的字节数',
+               [('', (('cache', name),), stats['bytes']) for name, stats in sorted(caches.items())])
+        if uploads is not None:
+            metric('uploads_active', 'gauge', '占用名额的上传数', [('', (), uploads['active'])])
+            metric('uploads_queued', 'gauge', '排队等待名额的上传数', [('', (), uploads['queued'])])
+            metric('uploads_rejected_total', 'counter', '因服务器繁忙被拒绝的上传数', [('', (), uploads['rejected'])])
+        metric('start_time_seconds', 'gauge', '进程启动时间', [('', (), self.started)])
+        return '\n'.join(lines) + '\n'
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def get_metrics():
+    """返回当前进程的指标（prefork 模式下每个工作进程各自统计）"""
+    global METRICS
+    if METRICS is None or METRICS.pid != os.getpid():
+        METRICS = Metrics()
+    return METRICS
+
+
+class UploadRejected(Exception):
+    """上传被拒绝：超过大小限制、磁盘空间不足或服务器繁忙"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    def headers(self):
+        return [('Retry-After', str(self.retry_after))] if self.retry_after else []
+
+
+class _UploadTicket:
+    __slots__ = ('client', 'grant', 'granted')
+
+    def __init__(self, client, grant):
+        self.client = client
+        self.grant = grant
+        self.granted = False
+
+
+class UploadSlot:
+    """UploadAdmission 分配的一个上传名额，退出 with 块时释放"""
+
+    def __init__(self, admission, reserved):
+        self.admission = admission
+        self.reserved = reserved
+        self.received = 0
+        self._check_at = reserved + SPACE_CHECK_BYTES
+        self._released = False
+
+    def count(self, nbytes):
+        """累计已接收的字节数，超过单次上传上限或磁盘空间不足时抛出 UploadRejected
+
+        没有声明大小（分块传输）或超出声明大小的部分没有预留空间，每收到
+        SPACE_CHECK_BYTES 字节重新检查一次磁盘剩余空间。
+        """
+        self.received += nbytes
+        limit = self.admission.max_bytes
+        if limit and self.received > limit:
+            raise UploadRejected(413, f'上传超过大小限制 ({format_size(limit)})')
+        if self.received >= self._check_at:
+            self._check_at = self.received + SPACE_CHECK_BYTES
+            self.admission.check_space(0)
+
+    def resize(self, size):
+        """把预留的空间改为 size 字节（增加时检查磁盘空间，不足时抛出 UploadRejected）"""
+        self.admission._resize(self, size)
+        self._check_at = max(self.received, size) + SPACE_CHECK_BYTES
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.admission._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class CountingReader:
+    """读取请求体时向 UploadSlot 累计字节数"""
+
+    def __init__(self, stream, slot):
+        self.stream = stream
+        self.slot = slot
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.slot.count(len(data))
+        return data
+
+
+class UploadAdmission:
+    """上传准入控制
+
+    在读取请求体之前检查 Content-Length 是否超过单次上限、磁盘剩余空间（扣除
+    正在进行的上传已声明的大小和保留空间）是否足够，并限制同时进行的上传
+    数量。名额已满时请求最多排队 wait 秒，各客户端轮流获得空出的名额，
+    等不到时返回 503 和 Retry-After，由客户端退避后重试。拿到名额时在同一次
+    加锁内再检查一次空间并预留声明的大小，并发的上传不会都通过检查。
+    """
+
+    def __init__(self, max_active=MAX_UPLOADS, max_bytes=0, reserve=MIN_FREE_SPACE,
+                 wait=ADMISSION_WAIT, max_queue=ADMISSION_QUEUE):
+        self.max_active = max_active
+        self.max_bytes = max_bytes
+        self.reserve = reserve
+        self.wait = wait
+        self.max_queue = max_queue
+        self.active = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # client -> deque[_UploadTicket]
+        self._queued = 0
+        self._reserved = 0
+        self._sessions = {}  # 分块上传会话 id -> 仍需预留的字节数
+
+    def _busy(self):
+        self.rejected += 1
+        return UploadRejected(503, '服务器繁忙，请稍后重试', max(1, round(self.wait)))
+
+    def preflight(self, size):
+        """检查声明的上传大小，不满足时抛出 UploadRejected"""
+        if size is not None and self.max_bytes and size > self.max_bytes:
+            raise UploadRejected(413, f'上传超过大小限制 ({format_size(self.max_bytes)})')
+        self.check_space(size)
+
+    def check_space(self, size):
+        """磁盘剩余空间扣除已预留的空间后放不下 size 字节时抛出 UploadRejected(507)"""
+        with self._lock:
+            self._check_space_locked(size)
+
+    def _check_space_locked(self, size):
+        try:
+            free = shutil.disk_usage(UPLOAD_DIR).free
+        except OSError:
+            return
+        if free < (size or 0) + self._reserved + self.reserve:
+            raise UploadRejected(507, f'磁盘空间不足（剩余 {format_size(free)}）')
+
+    def _enqueue(self, client, grant):
+        """立即获得名额时返回 None，否则返回排队的票据；队列已满时抛出 UploadRejected"""
+        with self._lock:
+            if not self.max_active or (self.active < self.max_active and not self._queued):
+                self.active += 1
+                return None
+            if self._queued >= self.max_queue:
+                raise self._busy()
+            ticket = _UploadTicket(client, grant)
+            self._queues.setdefault(client, deque()).append(ticket)
+            self._queued += 1
+            return ticket
+
+    def _cancel(self, ticket):
+        """等待超时：票据仍在排队时移除并抛出 UploadRejected，期间已经拿到名额则直接返回"""
+        with self._lock:
+            if ticket.granted:
+                return
+            queue = self._queues.get(ticket.client)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self._queued -= 1
+                if not queue:
+                    del self._queues[ticket.client]
+            raise self._busy()
+
+    def _grant_next_locked(self):
+        while self._queues and self.active < self.max_active:
+            client, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            self._queued -= 1
+            # 轮转：拿到名额的客户端排到最后
+            del self._queues[client]
+            if queue:
+                self._queues[client] = queue
+            ticket.granted = True
+            self.active += 1
+            ticket.grant()
+
+    def _reserve(self, size):
+        """拿到名额后再次检查空间并预留 size 字节，检查和预留在同一次加锁内完成"""
+        with self._lock:
+            try:
+                self._check_space_locked(size)
+            except UploadRejected:
+                self.active -= 1
+                self._grant_next_locked()
+                raise
+            self._reserved += size or 0
+        return UploadSlot(self, size or 0)
+
+    def _resize(self, slot, size):
+        with self._lock:
+            if size > slot.reserved:
+                self._check_space_locked(size - slot.reserved)
+            self._reserved += size - slot.reserved
+            slot.reserved = size
+
+    def _release(self, slot):
+        with self._lock:
+            self._reserved -= slot.reserved
+            self.active -= 1
+            self._grant_next_locked()
+
+    def reserve_session(self, session_id, size):
+        """为新建的分块上传会话预留 size 字节，直到 release_session；空间不足时抛出 UploadRejected"""
+        uploads = state_dir('uploads')
+        with self._lock:
+            # 其它进程完成的会话不会通知本进程，顺便清掉元数据已经不存在的会话
+            for stale in [sid for sid in self._sessions if not os.path.exists(os.path.join(uploads, sid + '.json'))]:
+                self._reserved -= self._sessions.pop(stale)
+            self._check_space_locked(size)
+            self._reserved += size - self._sessions.get(session_id, 0)
+            self._sessions[session_id] = size
+
+    def update_session(self, session_id, outstanding):
+        """会话的数据已经部分落盘：预留量改为还没有占用磁盘的 outstanding 字节"""
+        with self._lock:
+            self._reserved += outstanding - self._sessions.get(session_id, 0)
+            self._sessions[session_id] = outstanding
+
+    def release_session(self, session_id):
+        """会话完成、取消或过期"""
+        with self._lock:
+            self._reserved -= self._sessions.pop(session_id, 0)
+
+    def admit(self, client, size):
+        """检查并占用一个上传名额（同步版本），拒绝时抛出 UploadRejected"""
+        self.preflight(size)
+        granted = threading.Event()
+        ticket = self._enqueue(client, granted.set)
+        if ticket is not None and not granted.wait(self.wait):
+            self._cancel(ticket)
+        return self._reserve(size)
+
+    async def aadmit(self, client, size):
+        """admit 的 asyncio 版本"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.preflight, size)
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._enqueue(client, grant)
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.wait)
+            except asyncio.TimeoutError:
+                self._cancel(ticket)
+        return self._reserve(size)
+
+    def stats(self):
+        with self._lock:
+            return {'active': self.active, 'queued': self._queued, 'rejected': self.rejected}
+
+
+def get_upload_admission():
+    """返回上传准入控制器"""
+    global ADMISSION
+    if ADMISSION is None:
+        ADMISSION = UploadAdmission()
+    return ADMISSION
+
+
+@app.errorhandler(UploadRejected)
+def rejected_response(error):
+    """把 UploadRejected 转换成 JSON 错误响应"""
+    resp = jsonify({'error': error.message})
+    resp.status_code = error.status
+    resp.headers.extend(error.headers())
+    return resp
+
+
+class TokenBucket:
+    """令牌桶：按 rate 字节/秒补充，最多攒 burst 字节；允许透支，透支期间其他传输需要等待"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """令牌恢复为正还需要的秒数"""
+        return 0.0 if self.tokens > 0 else (-self.tokens + 1) / self.rate
+
+
+class _ClientState:
+    __slots__ = ('bucket', 'flows')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.flows = 0
+
+
+class _Waiter:
+    __slots__ = ('tag', 'seq', 'flow', 'nbytes', 'grant')
+
+    def __init__(self, tag, seq, flow, nbytes, grant):
+        self.tag = tag
+        self.seq = seq
+        self.flow = flow
+        self.nbytes = nbytes
+        self.grant = grant
+
+
+class TransferScheduler:
+    """上传/下载的带宽调度器
+
+    全局和每个客户端各有一个令牌桶。大文件传输按 SCHED_QUANTUM 分段向调度器
+    申请额度，等待中的请求按开始时间公平排队（SFQ）：每个客户端的权重平均
+    分给它的各个传输，开多条连接的下载工具不会因此占到更多带宽。小文件
+    （不超过 SCHED_SMALL）不排队，直接从令牌桶透支，因此页面和小文件总能
+    立即得到响应，由大文件传输让出带宽。
+
+    排队由一个调度线程统一处理，同步代码（线程池服务器）等待 Event，
+    asyncio 引擎等待 Future，二者共用同一个队列。
+    """
+
+    def __init__(self, rate=0, client_rate=0, burst_seconds=SCHED_BURST):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.burst_seconds = burst_seconds
+        self._cond = threading.Condition(threading.Lock())
+        self._global = TokenBucket(rate, self._burst(rate)) if rate else None
+        self._clients = {}  # client -> _ClientState
+        self._queue = []
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._thread = None
+
+    def _burst(self, rate):
+        return max(rate * self.burst_seconds, SCHED_QUANTUM)
+
+    def open(self, client, size=None):
+        """开始一个传输，size 为预计字节数（未知时为 None）"""
+        priority = size is not None and size <= SCHED_SMALL
+        with self._cond:
+            state = self._clients.get(client)
+            if state is None:
+                bucket = TokenBucket(self.client_rate, self._burst(self.client_rate)) if self.client_rate else None
+                state = self._clients[client] = _ClientState(bucket)
+            state.flows += 1
+        return Flow(self, client, priority)
+
+    def _close(self, flow):
+        with self._cond:
+            # 连接断开时可能还有没等到额度的请求
+            self._queue = [waiter for waiter in self._queue if waiter.flow is not flow]
+            state = self._clients.get(flow.client)
+            if state is not None:
+                state.flows -= 1
+                if state.flows <= 0 and (state.bucket is None or state.bucket.tokens >= 0):
+                    del self._clients[flow.client]
+
+    def _debit(self, client, nbytes):
+        now = time.monotonic()
+        with self._cond:
+            for bucket in (self._global, getattr(self._clients.get(client), 'bucket', None)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.tokens -= nbytes
+
+    def _enqueue(self, flow, nbytes, grant):
+        with self._cond:
+            # 客户端的权重平均分给它的各个传输
+            start = max(self._vtime, flow.finish)
+            flow.finish = start + nbytes * max(1, getattr(self._clients.get(flow.client), 'flows', 1))
+            waiter = _Waiter(start, next(self._seq), flow, nbytes, grant)
+            self._queue.append(waiter)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='quickshare-scheduler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return waiter
+
+    def _cancel(self, waiter):
+        """放弃一个还在排队的请求（asyncio 任务被取消）"""
+        with self._cond:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                if self._global is not None:
+                    self._global.refill(now)
+                best, timeout = None, None
+                for waiter in self._queue:
+                    bucket = getattr(self._clients.get(waiter.flow.client), 'bucket', None)
+                    if bucket is not None:
+                        bucket.refill(now)
+                        if bucket.tokens <= 0:
+                            delay = bucket.delay()
+                            timeout = delay if timeout is None else min(timeout, delay)
+                            continue
+                    if best is None or (waiter.tag, waiter.seq) < (best.tag, best.seq):
+                        best = waiter
+                if best is not None:
+                    if self._global is None or self._global.tokens > 0:
+                        self._queue.remove(best)
+                        self._vtime = best.tag
+                        if self._global is not None:
+                            self._global.tokens -= best.nbytes
+                        bucket = getattr(self._clients.get(best.flow.client), 'bucket', None)
+                        if bucket is not None:
+                            bucket.tokens -= best.nbytes
+                        best.grant()
+                        continue
+                    timeout = self._global.delay()
+                self._cond.wait(timeout)
+
+
+class Flow:
+    """调度器中的一个传输；没有启用限速时 throttle 直接返回"""
+
+    def __init__(self, scheduler, client, priority=False):
+        self.scheduler = scheduler
+        self.client = client
+        self.priority = priority
+        self.finish = 0.0
+        self.closed = False
+        # 由 open_flow 设置，用于统计传输指标
+        self.direction = None
+        self.started = 0.0
+        self.transferred = 0
+
+    @property
+    def limited(self):
+        """是否需要分段申请额度"""
+        return self.scheduler is not None and not self.priority
+
+    def throttle(self, nbytes):
+        """阻塞直到可以发送/接收 nbytes 字节"""
+        self.transferred += nbytes
+        if self.scheduler is None or not nbytes:
+            return
+        if self.priority:
+            self.scheduler._debit(self.client, nbytes)
+            return
+        granted = threading.Event()
+        self.scheduler._enqueue(self, nbytes, granted.set)
+        granted.wait()
+
+    async def athrottle(self, nbytes):
+        """throttle 的 asyncio 版本"""
+        import asyncio
+
+        self.transferred += nbytes
+        if self.scheduler is None or not nbytes:
+            return
+        if self.priority:
+            self.scheduler._debit(self.client, nbytes)
+            return
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self.scheduler._enqueue(self, nbytes, grant)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            self.scheduler._cancel(waiter)
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.scheduler is not None:
+                self.scheduler._close(self)
+            if self.direction is not None:
+                get_metrics().transfer_finished(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_flow(client, size=None, direction='out'):
+    """为来自 client 的传输创建 Flow（未启用限速时返回只统计字节数的 Flow）
+
+    direction 为 'in'（上传）或 'out'（下载）。
+    """
+    flow = Flow(None, client) if SCHEDULER is None else SCHEDULER.open(client, size)
+    flow.direction = direction
+    flow.started = time.monotonic()
+    get_metrics().transfer_started(flow)
+    return flow
+
+
+class ThrottledReader:
+    """按 Flow 分配的额度读取请求体的包装"""
+
+    def __init__(self, stream, flow):
+        self.stream = stream
+        self.flow = flow
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.flow.throttle(len(data))
+        return data
+
+
+def throttle_iter(iterable, flow):
+    """按 Flow 分配的额度逐块产生 iterable 的数据，结束时关闭 Flow"""
+    try:
+        for chunk in iterable:
+            flow.throttle(len(chunk))
+            yield chunk
+    finally:
+        flow.close()
+
+
+def sendfile_throttled(sock, f, offset, count, flow):
+    """socket.sendfile 的限速版本：启用限速时按 SCHED_QUANTUM 分段发送"""
+    if not flow.limited:
+        flow.throttle(sock.sendfile(f, offset, count))
+        return
+    while count > 0:
+        n = min(count, SCHED_QUANTUM)
+        flow.throttle(n)
+        sock.sendfile(f, offset, n)
+        offset += n
+        count -= n
+
+
+def parse_size(text):
+    """解析 20M、512K、1.5G 这样的字节数或速率（K/M/G/T 为 1024 进制，可带 /s），0 表示不限"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?(?:/s)?\s*', text, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f'无效的大小: {text}')
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' '))
+
+
+class RangeNotSatisfiable(Exception):
+    """Range 请求头中没有一个区间落在文件范围内"""
+
+
+def file_etag(st):
+    """由文件大小和修改时间生成强 ETag（多进程、多节点下保持一致）"""
+    return f'{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def content_disposition(name):
+    """生成附件下载用的 Content-Disposition，非 ASCII 文件名使用 RFC 5987 编码"""
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        simple = simple.replace('"', '') or 'download'
+        return f'attachment; filename="{simple}"; filename*=UTF-8\'\'{url_quote(name, safe="")}'
+    return 'attachment; filename="{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def resolve_ranges(header, size):
+    """解析 Range 请求头，返回合并后的 [(start, end)]（end 不含）
+
+    请求头无法解析或单位不是 bytes 时返回 None（按规范忽略 Range，返回完整文件）；
+    所有区间都越界时抛出 RangeNotSatisfiable。
+    """
+    parsed = parse_range_header(header)
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    ranges = []
+    for start, end in parsed.ranges:
+        if start < 0:
+            start, end = max(size + start, 0), size
+        else:
+            end = size if end is None else min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    # 重叠或相邻的区间合并发送，也避免被大量细碎区间放大请求
+    merged = merge_ranges(ranges)
+    if len(merged) > MAX_RANGES:
+        return None
+    return [tuple(r) for r in merged]
+
+
+def _if_range_matches(value, etag, mtime):
+    """If-Range 的值（ETag 或日期）仍与当前文件一致时返回 True"""
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith(('"', 'W/')):
+        return not value.startswith('W/') and unquote_etag(value)[0] == etag
+    date = parse_date(value)
+    return date is not None and int(mtime) == int(date.timestamp())
+
+
+def _not_modified(headers, etag, mtime):
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(etag)
+    date = parse_date(headers.get('If-Modified-Since'))
+    return date is not None and int(mtime) <= int(date.timestamp())
+
+
+class CachedFile:
+    """内存中的文件内容，以及预先算好的 ETag 和 gzip 压缩版本（压缩没有收益时为 None）"""
+
+    __slots__ = ('size', 'mtime_ns', 'etag', 'data', 'gzip')
+
+    def __init__(self, st, data, gzip_data):
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.etag = file_etag(st)
+        self.data = data
+        self.gzip = gzip_data
+
+    @property
+    def nbytes(self):
+        return len(self.data) + (len(self.gzip) if self.gzip is not None else 0)
+
+
+class HotFileCache:
+    """热点小文件的内存缓存
+
+    按字节预算的 LRU。同一个文件第二次被下载时才读入内存，避免一次性的
+    大批量下载把真正的热点文件挤出去；每次命中都用 stat 的大小和 mtime
+    校验，文件被修改后自动重新读取。适合很多设备同时下载同一份讲义的场景。
+    """
+
+    def __init__(self, max_bytes, max_file=HOT_FILE_MAX, ghost_size=4096):
+        self.max_bytes = max_bytes
+        self.max_file = min(max_file, max_bytes // 4)
+        self.ghost_size = ghost_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> CachedFile
+        self._seen = OrderedDict()  # 只访问过一次的文件
+        self._total = 0
+
+    def _remove_locked(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._total -= entry.nbytes
+
+    def get(self, path, st):
+        """返回与 st 一致的缓存内容，未缓存或不适合缓存时返回 None"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            # 被修改过的缓存文件直接重新读入，不必再等第二次访问
+            stale = entry is not None
+            self._remove_locked(path)
+            self.misses += 1
+            if st.st_size > self.max_file:
+                return None
+            if not stale and self._seen.pop(path, False) is False:
+                self._seen[path] = True
+                if len(self._seen) > self.ghost_size:
+                    self._seen.popitem(last=False)
+                return None
+        entry = self._load(path, st)
+        if entry is None:
+            return None
+        with self._lock:
+            self._remove_locked(path)
+            self._entries[path] = entry
+            self._total += entry.nbytes
+            while self._total > self.max_bytes:
+                self._remove_locked(next(iter(self._entries)))
+        return entry
+
+    @staticmethod
+    def _load(path, st):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(st.st_size + 1)
+                current = os.fstat(f.fileno())
+        except OSError:
+            return None
+        if len(data) != st.st_size or (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return None  # 读取期间文件被修改
+        gzip_data = None
+        if st.st_size >= 1024 and not _is_compressed(os.path.basename(path)):
+            gzip_data = gzip.compress(data, 6, mtime=0)
+            if len(gzip_data) > st.st_size * 0.9:
+                gzip_data = None
+        return CachedFile(st, data, gzip_data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total,
+                'capacity': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def _accepts_gzip(value):
+    return bool(value) and parse_accept_header(value).quality('gzip') > 0
+
+
+class DownloadPlan:
+    """一次文件下载响应：状态码、响应头，以及依次发送的片段
+
+    片段是 bytes（multipart 分隔头等）或 (offset, count) 形式的文件区间。
+    data 不为 None 时区间取自内存中的 data（热点缓存命中），而不是文件；
+    stream 不为 None 时响应体是长度未知的 bytes 迭代器（边压缩边发送）。
+    与具体服务器无关，WSGI 路由和其他传输引擎都可以据此发送响应。
+    """
+
+    def __init__(self, path, status, headers, segments=(), data=None, stream=None):
+        self.path = path
+        self.status = status
+        self.headers = headers
+        self.segments = list(segments)
+        self.data = data
+        self.stream = stream
+
+    @property
+    def length(self):
+        return sum(len(s) if isinstance(s, bytes) else s[1] for s in self.segments)
+
+    @classmethod
+    def build(cls, path, name, headers, cache=None, compress=False):
+        """根据请求头（支持 .get 的映射）生成下载响应，文件不存在时抛出 OSError
+
+        cache 为 HotFileCache 时优先从内存发送，客户端接受 gzip 且没有 Range
+        请求时发送预先压缩好的版本。compress 为真时按 Accept-Encoding 压缩
+        （已经是压缩格式的文件和 Range 请求除外），压缩结果缓存在磁盘上。
+        """
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        size = st.st_size
+        entry = cache.get(path, st) if cache is not None else None
+        etag = entry.etag if entry is not None else file_etag(st)
+        compress = compress and not _is_compressed(name)
+        compressed = encoding = variant = None
+        if not headers.get('Range'):
+            if entry is not None and entry.gzip is not None and _accepts_gzip(headers.get('Accept-Encoding')):
+                compressed = entry.gzip
+                etag += '.gz'
+            elif compress:
+                encoding = choose_encoding(headers.get('Accept-Encoding'))
+                if encoding is not None:
+                    variants = get_variant_cache()
+                    variant = variants.lookup(name, st, encoding)
+                    if variant is None and not variants.worthwhile(path):
+                        encoding = None
+                    else:
+                        etag += '.' + encoding
+        common = [
+            ('ETag', quote_etag(etag)),
+            ('Last-Modified', http_date(st.st_mtime)),
+            ('Accept-Ranges', 'bytes'),
+            ('Cache-Control', 'no-cache'),
+        ]
+        if (entry is not None and entry.gzip is not None) or compress:
+            common.append(('Vary', 'Accept-Encoding'))
+        if _not_modified(headers, etag, st.st_mtime):
+            return cls(path, 304, common)
+
+        common.append(('Content-Disposition', content_disposition(posixpath.basename(name))))
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if compressed is not None:
+            plan = cls(path, 200, common + [('Content-Type', content_type), ('Content-Encoding', 'gzip')],
+                       [(0, len(compressed))], data=compressed)
+            plan.headers.append(('Content-Length', str(plan.length)))
+            return plan
+        if encoding is not None:
+            common += [('Content-Type', content_type), ('Content-Encoding', encoding)]
+            if variant is None:
+                return cls(path, 200, common, stream=variants.compress(path, name, st, encoding))
+            plan = cls(variant, 200, common, [(0, os.path.getsize(variant))])
+            plan.headers.append(('Content-Length', str(plan.length)))
+            return plan
+        ranges = None
+        if headers.get('Range') and _if_range_matches(headers.get('If-Range'), etag, st.st_mtime):
+            try:
+                ranges = resolve_ranges(headers['Range'], size)
+            except RangeNotSatisfiable:
+                return cls(path, 416, common + [('Content-Range', f'bytes */{size}'),
+                                                ('Content-Length', '0')])
+
+        if ranges is None:
+            plan = cls(path, 200, common + [('Content-Type', content_type)], [(0, size)])
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            plan = cls(path, 206, common + [
+                ('Content-Type', content_type),
+                ('Content-Range', f'bytes {start}-{end - 1}/{size}'),
+            ], [(start, end - start)])
+        else:
+            boundary = secrets.token_hex(16)
+            segments = []
+            for start, end in ranges:
+                segments.append((
+                    f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                    f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'
+                ).encode('latin-1'))
+                segments.append((start, end - start))
+                segments.append(b'\r\n')
+            segments.append(f'--{boundary}--\r\n'.encode('latin-1'))
+            plan = cls(path, 206, common + [
+                ('Content-Type', f'multipart/byteranges; boundary={boundary}'),
+            ], segments)
+        if entry is not None:
+            plan.data = entry.data
+        plan.headers.append(('Content-Length', str(plan.length)))
+        return plan
+
+    def iter_memory(self):
+        """data 不为 None 时逐个产生要发送的 bytes"""
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            elif segment[0] == 0 and segment[1] == len(self.data):
+                yield self.data
+            elif segment[1]:
+                yield self.data[segment[0]:segment[0] + segment[1]]
+
+
+class FileBody:
+    """下载响应体
+
+    能拿到客户端套接字时（Werkzeug 开发服务器提供 werkzeug.socket），先让服务器
+    写出响应头，再用 socket.sendfile 直接从页缓存发送文件区间（支持时即
+    os.sendfile 零拷贝）；否则退回按 COPY_BUFFER 分块读取。发送速度由 flow 调度。
+    """
+
+    def __init__(self, plan, sock=None, flow=None):
+        self.plan = plan
+        self.sock = sock
+        self.flow = flow or Flow(None, None)
+
+    def __iter__(self):
+        try:
+            if self.plan.stream is not None:
+                yield from throttle_iter(self.plan.stream, self.flow)
+            elif self.plan.data is not None:
+                yield from throttle_iter(self.plan.iter_memory(), self.flow)
+            elif self.plan.segments:
+                yield from self._iter_file()
+        finally:
+            self.flow.close()
+
+    def close(self):
+        # 服务器没有迭代响应体就关闭时也要结束 Flow
+        self.flow.close()
+
+    def _iter_file(self):
+        with open(self.plan.path, 'rb') as f:
+            if self.sock is not None:
+                yield b''  # 触发服务器发送响应头
+                for segment in self.plan.segments:
+                    if isinstance(segment, bytes):
+                        self.sock.sendall(segment)
+                    elif segment[1]:
+                        sendfile_throttled(self.sock, f, segment[0], segment[1], self.flow)
+                return
+            for segment in self.plan.segments:
+                if isinstance(segment, bytes):
+                    yield segment
+                    continue
+                offset, remaining = segment
+                f.seek(offset)
+                while remaining > 0:
+                    buf = f.read(min(COPY_BUFFER, remaining))
+                    if not buf:
+                        return
+                    remaining -= len(buf)
+                    self.flow.throttle(len(buf))
+                    yield buf
+
+
+class _FlowFile:
+    """交给其他服务器的 file_wrapper 的文件：关闭时按读到的位置把实际发送的字节数记入 Flow"""
+
+    def __init__(self, f, flow):
+        self._file = f
+        self._flow = flow
+        self._start = f.tell()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        if not self._file.closed:
+            try:
+                # socket.sendfile 发送完成后也会把文件位置移到发送结束处
+                self._flow.throttle(max(0, self._file.tell() - self._start))
+            except (OSError, ValueError):
+                pass
+            self._file.close()
+        self._flow.close()
+
+
+def download_response(plan, environ, flow=None):
+    """把 DownloadPlan 转换成 WSGI 响应，优先使用服务器提供的零拷贝发送方式"""
+    flow = flow or Flow(None, None)
+    body = ()
+    if (plan.segments or plan.stream is not None) and environ.get('REQUEST_METHOD') != 'HEAD':
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is SendfileWrapper and len(plan.segments) == 1 and plan.data is None:
+            # 我们自己的服务器按 Content-Length 发送，可以先 seek 到区间起点
+            f = open(plan.path, 'rb')
+            f.seek(plan.segments[0][0])
+            body = file_wrapper(f, COPY_BUFFER)
+            body.flow = flow
+        elif file_wrapper is not None and plan.status == 200 and len(plan.segments) == 1 \
+                and plan.data is None and not flow.limited:
+            # 其他服务器的 file_wrapper（如 wsgiref）可能一直读到文件末尾，也无法限速，
+            # 所以只用于不限速的完整文件
+            body = file_wrapper(_FlowFile(open(plan.path, 'rb'), flow), COPY_BUFFER)
+        else:
+            body = FileBody(plan, environ.get('werkzeug.socket'), flow)
+    else:
+        flow.close()
+    return Response(body, status=plan.status, headers=plan.headers, direct_passthrough=True)
+
+
+def render_thumbnail(source, dest, size):
+    """在工作进程中生成 JPEG 缩略图（长边不超过 size），返回缩略图字节数"""
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as img:
+        # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，大照片省掉大部分解码时间
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        tmp = f'{dest}.{secrets.token_hex(8)}.tmp'
+        try:
+            img.save(tmp, 'JPEG', quality=80, optimize=True)
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    return os.path.getsize(dest)
+
+
+class DiskLRU:
+    """.quickshare 下的派生文件缓存目录（缩略图、压缩版本等）
+
+    每个 key 对应目录中的一个文件，总大小超过 max_bytes 时按最近使用时间淘汰。
+    最近使用时间同时记在文件 mtime 上，重启后仍能按 LRU 顺序淘汰。
+    """
+
+    def __init__(self, directory, max_bytes, suffix):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> 字节数，按最近使用排序
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        existing = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.endswith(suffix):
+                        st = entry.stat()
+                        existing.append((st.st_mtime, entry.name[:-len(suffix)], st.st_size))
+        except OSError:
+            pass
+        for _, key, nbytes in sorted(existing):
+            self._entries[key] = nbytes
+            self._total += nbytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def tmp_path(self, key):
+        """写入 key 时使用的临时文件，写完后 os.replace 到 path(key) 再调用 add"""
+        os.makedirs(self.directory, exist_ok=True)
+        return f'{self.path(key)}.{secrets.token_hex(8)}.tmp'
+
+    def get(self, key):
+        """返回 key 对应的文件路径并标记为最近使用，不存在时返回 None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            # 已被其它进程淘汰
+            with self._lock:
+                self._total -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def add(self, key):
+        """登记刚写好的文件，必要时淘汰最久未用的文件"""
+        try:
+            nbytes = os.path.getsize(self.path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._total += nbytes - self._entries.pop(key, 0)
+            self._entries[key] = nbytes
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old, old_bytes = self._entries.popitem(last=False)
+                self._total -= old_bytes
+                try:
+                    os.remove(self.path(old))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._total, 'capacity': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class ThumbnailCache:
+    """图片缩略图缓存
+
+    缩略图由进程池生成（解码大图是 CPU 密集型操作，不占用请求线程的 GIL），
+    保存在 .quickshare/thumbs，文件名由原图的名称、大小和 mtime 决定，原图
+    变化后自然失效。缓存总大小超过 max_bytes 时按最近使用时间淘汰。
+    """
+
+    def __init__(self, path, max_bytes, size=THUMB_SIZE, workers=THUMB_WORKERS):
+        self.path = path
+        self.size = size
+        self.workers = workers
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._executor = None
+        self._pending = {}  # key -> Future
+        self._failed = set()
+        self._lru = DiskLRU(os.path.join(path, STATE_DIR_NAME, 'thumbs'), max_bytes, '.jpg')
+
+    @staticmethod
+    def supports(name):
+        return os.path.splitext(name)[1].lower() in THUMB_EXTENSIONS
+
+    def _key(self, name, st):
+        raw = f'{name}\0{st.st_size}\0{st.st_mtime_ns}\0{self.size}'.encode('utf-8', 'surrogateescape')
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def _submit_locked(self, key, source):
+        future = self._pending.get(key)
+        if future is None:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn 而不是 fork：当前进程里有很多线程，fork 出的子进程可能继承被锁住的锁
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            os.makedirs(self._lru.directory, exist_ok=True)
+            future = self._executor.submit(render_thumbnail, source, self._lru.path(key), self.size)
+            future.add_done_callback(lambda f: self._finished(key, f))
+            self._pending[key] = future
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            try:
+                future.result()
+            except BrokenExecutor:
+                # 某张图片让工作进程崩溃了，下次请求时重建进程池
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                self._failed.add(key)
+                return
+            except Exception:
+                self._failed.add(key)
+                return
+        self._lru.add(key)
+
+    def _lookup(self, name):
+        """返回 (key, 原图路径)，不是支持的图片时返回 None"""
+        if not self.supports(name):
+            return None
+        source = os.path.join(self.path, name)
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return self._key(name, st), source
+
+    def schedule(self, name):
+        """在后台为 name 生成缩略图（上传完成后调用）"""
+        found = self._lookup(name)
+        if found is None:
+            return
+        key, source = found
+        with self._lock:
+            if key not in self._lru and key not in self._failed:
+                self._submit_locked(key, source)
+
+    def get(self, name, timeout=THUMB_TIMEOUT):
+        """返回 (缩略图路径, key)；不是图片、无法解码或超时时返回 (None, None)"""
+        found = self._lookup(name)
+        if found is None:
+            return None, None
+        key, source = found
+        with self._lock:
+            if key in self._failed:
+                return None, None
+            path = self._lru.get(key)
+            if path is not None:
+                return path, key
+            future = self._submit_locked(key, source)
+        try:
+            future.result(timeout)
+        except Exception:
+            return None, None
+        return self._lru.path(key), key
+
+    def stats(self):
+        return self._lru.stats()
+
+
+def get_thumbnail_cache():
+    """返回当前共享目录的缩略图缓存（每个进程一份）"""
+    global THUMB_CACHE
+    if THUMB_CACHE is None or THUMB_CACHE.path != UPLOAD_DIR or THUMB_CACHE.pid != os.getpid():
+        THUMB_CACHE = ThumbnailCache(UPLOAD_DIR, THUMB_CACHE_MB * 1024 * 1024)
+    return THUMB_CACHE
+
+
+class _BrotliCompressor:
+    """让 brotli.Compressor 与 zlib 压缩对象的 compress/flush 接口一致"""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 31)}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+if brotli is not None:
+    COMPRESSORS['br'] = _BrotliCompressor
+ENCODING_PREFERENCE = ('zstd', 'br', 'gzip')
+
+
+def choose_encoding(accept_encoding):
+    """按 Accept-Encoding 选出可用的压缩格式，客户端不接受任何压缩时返回 None"""
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best = None
+    for encoding in ENCODING_PREFERENCE:
+        quality = accepted.quality(encoding)
+        if encoding in COMPRESSORS and quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def compress_bytes(data, encoding):
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressedVariants:
+    """下载文件压缩版本的磁盘缓存（?compress=1）
+
+    第一次请求时边压缩边发送，同时写入 .quickshare/compressed；完整写完后
+    登记到缓存，之后的请求直接用 sendfile 发送压缩好的文件。
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.pid = os.getpid()
+        self._lru = DiskLRU(os.path.join(path, STATE_DIR_NAME, 'compressed'), max_bytes, '.bin')
+
+    @staticmethod
+    def _key(name, st, encoding):
+        raw = f'{name}\0{st.st_size}\0{st.st_mtime_ns}\0{encoding}'.encode('utf-8', 'surrogateescape')
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    @staticmethod
+    def worthwhile(path, sample=COMPRESS_SAMPLE):
+        """用文件开头的一段试压缩，压缩率太低（随机数据、未知的压缩格式）时不压缩"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(sample)
+        except OSError:
+            return False
+        return len(data) >= COMPRESS_MIN_SIZE and len(zlib.compress(data, 1)) < len(data) * 0.9
+
+    def lookup(self, name, st, encoding):
+        """返回已缓存的压缩文件路径，没有时返回 None"""
+        return self._lru.get(self._key(name, st, encoding))
+
+    def stats(self):
+        return self._lru.stats()
+
+    def compress(self, source, name, st, encoding):
+        """逐块产生 source 的压缩数据，完整产生后写入缓存"""
+        key = self._key(name, st, encoding)
+        tmp = self._lru.tmp_path(key)
+        compressor = COMPRESSORS[encoding]()
+        complete = False
+        try:
+            with open(source, 'rb') as src, open(tmp, 'wb') as out:
+                while True:
+                    buf = src.read(COPY_BUFFER)
+                    if not buf:
+                        break
+                    data = compressor.compress(buf)
+                    if data:
+                        out.write(data)
+                        yield data
+                data = compressor.flush()
+                out.write(data)
+                yield data
+                current = os.fstat(src.fileno())
+            # 压缩期间原文件被修改过时不缓存
+            if (current.st_size, current.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                os.replace(tmp, self._lru.path(key))
+                self._lru.add(key)
+                complete = True
+        finally:
+            if not complete:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+
+def get_variant_cache():
+    """返回当前共享目录的压缩版本缓存（每个进程一份）"""
+    global VARIANT_CACHE
+    if VARIANT_CACHE is None or VARIANT_CACHE.path != UPLOAD_DIR or VARIANT_CACHE.pid != os.getpid():
+        VARIANT_CACHE = CompressedVariants(UPLOAD_DIR, COMPRESS_CACHE_MB * 1024 * 1024)
+    return VARIANT_CACHE
+
+
+def delta_block_size(size):
+    """差量同步的默认块大小：约为文件大小的平方根，取 2 的幂并限制在 DELTA_MIN_BLOCK ~ DELTA_MAX_BLOCK"""
+    block = DELTA_MIN_BLOCK
+    while block < DELTA_MAX_BLOCK and block * block < size:
+        block *= 2
+    return block
+
+
+def _strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class SignatureBuilder:
+    """按 block_size 切块计算差量同步的块签名
+
+    弱校验和为 Adler-32（客户端可以逐字节滚动计算），强校验为 128 位 BLAKE2b。
+    数据可以分多次 update，最后一块可能不足 block_size。
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.size = 0
+        self.weak = []
+        self.strong = []
+        self._pending = bytearray()
+
+    def _add(self, block):
+        self.weak.append(zlib.adler32(block))
+        self.strong.append(_strong_hash(block))
+
+    def update(self, data):
+        self.size += len(data)
+        view = memoryview(data)
+        if self._pending:
+            need = self.block_size - len(self._pending)
+            self._pending += view[:need]
+            view = view[need:]
+            if len(self._pending) < self.block_size:
+                return
+            self._add(self._pending)
+            self._pending = bytearray()
+        end = len(view) - len(view) % self.block_size
+        for start in range(0, end, self.block_size):
+            self._add(view[start:start + self.block_size])
+        self._pending += view[end:]
+
+    def result(self):
+        if self._pending:
+            self._add(self._pending)
+            self._pending = bytearray()
+        return {'block_size': self.block_size, 'weak': self.weak, 'strong': self.strong}
+
+
+class SignatureCache:
+    """差量同步块签名的磁盘缓存（.quickshare/signatures）
+
+    计算一个大文件的签名要完整读一遍文件，所以按文件的名称、大小、mtime 和
+    块大小缓存，文件变化后自然失效。差量上传重建文件时顺便算好新版本的签名。
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.pid = os.getpid()
+        self._lru = DiskLRU(os.path.join(path, STATE_DIR_NAME, 'signatures'), max_bytes, '.json')
+
+    @staticmethod
+    def _key(name, st, block_size):
+        raw = f'{name}\0{st.st_size}\0{st.st_mtime_ns}\0{block_size}'.encode('utf-8', 'surrogateescape')
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def get(self, name, path, block_size):
+        """返回 (签名, 计算签名时文件的 stat)"""
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            cached = self._lru.get(self._key(name, st, block_size))
+            if cached is not None:
+                try:
+                    with open(cached, 'rb') as c:
+                        return json.load(c), st
+                except (OSError, ValueError):
+                    pass
+            builder = SignatureBuilder(block_size)
+            while True:
+                buf = f.read(COPY_BUFFER)
+                if not buf:
+                    break
+                builder.update(buf)
+            current = os.fstat(f.fileno())
+        signature = builder.result()
+        # 计算期间文件被修改时不缓存；返回的 etag 也随之过期，客户端上传时会得到 412
+        if (current.st_size, current.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            self.put(name, st, signature)
+        return signature, st
+
+    def put(self, name, st, signature):
+        key = self._key(name, st, signature['block_size'])
+        tmp = self._lru.tmp_path(key)
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(signature, f, separators=(',', ':'))
+            os.replace(tmp, self._lru.path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._lru.add(key)
+
+    def stats(self):
+        return self._lru.stats()
+
+
+def get_signature_cache():
+    """返回当前共享目录的块签名缓存（每个进程一份）"""
+    global SIGNATURE_CACHE
+    if SIGNATURE_CACHE is None or SIGNATURE_CACHE.path != UPLOAD_DIR or SIGNATURE_CACHE.pid != os.getpid():
+        SIGNATURE_CACHE = SignatureCache(UPLOAD_DIR, SIGNATURE_CACHE_MB * 1024 * 1024)
+    return SIGNATURE_CACHE
+
+
+def _read_exact(stream, n):
+    """从 stream 读取恰好 n 字节，请求体提前结束时抛出 ValueError"""
+    parts = []
+    while n:
+        buf = stream.read(min(n, COPY_BUFFER))
+        if not buf:
+            raise ValueError('请求体不完整')
+        parts.append(buf)
+        n -= len(buf)
+    return b''.join(parts)
+
+
+def apply_delta(stream, base, base_size, write):
+    """服务器端：按差量指令流重建新版本，依次交给 write；返回 (复用的字节数, 新数据字节数, 声明的 sha256)
+
+    base 为旧版本的文件对象。指令流以 DELTA_MAGIC 和块大小 (u32) 开头，之后是：
+      b'C' + 起始块号 (u64) + 块数 (u32)：复制旧版本中连续的块
+      b'L' + 长度 (u32) + 数据：新数据
+      b'E' + 新版本的 sha256 (32 字节)：结束
+    """
+    header = _read_exact(stream, len(DELTA_MAGIC) + 4)
+    if header[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise ValueError('不是差量数据')
+    block_size, = struct.unpack('>I', header[len(DELTA_MAGIC):])
+    if block_size <= 0:
+        raise ValueError('无效的块大小')
+    copied = literal = 0
+    while True:
+        op = _read_exact(stream, 1)
+        if op == b'C':
+            start, count = struct.unpack('>QI', _read_exact(stream, 12))
+            offset = start * block_size
+            end = min((start + count) * block_size, base_size)
+            if count == 0 or offset >= base_size:
+                raise ValueError('块号超出原文件范围')
+            base.seek(offset)
+            while offset < end:
+                buf = base.read(min(COPY_BUFFER, end - offset))
+                if not buf:
+                    raise ValueError('原文件已被修改')
+                write(buf)
+                offset += len(buf)
+                copied += len(buf)
+        elif op == b'L':
+            length, = struct.unpack('>I', _read_exact(stream, 4))
+            while length:
+                buf = stream.read(min(COPY_BUFFER, length))
+                if not buf:
+                    raise ValueError('请求体不完整')
+                write(buf)
+                length -= len(buf)
+                literal += len(buf)
+        elif op == b'E':
+            return copied, literal, _read_exact(stream, 32).hex()
+        else:
+            raise ValueError('无效的差量指令')
+
+
+def delta_plan(f, signature, max_literal=None):
+    """客户端：对照服务器的块签名扫描新版本 f，找出可以复用的块（与 rsync 相同的滚动校验和）
+
+    返回 (指令列表, 新版本的 sha256, 新数据字节数)。指令为 ('C', 起始块号, 块数) 或
+    ('L', 文件偏移, 长度)。新数据超过 max_literal 字节时返回 None，此时完整上传更划算。
+    """
+    block = signature['block_size']
+    weak, strong = signature['weak'], signature['strong']
+    last = len(weak) - 1
+    last_len = signature['size'] - last * block if weak else 0
+    index = {}
+    for i, w in enumerate(weak):
+        if i < last or last_len == block:
+            index.setdefault(w, []).append(i)
+    digest = hashlib.sha256()
+    ops = []
+    literal = 0
+
+    def lookup(window, w):
+        # 内容相同的块有多个时优先选紧接着上一个复制块的那个，复制指令可以合并
+        candidates = index.get(w, ())
+        digest = _strong_hash(window)
+        after = ops[-1][1] + ops[-1][2] if ops and ops[-1][0] == 'C' else 0
+        if after in candidates and strong[after] == digest:
+            return after
+        for i in candidates:
+            if strong[i] == digest:
+                return i
+        return None
+
+    def add_copy(i):
+        if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == i:
+            ops[-1] = ('C', ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(('C', i, 1))
+
+    def add_literal(start, end):
+        nonlocal literal
+        if end <= start:
+            return
+        literal += end - start
+        if ops and ops[-1][0] == 'L' and ops[-1][1] + ops[-1][2] == start:
+            ops[-1] = ('L', ops[-1][1], ops[-1][2] + end - start)
+        else:
+            ops.append(('L', start, end - start))
+
+    buf = b''
+    buf_offset = 0  # buf[0] 在文件中的偏移
+    pos = 0
+    pending = 0  # 尚未登记的新数据从文件的这个偏移开始
+    eof = False
+    while True:
+        if len(buf) - pos <= block and not eof:
+            chunk = f.read(max(COPY_BUFFER, block * 4))
+            if chunk:
+                digest.update(chunk)
+                buf_offset += pos
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                eof = True
+            continue
+        remaining = len(buf) - pos
+        if remaining < block:
+            # 文件末尾不足一块：只可能与旧版本的最后一块相同
+            if remaining and remaining == last_len and strong[last] == _strong_hash(buf[pos:]):
+                add_literal(pending, buf_offset + pos)
+                add_copy(last)
+            else:
+                add_literal(pending, buf_offset + len(buf))
+            break
+        w = zlib.adler32(buf[pos:pos + block])
+        found = lookup(buf[pos:pos + block], w) if w in index else None
+        if found is None:
+            # 逐字节滚动，直到找到匹配的块或用完已读入的数据
+            a, b = w & 0xffff, w >> 16
+            p, limit = pos, len(buf) - block
+            while p < limit:
+                out, new = buf[p], buf[p + block]
+                a = (a - out + new) % 65521
+                b = (b - block * out + a - 1) % 65521
+                p += 1
+                w = (b << 16) | a
+                if w in index:
+                    found = lookup(buf[p:p + block], w)
+                    if found is not None:
+                        break
+            pos = p
+            if max_literal is not None and literal + buf_offset + pos - pending > max_literal:
+                return None
+            if found is None:
+                if eof:
+                    # 最后一个窗口也没有匹配，剩下的都是新数据
+                    add_literal(pending, buf_offset + len(buf))
+                    break
+                continue
+        add_literal(pending, buf_offset + pos)
+        add_copy(found)
+        pos += block
+        pending = buf_offset + pos
+    if max_literal is not None and literal > max_literal:
+        return None
+    return ops, digest.hexdigest(), literal
+
+
+def delta_length(ops):
+    """iter_delta 产生的请求体长度"""
+    length = len(DELTA_MAGIC) + 4 + 33
+    for op, _, n in ops:
+        length += 13 if op == 'C' else n + 5 * -(-n // COPY_BUFFER)
+    return length
+
+
+def iter_delta(f, block_size, ops, digest):
+    """客户端：按 delta_plan 的结果逐块产生差量请求体（新数据从 f 中按偏移读取）"""
+    yield DELTA_MAGIC + struct.pack('>I', block_size)
+    for op, start, n in ops:
+        if op == 'C':
+            yield b'C' + struct.pack('>QI', start, n)
+            continue
+        f.seek(start)
+        while n:
+            data = f.read(min(COPY_BUFFER, n))
+            if not data:
+                raise ValueError('文件在扫描之后被修改')
+            yield b'L' + struct.pack('>I', len(data)) + data
+            n -= len(data)
+    yield b'E' + bytes.fromhex(digest)
+
+
+class MergedListing:
+    """集群模式下一个目录的合并列表，提供与 DirectoryCache 相同的只读接口
+
+    本机的文件原样保留；只在其它节点上的文件带 nodes 字段（持有该文件的节点地址）。
+    version 沿用本机目录的版本号，/api/events 的增量照常可用；epoch 和 ETag 另外带上
+    集群视图的版本，其它节点的文件变化后客户端缓存随之失效。
+    """
+
+    def __init__(self, local, remote, remote_dirs, cluster_version):
+        if local is not None:
+            files, etag, self.version = local.snapshot()
+            dirs = local.dirs()
+            self.epoch = f'{local.epoch}-{cluster_version}'
+        else:
+            files, etag, self.version, dirs = [], 'remote', 0, []
+            self.epoch = f'remote-{cluster_version}'
+        self._etag = f'{etag}-{cluster_version}'
+        self._items = {item['name']: item for item in files}
+        for name, (size, mtime, _, nodes) in remote.items():
+            if name not in self._items:
+                self._items[name] = {'name': name, 'size': format_size(size), 'bytes': size, 'mtime': mtime,
+                                     'nodes': nodes}
+        merged = {item['name']: item['mtime'] for item in dirs}
+        for name, mtime in remote_dirs.items():
+            merged.setdefault(name, mtime)
+        self._dirs = [{'name': name, 'mtime': mtime} for name, mtime in sorted(merged.items())]
+        self._listing = [self._items[name] for name in sorted(self._items)]
+        self._lock = threading.Lock()
+        self._index = {}
+
+    def refresh(self, force=False):
+        pass
+
+    def snapshot(self):
+        return self._listing, self._etag, self.version
+
+    def files(self):
+        return self._listing
+
+    def dirs(self):
+        return self._dirs
+
+    def page(self, sort='name', reverse=False, cursor=None, limit=100, prefix='', query=''):
+        with self._lock:
+            keys = self._index.get(sort)
+            if keys is None:
+                keys = self._index[sort] = sorted(
+                    _sort_key(sort, name, (item['bytes'], item['mtime'])) for name, item in self._items.items())
+        return page_keys(keys, self._items.__getitem__, sort, reverse, cursor, limit, prefix, query)
+
+
+class _Peer:
+    """集群中的另一个节点"""
+
+    __slots__ = ('addr', 'load', 'seen', 'sent', 'catalog', 'fetched', 'files', 'redirects')
+
+    def __init__(self, addr):
+        self.addr = addr  # (host, HTTP 端口)
+        self.load = 0  # 通告中的进行中下载数
+        self.seen = 0.0
+        self.sent = 0.0  # 最近一条通告中的发送时间，用于丢弃重放的通告
+        self.catalog = None  # 通告中的文件清单版本
+        self.fetched = None  # 已拉取的文件清单版本
+        self.files = {}  # 相对路径 -> (size, mtime, sha256 或 None)
+        self.redirects = 0  # 上次通告以来本机重定向过去的下载数
+
+    @property
+    def url(self):
+        return f'{self.addr[0]}:{self.addr[1]}'
+
+
+def _same_content(a, b):
+    """两条 (size, mtime, sha256) 记录是否为同一内容：都有 sha256 时比较 sha256，否则比较 mtime"""
+    if a[0] != b[0]:
+        return False
+    if a[2] and b[2]:
+        return a[2] == b[2]
+    return a[1] == b[1]
+
+
+class Cluster:
+    """局域网内多个 QuickShare 节点组成的集群
+
+    每个节点每隔 interval 秒向 UDP 端口 port 广播一条通告（集群名、节点 ID、HTTP 端口、
+    文件清单版本和进行中的下载数），CLUSTER_PEER_TTL 秒内没有通告的节点视为已离开。
+    通告中的清单版本变化时，后台线程从该节点的 /api/cluster/catalog 拉取完整的文件清单。
+    设置了 --auth 时通告带 HMAC 签名和发送时间，各节点须使用相同的密码，过期或重放的
+    通告被丢弃；未设置时只信任 UDP 包的源地址，忽略通告中的 host。
+
+    文件列表合并其它节点上的文件；下载时在本机和持有相同内容的节点中选进行中下载数
+    最少的一个，不是本机时重定向过去。启用 replicate 后，多次被请求、只在其它节点上的
+    文件在后台复制到本机。
+    """
+
+    def __init__(self, name, http_port, host=None, port=CLUSTER_PORT, broadcast='<broadcast>',
+                 replicate=False, interval=CLUSTER_INTERVAL):
+        self.name = name
+        self.http_port = http_port
+        self.host = host
+        self.port = port
+        self.broadcast = broadcast
+        self.replicate = replicate
+        self.interval = interval
+        self.node = secrets.token_hex(6)
+        self.version = 0  # 其它节点的文件清单或成员变化时递增
+        self.replicated = 0
+        self._lock = threading.Lock()
+        self._peers = {}  # 节点 ID -> _Peer
+        self._view = None  # (目录 -> {文件名: [size, mtime, sha256, 节点地址列表]}, 目录 -> {子目录名: mtime})
+        self._listings = OrderedDict()  # (目录, 本机 epoch, 本机版本) -> (集群版本, MergedListing)
+        self._hits = {}  # 只在其它节点上的文件 -> 被请求次数
+        self._queue = deque()  # 等待复制到本机的文件
+        self._wake = threading.Event()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # 同一台机器上的多个节点共用广播端口
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._sock.bind(('', port))
+        self._threads = []
+
+    def _sign(self, body):
+        return hmac.new(AUTH_TOKEN.encode(), body.encode(), hashlib.sha256).hexdigest() if AUTH_TOKEN else ''
+
+    def _announce(self, bye=False):
+        info = {'cluster': self.name, 'node': self.node, 'port': self.http_port,
+                'version': get_search_index().version, 'load': self.local_load(), 'time': time.time()}
+        if self.host:
+            info['host'] = self.host
+        if bye:
+            info['bye'] = True
+        body = json.dumps(info, ensure_ascii=False)
+        try:
+            self._sock.sendto(json.dumps({'body': body, 'mac': self._sign(body)}).encode(),
+                              (self.broadcast, self.port))
+        except OSError:
+            pass
+
+    def _changed_locked(self):
+        self.version += 1
+        self._view = None
+        self._listings.clear()
+
+    def _receive(self, data, addr):
+        try:
+            packet = json.loads(data)
+            body = packet['body']
+            info = json.loads(body)
+            if info['cluster'] != self.name or info['node'] == self.node:
+                return
+            if AUTH_TOKEN is not None and not hmac.compare_digest(str(packet.get('mac')), self._sign(body)):
+                return
+            node = str(info['node'])
+            # 未签名的通告谁都能伪造，只有签名过的 host 才可以与源地址不同
+            host = str(info.get('host') or addr[0])
+            if AUTH_TOKEN is None and host != addr[0]:
+                host = addr[0]
+            peer_addr = (host, int(info['port']))
+            catalog, load, sent = int(info['version']), int(info['load']), float(info['time'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        if abs(time.time() - sent) > CLUSTER_PEER_TTL:
+            return
+        with self._lock:
+            peer = self._peers.get(node)
+            if peer is not None and sent <= peer.sent:
+                return
+            if info.get('bye'):
+                if self._peers.pop(node, None) is not None:
+                    self._changed_locked()
+                return
+            if peer is None:
+                peer = self._peers[node] = _Peer(peer_addr)
+            peer.addr = peer_addr
+            peer.sent = sent
+            peer.load = load
+            peer.redirects = 0
+            peer.seen = time.monotonic()
+            peer.catalog = catalog
+            if peer.fetched != catalog:
+                self._wake.set()
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            gone = [node for node, peer in self._peers.items() if now - peer.seen > CLUSTER_PEER_TTL]
+            for node in gone:
+                del self._peers[node]
+            if gone:
+                self._changed_locked()
+
+    def _run(self):
+        announce_at = 0.0
+        while not SHUTDOWN.is_set():
+            now = time.monotonic()
+            if now >= announce_at:
+                self._announce()
+                self._expire()
+                announce_at = now + self.interval
+            try:
+                self._sock.settimeout(max(0.05, announce_at - now))
+                data, addr = self._sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._sock.fileno() < 0:
+                    return
+                time.sleep(self.interval)
+                continue
+            self._receive(data, addr)
+
+    def _request(self, addr, target, timeout=10):
+        """向节点 addr 发起 GET 请求，返回 (连接, 响应)，调用方负责关闭连接"""
+        import http.client
+
+        conn = http.client.HTTPConnection(*addr, timeout=timeout)
+        try:
+            conn.request('GET', target)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    @staticmethod
+    def _query(**params):
+        if AUTH_TOKEN:
+            params['token'] = AUTH_TOKEN
+        return urlencode(params)
+
+    def _fetch_catalog(self, node, addr):
+        import http.client
+
+        try:
+            conn, resp = self._request(addr, '/api/cluster/catalog?' + self._query())
+            try:
+                if resp.status != 200:
+                    return
+                data = json.loads(resp.read())
+            finally:
+                conn.close()
+            if data['node'] != node:
+                return
+            files = {rel: (size, mtime, digest) for rel, size, mtime, digest in data['files']
+                     if rel and safe_path(rel) == rel}
+            version = int(data['version'])
+        except (OSError, http.client.HTTPException, ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            peer = self._peers.get(node)
+            if peer is not None:
+                peer.files = files
+                peer.fetched = version
+                self._changed_locked()
+
+    def _sync(self):
+        while not SHUTDOWN.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                stale = [(node, peer.addr) for node, peer in self._peers.items() if peer.fetched != peer.catalog]
+            for node, addr in stale:
+                self._fetch_catalog(node, addr)
+            while self._queue and not SHUTDOWN.is_set():
+                rel = self._queue.popleft()
+                try:
+                    self._replicate(rel)
+                finally:
+                    with self._lock:
+                        self._hits.pop(rel, None)
+
+    def _replicate(self, rel):
+        """从负载最低的持有节点把 rel 复制到本机，保留 mtime，校验大小和 sha256"""
+        import http.client
+
+        if resolve_file(rel) is not None or not check_parent(rel):
+            return
+        with self._lock:
+            holders = [(peer.load + peer.redirects, peer.url, peer.addr, peer.files[rel])
+                       for peer in self._peers.values() if rel in peer.files]
+        if not holders:
+            return
+        _, url, addr, (size, mtime, digest) = min(holders)
+        try:
+            get_upload_admission().preflight(size)
+        except UploadRejected:
+            return
+        try:
+            conn, resp = self._request(addr, f'/download/{url_quote(rel)}?' + self._query(local=1), 60)
+        except (OSError, http.client.HTTPException):
+            return
+        try:
+            if resp.status != 200:
+                return
+            with UploadWriter(rel, url) as writer:
+                writer.copy_from(resp)
+                if writer.size != size or (digest and writer.hexdigest() != digest):
+                    return
+                writer.sync()
+                os.utime(writer.tmp_path, (mtime, mtime))
+                if resolve_file(rel) is None:
+                    writer.commit()
+                    self.replicated += 1
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def start(self):
+        """启动广播和同步线程"""
+        if not self._threads:
+            for target, name in ((self._run, 'quickshare-cluster'), (self._sync, 'quickshare-cluster-sync')):
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """通告其它节点本机离开"""
+        self._announce(bye=True)
+        self._sock.close()
+
+    @staticmethod
+    def local_load():
+        return get_metrics().active_transfers('out')
+
+    def _view_locked(self):
+        if self._view is not None:
+            return self._view
+        files, dirs = {}, {}
+        for peer in self._peers.values():
+            for rel, entry in peer.files.items():
+                parent, _, name = rel.rpartition('/')
+                bucket = files.setdefault(parent, {})
+                current = bucket.get(name)
+                if current is not None and _same_content(entry, current):
+                    current[3].append(peer.url)
+                elif current is None or entry[1] > current[1]:
+                    # 各节点上内容不同时列出最新的一份
+                    bucket[name] = [*entry, [peer.url]]
+                mtime = entry[1]
+                while parent:
+                    parent, _, child = parent.rpartition('/')
+                    subdirs = dirs.setdefault(parent, {})
+                    if subdirs.get(child, -1) >= mtime:
+                        break
+                    subdirs[child] = mtime
+        self._view = files, dirs
+        return self._view
+
+    def listing(self, rel, cache):
+        """目录 rel 的文件列表：其它节点上有这个目录时返回 MergedListing，否则原样返回 cache"""
+        with self._lock:
+            files, dirs = self._view_locked()
+            remote, subdirs = files.get(rel), dirs.get(rel)
+            version = self.version
+        if not remote and not subdirs:
+            return cache
+        if cache is not None:
+            cache.refresh()
+        key = (rel, cache.epoch, cache.version) if cache is not None else (rel,)
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached is not None and cached[0] == version:
+                self._listings.move_to_end(key)
+                return cached[1]
+        merged = MergedListing(cache, remote or {}, subdirs or {}, version)
+        with self._lock:
+            if self.version == version:
+                self._listings[key] = (version, merged)
+                while len(self._listings) > CLUSTER_LISTINGS:
+                    self._listings.popitem(last=False)
+        return merged
+
+    def redirect(self, rel, args, count=True):
+        """下载 rel 应当转去的节点 URL；本机负载最低、或没有其它节点持有相同内容时返回 None
+
+        rel 只在其它节点上时总是重定向；count 为真时计入请求次数，达到
+        CLUSTER_REPLICATE_HITS 次后排队复制到本机。
+        """
+        with self._lock:
+            if not any(rel in peer.files for peer in self._peers.values()):
+                return None
+        path = resolve_file(rel)
+        local = None
+        if path is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                path = None
+            else:
+                local = (st.st_size, st.st_mtime, get_content_index().known_digest(rel, st.st_size, st.st_mtime))
+        local_load = self.local_load()
+        with self._lock:
+            holders = [peer for peer in self._peers.values() if rel in peer.files]
+            if not holders:
+                return None
+            if local is None:
+                local = max((peer.files[rel] for peer in holders), key=lambda entry: entry[1])
+            candidates = [(peer.load + peer.redirects, peer.url, peer) for peer in holders
+                          if _same_content(peer.files[rel], local)]
+            if not candidates:
+                return None
+            load, _, peer = min(candidates, key=lambda c: c[:2])
+            if path is not None and load >= local_load:
+                return None
+            peer.redirects += 1
+            if path is None and count and self.replicate and local[0] <= CLUSTER_REPLICATE_MAX:
+                hits = self._hits[rel] = self._hits.get(rel, 0) + 1
+                if hits == CLUSTER_REPLICATE_HITS:
+                    self._queue.append(rel)
+                    self._wake.set()
+            host, port = peer.addr
+        params = {key: value for key, value in args.items() if key not in ('token', 'ticket', 'local')}
+        params['local'] = 1
+        if AUTH_TOKEN:
+            # 重定向地址会出现在浏览器中，只带只对这个文件有效的短期票据而不是密码
+            params['ticket'] = download_ticket('/download/' + rel)
+        return f'http://{host}:{port}/download/{url_quote(rel)}?' + urlencode(params)
+
+    def catalog(self):
+        """本节点的文件清单：(版本号, [[相对路径, size, mtime, sha256 或 None], ...])"""
+        version, files = get_search_index().snapshot()
+        digests = get_content_index().records()
+        result = []
+        for rel, (size, mtime) in sorted(files.items()):
+            record = digests.get(rel)
+            result.append([rel, size, mtime, record[2] if record is not None and record[:2] == (size, mtime) else None])
+        return version, result
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            peers = [{'node': node, 'url': peer.url, 'load': peer.load + peer.redirects, 'files': len(peer.files),
+                      'seen': round(now - peer.seen, 3)} for node, peer in sorted(self._peers.items())]
+            queued = len(self._queue)
+        return {'name': self.name, 'node': self.node, 'version': self.version, 'load': self.local_load(),
+                'peers': peers, 'replicate': self.replicate, 'replicated': self.replicated, 'queued': queued}
+
+
+def get_listing(rel=''):
+    """返回目录 rel 的文件列表（集群模式下合并其它节点上的文件），目录无效时返回 None"""
+    cache = get_file_cache(rel)
+    if CLUSTER is not None:
+        return CLUSTER.listing(rel, cache)
+    return cache
+
+
+# HTML 模板
+LOGIN_PAGE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>QuickShare - 需要认证</title>
+    <style>
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+            background: #1a1a1a;
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            min-height: 100vh;
+            padding: 20px;
+        }
+        .login-container {
+            background: #ffffff;
+            padding: 48px 40px;
+            border-radius: 4px;
+            box-shadow: 0 2px 8px rgba(0,0,0,0.15);
+            max-width: 420px;
+            width: 100%;
+            border: 1px solid #e5e5e5;
+        }
+        h1 { 
+            color: #1a1a1a; 
+            margin-bottom: 8px; 
+            text-align: center; 
+            font-size: 24px;
+            font-weight: 600;
+            letter-spacing: -0.5px;
+        }
+        p { 
+            color: #666666; 
+            margin-bottom: 32px; 
+            text-align: center; 
+            font-size: 14px;
+        }
+        input {
+            width: 100%;
+            padding: 12px 16px;
+            border: 1px solid #d0d0d0;
+            border-radius: 4px;
+            font-size: 14px;
+            margin-bottom: 20px;
+            background: #ffffff;
+            color: #1a1a1a;
+            transition: border-color 0.2s;
+        }
+        input:focus { 
+            outline: none; 
+            border-color: #1a1a1a; 
+        }
+        input::placeholder {
+            color: #999999;
+        }
+        button {
+            width: 100%;
+            padding: 12px 16px;
+            background: #1a1a1a;
+            color: #ffffff;
+            border: none;
+            border-radius: 4px;
+            font-size: 14px;
+            font-weight: 500;
+            cursor: pointer;
+            transition: background-color 0.2s;
+        }
+        button:hover { background: #2d2d2d; }
+        button:active { background: #0d0d0d; }
+        .error { 
+            color: #d32f2f; 
+            margin-top: 12px; 
+            text-align: center; 
+            font-size: 13px;
+        }
+    </style>
+</head>
+<body>
+    <div class="login-container">
+        <h1>QuickShare</h1>
+        <p>请输入访问密码</p>
+        <form method="POST" action="/login">
+            <input type="password" name="password" placeholder="密码" required autofocus>
+            <button type="submit">登录</button>
+        </form>
+        <div id="error" class="error">{% if error %}{{ error }}{% endif %}</div>
+    </div>
+</body>
+</html>
+"""
+LOGIN_TEMPLATE = app.jinja_env.from_string(LOGIN_PAGE)
+
+MAIN_PAGE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>QuickShare - 文件快传</title>
+    <style>
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
+            background: #f5f5f5;
+            min-height: 100vh;
+            padding: 24px;
+        }
+        .container {
+            max-width: 1200px;
+            margin: 0 auto;
+        }
+        .header {
+            background: #ffffff;
+            padding: 32px;
+            border-radius: 4px;
+            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
+            margin-bottom: 24px;
+            border: 1px solid #e5e5e5;
+        }
+        h1 { 
+            color: #1a1a1a; 
+            margin-bottom: 8px; 
+            font-size: 28px;
+            font-weight: 600;
+            letter-spacing: -0.5px;
+        }
+        .info { 
+            color: #666666; 
+            font-size: 13px; 
+            font-weight: 400;
+        }
+        .main-content {
+            display: grid;
+            grid-template-columns: 1fr 1fr;
+            gap: 24px;
+        }
+        @media (max-width: 768px) {
+            .main-content { grid-template-columns: 1fr; }
+        }
+        .card {
+            background: #ffffff;
+            padding: 32px;
+            border-radius: 4px;
+            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
+            border: 1px solid #e5e5e5;
+        }
+        .card h2 { 
+            color: #1a1a1a; 
+            margin-bottom: 24px; 
+            font-size: 18px;
+            font-weight: 600;
+            letter-spacing: -0.3px;
+        }
+        .upload-area {
+            border: 2px dashed #d0d0d0;
+            border-radius: 4px;
+            padding: 48px 32px;
+            text-align: center;
+            cursor: pointer;
+            transition: all 0.2s;
+            background: #fafafa;
+        }
+        .upload-area:hover { 
+            border-color: #1a1a1a; 
+            background: #f5f5f5; 
+        }
+        .upload-area.dragover { 
+            border-color: #1a1a1a; 
+            background: #f0f0f0; 
+        }
+        .upload-icon { 
+            font-size: 32px; 
+            margin-bottom: 12px; 
+            opacity: 0.4;
+            font-weight: 300;
+        }
+        .upload-area p {
+            color: #666666;
+            font-size: 14px;
+            font-weight: 400;
+        }
+        .file-input { display: none; }
+        .folder-button {
+            margin-top: 12px;
+            padding: 6px 12px;
+            border: 1px solid #d0d0d0;
+            border-radius: 4px;
+            font-size: 13px;
+            background: #ffffff;
+            color: #1a1a1a;
+            cursor: pointer;
+        }
+        .folder-button:hover {
+            background: #1a1a1a;
+            color: #ffffff;
+            border-color: #1a1a1a;
+        }
+        .breadcrumb {
+            font-size: 13px;
+            color: #999999;
+            margin-bottom: 12px;
+            overflow-wrap: anywhere;
+        }
+        .breadcrumb a {
+            color: #1a1a1a;
+            text-decoration: none;
+        }
+        .breadcrumb a:hover { text-decoration: underline; }
+        .dir-list {
+            max-height: 30vh;
+            margin-bottom: 8px;
+        }
+        .dir-link {
+            text-decoration: none;
+            font-weight: 500;
+        }
+        .dir-link:hover { text-decoration: underline; }
+        .search-box {
+            width: 100%;
+            padding: 8px 12px;
+            border: 1px solid #d0d0d0;
+            border-radius: 4px;
+            font-size: 13px;
+            margin-bottom: 12px;
+        }
+        .search-box:focus {
+            outline: none;
+            border-color: #1a1a1a;
+        }
+        .search-dir {
+            color: #999999;
+            font-size: 12px;
+            margin-right: 12px;
+            text-decoration: none;
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            max-width: 30%;
+        }
+        .search-dir:hover { text-decoration: underline; }
+        .list-toolbar {
+            display: flex;
+            gap: 8px;
+            margin-bottom: 12px;
+        }
+        .list-toolbar input, .list-toolbar select {
+            padding: 8px 12px;
+            border: 1px solid #d0d0d0;
+            border-radius: 4px;
+            font-size: 13px;
+            background: #ffffff;
+            color: #1a1a1a;
+        }
+        .list-toolbar input {
+            flex: 1;
+            min-width: 0;
+        }
+        .list-toolbar input:focus, .list-toolbar select:focus {
+            outline: none;
+            border-color: #1a1a1a;
+        }
+        .archive-actions {
+            display: flex;
+            gap: 8px;
+            margin-bottom: 12px;
+        }
+        .archive-actions button, .archive-actions select {
+            padding: 6px 12px;
+            border: 1px solid #d0d0d0;
+            border-radius: 4px;
+            font-size: 13px;
+            background: #ffffff;
+            color: #1a1a1a;
+            cursor: pointer;
+        }
+        .archive-actions button:hover:enabled {
+            background: #1a1a1a;
+            color: #ffffff;
+            border-color: #1a1a1a;
+        }
+        .archive-actions button:disabled {
+            color: #999999;
+            cursor: default;
+        }
+        .file-check {
+            margin-right: 12px;
+            flex-shrink: 0;
+        }
+        .file-thumb {
+            width: 36px;
+            height: 36px;
+            object-fit: cover;
+            border-radius: 3px;
+            margin-right: 12px;
+            flex-shrink: 0;
+            background: #eeeeee;
+        }
+        .list-count {
+            color: #999999;
+            font-size: 12px;
+            margin-bottom: 8px;
+        }
+        .file-list {
+            list-style: none;
+            margin-top: 0;
+            max-height: 70vh;
+            overflow-y: auto;
+        }
+        .file-spacer { margin: 0; padding: 0; }
+        .file-item {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            height: 48px;
+            padding: 0 16px;
+            background: #fafafa;
+            border-radius: 4px;
+            margin-bottom: 8px;
+            border: 1px solid #e5e5e5;
+            transition: all 0.2s;
+        }
+        .file-item:hover { 
+            background: #f5f5f5; 
+            border-color: #d0d0d0;
+        }
+        .file-name { 
+            flex: 1; 
+            min-width: 0;
+            margin-right: 12px;
+            color: #1a1a1a; 
+            font-size: 14px;
+            font-weight: 400;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            white-space: nowrap;
+        }
+        .file-size { 
+            color: #999999; 
+            font-size: 12px; 
+            margin-right: 16px;
+            font-weight: 400;
+        }
+        .file-node {
+            color: #999999;
+            font-size: 12px;
+            margin-right: 8px;
+            white-space: nowrap;
+        }
+        .file-actions a {
+            color: #1a1a1a;
+            text-decoration: none;
+            padding: 6px 16px;
+            border-radius: 4px;
+            transition: all 0.2s;
+            font-size: 13px;
+            border: 1px solid #d0d0d0;
+            background: #ffffff;
+            display: inline-block;
+        }
+        .file-actions a:hover { 
+            background: #1a1a1a; 
+            color: #ffffff;
+            border-color: #1a1a1a;
+        }
+        .progress-bar {
+            width: 100%;
+            height: 4px;
+            background: #e5e5e5;
+            border-radius: 2px;
+            margin-top: 16px;
+            overflow: hidden;
+            display: none;
+        }
+        .progress-fill {
+            height: 100%;
+            background: #1a1a1a;
+            width: 0%;
+            transition: width 0.3s;
+        }
+        .upload-status {
+            margin-top: 16px;
+            padding: 12px 16px;
+            border-radius: 4px;
+            display: none;
+            font-size: 13px;
+        }
+        .upload-status.success {
+            background: #e8f5e9;
+            color: #2e7d32;
+            display: block;
             border: 1px solid #c8e6c9;
         }
         .upload-status.error {
@@ -364,6 +4773,8 @@ MAIN_PAGE = """
                     <p>拖拽文件到此处或点击选择</p>
                     <input type="file" id="fileInput" class="file-input" multiple>
                 </div>
+                <button type="button" class="folder-button" id="folderButton">上传文件夹</button>
+                <input type="file" id="folderInput" class="file-input" webkitdirectory multiple>
                 <div class="progress-bar" id="progressBar">
                     <div class="progress-fill" id="progressFill"></div>
                 </div>
@@ -371,221 +4782,3388 @@ MAIN_PAGE = """
             </div>
             <div class="card">
                 <h2> 下载文件</h2>
+                <input type="search" class="search-box" id="searchBox" placeholder="搜索全部文件（含子文件夹）" autocomplete="off">
+                <div class="list-count" id="searchCount" style="display:none"></div>
+                <ul class="file-list" id="searchResults" style="display:none"></ul>
+                <div id="browser">
+                <div class="list-toolbar">
+                    <input type="search" id="fileFilter" placeholder="筛选文件名">
+                    <select id="fileSort">
+                        <option value="name:asc">名称 A→Z</option>
+                        <option value="name:desc">名称 Z→A</option>
+                        <option value="mtime:desc">最近修改</option>
+                        <option value="mtime:asc">最早修改</option>
+                        <option value="size:desc">最大</option>
+                        <option value="size:asc">最小</option>
+                    </select>
+                </div>
+                <div class="archive-actions">
+                    <button type="button" id="archiveSelected" disabled>打包下载选中</button>
+                    <button type="button" id="archiveAll">全部打包下载</button>
+                    <select id="archiveFormat">
+                        <option value="zip">ZIP</option>
+                        <option value="tar">TAR</option>
+                    </select>
+                </div>
+                <div class="breadcrumb" id="breadcrumb"></div>
+                <ul class="file-list dir-list" id="dirList"></ul>
+                <div class="list-count" id="fileCount">{% if total is not none %}共 {{ total }} 个文件{% endif %}</div>
                 <ul class="file-list" id="fileList">
                     {% for file in files %}
                     <li class="file-item">
                         <span class="file-name">{{ file.name }}</span>
                         <span class="file-size">{{ file.size }}</span>
                         <div class="file-actions">
-                            <a href="/download/{{ file.name }}?token={{ token }}" download>下载</a>
+                            <a href="/download/{% if path %}{{ path }}/{% endif %}{{ file.name }}?token={{ token }}" download>下载</a>
                         </div>
                     </li>
                     {% endfor %}
                 </ul>
+                </div>
             </div>
         </div>
     </div>
     <script>
         const uploadArea = document.getElementById('uploadArea');
         const fileInput = document.getElementById('fileInput');
+        const folderInput = document.getElementById('folderInput');
         const progressBar = document.getElementById('progressBar');
         const progressFill = document.getElementById('progressFill');
         const uploadStatus = document.getElementById('uploadStatus');
         const token = new URLSearchParams(window.location.search).get('token') || '';
 
-        uploadArea.addEventListener('click', () => fileInput.click());
+        uploadArea.addEventListener('click', () => fileInput.click());
+
+        uploadArea.addEventListener('dragover', (e) => {
+            e.preventDefault();
+            uploadArea.classList.add('dragover');
+        });
+
+        uploadArea.addEventListener('dragleave', () => {
+            uploadArea.classList.remove('dragover');
+        });
+
+        // 拖入的文件夹逐层展开，保留相对路径
+        async function readEntry(entry, prefix, out) {
+            if (entry.isFile) {
+                const file = await new Promise((resolve, reject) => entry.file(resolve, reject));
+                out.push({ file, path: prefix + file.name });
+            } else if (entry.isDirectory) {
+                const reader = entry.createReader();
+                for (;;) {
+                    const batch = await new Promise((resolve, reject) => reader.readEntries(resolve, reject));
+                    if (!batch.length) break;
+                    for (const child of batch) await readEntry(child, prefix + entry.name + '/', out);
+                }
+            }
+        }
+
+        uploadArea.addEventListener('drop', async (e) => {
+            e.preventDefault();
+            uploadArea.classList.remove('dragover');
+            // webkitGetAsEntry 只能在事件处理函数同步执行期间调用
+            const entries = Array.from(e.dataTransfer.items || [], item => item.webkitGetAsEntry && item.webkitGetAsEntry())
+                .filter(Boolean);
+            if (!entries.length) {
+                handleFiles(Array.from(e.dataTransfer.files, file => ({ file, path: file.name })));
+                return;
+            }
+            const out = [];
+            try {
+                for (const entry of entries) await readEntry(entry, '', out);
+            } catch (err) {
+                uploadStatus.className = 'upload-status error';
+                uploadStatus.textContent = '读取文件夹失败: ' + err.message;
+                return;
+            }
+            handleFiles(out);
+        });
+
+        fileInput.addEventListener('change', (e) => {
+            handleFiles(Array.from(e.target.files, file => ({ file, path: file.name })));
+        });
+
+        document.getElementById('folderButton').addEventListener('click', () => folderInput.click());
+        folderInput.addEventListener('change', (e) => {
+            handleFiles(Array.from(e.target.files, file => ({ file, path: file.webkitRelativePath || file.name })));
+        });
+
+        // 小文件打包成一个 tar 流一次上传，服务器边收边解包；大文件走可续传的分块上传，
+        // 多个分块并行发送，失败的请求按指数退避重试
+        const CHUNK_SIZE = {{ chunk_size|tojson }};
+        const PARALLEL_CHUNKS = 4;
+        const MAX_RETRIES = 8;
+        const INSTANT_MAX = {{ instant_max|tojson }};
+
+        const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+        function storageGet(key) {
+            try { return localStorage.getItem(key); } catch (e) { return null; }
+        }
+
+        function storageSet(key, value) {
+            try {
+                if (value === null) localStorage.removeItem(key);
+                else localStorage.setItem(key, value);
+            } catch (e) { /* 隐私模式下不可用，只是无法跨页面续传 */ }
+        }
+
+        function request(method, url, body, onProgress) {
+            // 2xx 时返回 xhr；其他状态抛出错误，4xx（408/429 除外）和 507 标记为不可重试
+            return new Promise((resolve, reject) => {
+                const xhr = new XMLHttpRequest();
+                if (onProgress) {
+                    onProgress(0);
+                    xhr.upload.addEventListener('progress', e => onProgress(e.loaded));
+                }
+                xhr.addEventListener('load', () => {
+                    if (xhr.status >= 200 && xhr.status < 300) return resolve(xhr);
+                    let message = xhr.statusText;
+                    try { message = JSON.parse(xhr.responseText).error || message; } catch (e) {}
+                    const err = new Error(message);
+                    err.status = xhr.status;
+                    err.fatal = (xhr.status < 500 && xhr.status !== 408 && xhr.status !== 429) || xhr.status === 507;
+                    err.busy = xhr.status === 503 || xhr.status === 429;
+                    err.retryAfter = parseFloat(xhr.getResponseHeader('Retry-After')) || 0;
+                    reject(err);
+                });
+                xhr.addEventListener('error', () => reject(new Error('网络错误')));
+                xhr.addEventListener('abort', () => reject(new Error('请求被中断')));
+                xhr.open(method, url);
+                if (body && !(body instanceof FormData) && !(body instanceof Blob)) {
+                    xhr.setRequestHeader('Content-Type', 'application/json');
+                    body = JSON.stringify(body);
+                }
+                xhr.send(body || null);
+            });
+        }
+
+        async function withRetry(task) {
+            for (let attempt = 0, busy = 0; ; ) {
+                try {
+                    return await task();
+                } catch (err) {
+                    if (err.fatal) throw err;
+                    if (err.busy) {
+                        // 服务器上传名额已满：不计入重试次数，按 Retry-After 加随机抖动退避
+                        uploadStatus.className = 'upload-status';
+                        uploadStatus.textContent = '服务器繁忙，排队中...';
+                        const delay = Math.max(err.retryAfter * 1000, Math.min(30000, 1000 * 2 ** busy++));
+                        await sleep(delay * (0.5 + Math.random()));
+                        continue;
+                    }
+                    if (attempt >= MAX_RETRIES) throw err;
+                    uploadStatus.className = 'upload-status error';
+                    uploadStatus.textContent = '连接中断，正在重试...';
+                    if (!navigator.onLine) {
+                        await new Promise(resolve => window.addEventListener('online', resolve, { once: true }));
+                    } else {
+                        await sleep(Math.min(30000, 1000 * 2 ** attempt));
+                    }
+                    attempt++;
+                }
+            }
+        }
+
+        // tar 打包：Blob 只引用各个文件，不把内容读进内存
+        const encoder = new TextEncoder();
+
+        function tarHeader(name, size, mtime, type) {
+            const block = new Uint8Array(512);
+            const put = (text, offset, length) => block.set(encoder.encode(text).subarray(0, length), offset);
+            const octal = (value, length) => value.toString(8).padStart(length - 1, '0');
+            put(name, 0, 100);
+            put(octal(0o644, 8), 100, 8);
+            put(octal(0, 8), 108, 8);
+            put(octal(0, 8), 116, 8);
+            put(octal(size, 12), 124, 12);
+            put(octal(mtime, 12), 136, 12);
+            put(' '.repeat(8), 148, 8);
+            put(type, 156, 1);
+            put('ustar\\x0000', 257, 8);
+            put(octal(block.reduce((a, b) => a + b, 0), 7) + '\\x00 ', 148, 8);
+            return block;
+        }
+
+        function paxRecord(key, value) {
+            // "长度 key=value\\n"，长度包括表示长度的数字本身
+            const body = ' ' + key + '=' + value + '\\n';
+            const base = encoder.encode(body).length;
+            let length = base + String(base).length;
+            if (String(length).length !== String(base).length) length = base + String(length).length;
+            return encoder.encode(length + body);
+        }
+
+        function buildTar(items) {
+            const parts = [];
+            const pad = size => new Uint8Array((512 - size % 512) % 512);
+            for (const { file, path } of items) {
+                const mtime = Math.max(0, Math.floor(file.lastModified / 1000) || 0);
+                if (encoder.encode(path).length > 100) {
+                    // 超过 100 字节的路径用 PAX 扩展头记录
+                    const record = paxRecord('path', path);
+                    parts.push(tarHeader('PaxHeader', record.length, mtime, 'x'), record, pad(record.length));
+                }
+                parts.push(tarHeader(path, file.size, mtime, '0'), file, pad(file.size));
+            }
+            parts.push(new Uint8Array(1024));
+            return new Blob(parts, { type: 'application/x-tar' });
+        }
+
+        async function sha256Hex(file) {
+            const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        async function tryInstantUpload(file, name) {
+            // 秒传：先发送内容哈希，服务器已有相同内容时无需传输。crypto.subtle 只在
+            // HTTPS 或 localhost 下可用，且要把整个文件读进内存，所以限制大小
+            if (!(window.crypto && crypto.subtle) || file.size > INSTANT_MAX) return false;
+            let sha256;
+            try {
+                sha256 = await sha256Hex(file);
+            } catch (e) {
+                return false;
+            }
+            const xhr = await withRetry(() => request('POST', apiUrl('/api/uploads/instant'), { name, size: file.size, sha256 }));
+            return JSON.parse(xhr.responseText).exists;
+        }
+
+        async function uploadResumable(file, name, onProgress) {
+            const key = 'quickshare-upload:' + [name, file.size, file.lastModified].join(':');
+            let session = null;
+            const savedId = storageGet(key);
+            if (!savedId && await tryInstantUpload(file, name)) {
+                onProgress(file.size);
+                return;
+            }
+            if (savedId) {
+                try {
+                    const xhr = await withRetry(() => request('GET', apiUrl('/api/uploads/' + savedId)));
+                    session = JSON.parse(xhr.responseText);
+                } catch (err) {
+                    if (!err.fatal) throw err;
+                }
+            }
+            if (!session) {
+                const xhr = await withRetry(() => request('POST', apiUrl('/api/uploads'), { name, size: file.size }));
+                session = JSON.parse(xhr.responseText);
+                storageSet(key, session.id);
+            }
+
+            const sessionUrl = '/api/uploads/' + session.id;
+            const chunkSize = session.chunk_size;
+            const pending = [];
+            const inflight = new Map();
+            let confirmed = 0;
+            for (let start = 0; start < file.size; start += chunkSize) {
+                const end = Math.min(start + chunkSize, file.size);
+                if (session.received.some(([a, b]) => a <= start && end <= b)) confirmed += end - start;
+                else pending.push(start);
+            }
+            const report = () => {
+                let loaded = confirmed;
+                inflight.forEach(n => loaded += n);
+                onProgress(loaded);
+            };
+            report();
+
+            async function worker() {
+                while (pending.length) {
+                    const start = pending.shift();
+                    const end = Math.min(start + chunkSize, file.size);
+                    await withRetry(() => request('PUT', apiUrl(sessionUrl, { offset: start }), file.slice(start, end),
+                        loaded => { inflight.set(start, loaded); report(); }));
+                    inflight.delete(start);
+                    confirmed += end - start;
+                    report();
+                }
+            }
+            await Promise.all(Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, worker));
+            await withRetry(() => request('POST', apiUrl(sessionUrl + '/finalize')));
+            storageSet(key, null);
+        }
+
+        async function handleFiles(selected) {
+            // selected 为 [{file, path}]，path 是相对于当前目录的路径（上传文件夹时带子目录）
+            if (selected.length === 0) return;
+
+            progressBar.style.display = 'block';
+            uploadStatus.style.display = 'none';
+            progressFill.style.width = '0%';
+
+            const totalBytes = selected.reduce((n, item) => n + item.file.size, 0) || 1;
+            let doneBytes = 0;
+            const onProgress = loaded => {
+                progressFill.style.width = Math.min(100, (doneBytes + loaded) / totalBytes * 100) + '%';
+            };
+            const small = selected.filter(item => item.file.size < CHUNK_SIZE);
+            const large = selected.filter(item => item.file.size >= CHUNK_SIZE);
+            const totalSmall = small.reduce((n, item) => n + item.file.size, 0);
+            const dir = currentPath;
+
+            try {
+                if (small.length) {
+                    const tar = buildTar(small);
+                    await withRetry(() => request('POST', apiUrl('/upload-archive', dir ? { path: dir } : {}), tar,
+                        loaded => onProgress(loaded * totalSmall / tar.size)));
+                    doneBytes += totalSmall;
+                }
+                for (const item of large) {
+                    await uploadResumable(item.file, joinPath(dir, item.path), onProgress);
+                    doneBytes += item.file.size;
+                }
+                progressFill.style.width = '100%';
+                uploadStatus.className = 'upload-status success';
+                uploadStatus.textContent = '上传成功！';
+                if (!window.EventSource) refreshFiles();
+            } catch (error) {
+                uploadStatus.className = 'upload-status error';
+                uploadStatus.textContent = '上传失败: ' + error.message;
+            }
+        }
+
+        // 文件列表：按页加载，只渲染滚动窗口内的条目；优先使用服务端推送的增量，
+        // 不支持 EventSource 时退回条件轮询
+        const fileList = document.getElementById('fileList');
+        const fileFilter = document.getElementById('fileFilter');
+        const fileSort = document.getElementById('fileSort');
+        const fileCount = document.getElementById('fileCount');
+        const breadcrumb = document.getElementById('breadcrumb');
+        const dirList = document.getElementById('dirList');
+        const PAGE_SIZE = {{ page_size|tojson }};
+        const ROW_HEIGHT = 56;  // .file-item 高度加下边距
+        const ROW_BUFFER = 10;
+        let items = {{ files|tojson }};
+        let nextCursor = {{ next_cursor|tojson }};
+        let total = {{ total|tojson }};
+        let listVersion = {{ version|tojson }};
+        let currentPath = {{ path|tojson }};
+        let dirs = {{ dirs|tojson }};
+        let listEtag = null;
+        let loading = false;
+        let generation = 0;  // 查询条件变化后丢弃过期的响应
+        const query = { sort: 'name', order: 'asc', q: '' };
+
+        function apiUrl(path, params) {
+            const search = new URLSearchParams(params || {});
+            if (token) search.set('token', token);
+            const qs = search.toString();
+            return path + (qs ? '?' + qs : '');
+        }
+
+        function escapeHtml(text) {
+            return String(text).replace(/[&<>"']/g, c => ({
+                '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+            })[c]);
+        }
+
+        function joinPath(dir, name) {
+            return dir ? dir + '/' + name : name;
+        }
+
+        function encodePath(path) {
+            return path.split('/').map(encodeURIComponent).join('/');
+        }
+
+        function pageUrl(path) {
+            return apiUrl('/', path ? { path } : {});
+        }
+
+        function pageParams(cursor, limit) {
+            const params = { sort: query.sort, order: query.order, limit: limit || PAGE_SIZE };
+            if (currentPath) params.path = currentPath;
+            if (query.q) params.q = query.q;
+            if (cursor) params.cursor = cursor;
+            return params;
+        }
+
+        function compareFiles(a, b) {
+            let d = 0;
+            if (query.sort === 'size') d = a.bytes - b.bytes;
+            else if (query.sort === 'mtime') d = a.mtime - b.mtime;
+            if (d === 0) d = a.name < b.name ? -1 : (a.name > b.name ? 1 : 0);
+            return query.order === 'desc' ? -d : d;
+        }
+
+        function matchesFilter(file) {
+            return !query.q || file.name.toLowerCase().includes(query.q.toLowerCase());
+        }
+
+        const THUMB_PATTERN = /\\.(jpe?g|png|gif|webp|bmp|tiff?)$/i;
+
+        function thumbUrl(file) {
+            return apiUrl('/thumb/' + encodePath(joinPath(currentPath, file.name)), { v: file.mtime });
+        }
+
+        function renderItem(file) {
+            const path = joinPath(currentPath, file.name);
+            return `
+                <li class="file-item">
+                    <input type="checkbox" class="file-check" data-name="${escapeHtml(path)}"${selected.has(path) ? ' checked' : ''}>
+                    ${THUMB_PATTERN.test(file.name) && !file.nodes ? `<img class="file-thumb" loading="lazy" alt="" src="${escapeHtml(thumbUrl(file))}">` : ''}
+                    <span class="file-name" title="${escapeHtml(file.name)}">${escapeHtml(file.name)}</span>
+                    ${file.nodes ? `<span class="file-node" title="${escapeHtml(file.nodes.join(', '))}">其它节点</span>` : ''}
+                    <span class="file-size">${escapeHtml(file.size)}</span>
+                    <div class="file-actions">
+                        <a href="/download/${encodePath(path)}?token=${encodeURIComponent(token)}" download>下载</a>
+                    </div>
+                </li>`;
+        }
+
+        function renderDirs() {
+            // 面包屑导航和当前目录下的子目录（子目录通常不多，不做虚拟滚动）
+            const parts = currentPath ? currentPath.split('/') : [];
+            breadcrumb.innerHTML = [`<a href="${escapeHtml(pageUrl(''))}" data-path="">全部文件</a>`].concat(
+                parts.map((part, i) => {
+                    const path = parts.slice(0, i + 1).join('/');
+                    return `<a href="${escapeHtml(pageUrl(path))}" data-path="${escapeHtml(path)}">${escapeHtml(part)}</a>`;
+                })).join(' / ');
+            dirList.innerHTML = dirs.map(dir => {
+                const path = joinPath(currentPath, dir.name);
+                return `
+                <li class="file-item">
+                    <input type="checkbox" class="file-check" data-name="${escapeHtml(path)}"${selected.has(path) ? ' checked' : ''}>
+                    <a class="file-name dir-link" href="${escapeHtml(pageUrl(path))}" data-path="${escapeHtml(path)}" title="${escapeHtml(dir.name)}">${escapeHtml(dir.name)}/</a>
+                </li>`;
+            }).join('');
+            dirList.style.display = dirs.length ? '' : 'none';
+        }
+
+        function renderFiles() {
+            const top = fileList.scrollTop;
+            const height = fileList.clientHeight || window.innerHeight;
+            const first = Math.max(0, Math.floor(top / ROW_HEIGHT) - ROW_BUFFER);
+            const last = Math.min(items.length, Math.ceil((top + height) / ROW_HEIGHT) + ROW_BUFFER);
+            fileList.innerHTML =
+                `<li class="file-spacer" style="height:${first * ROW_HEIGHT}px"></li>` +
+                items.slice(first, last).map(renderItem).join('') +
+                `<li class="file-spacer" style="height:${(items.length - last) * ROW_HEIGHT}px"></li>`;
+            fileCount.textContent = total !== null
+                ? `共 ${total} 个文件`
+                : `已加载 ${items.length} 个匹配的文件` + (nextCursor ? '…' : '');
+            if (nextCursor && last + ROW_BUFFER >= items.length) loadMore();
+        }
+
+        async function loadMore() {
+            if (loading || !nextCursor) return;
+            loading = true;
+            const gen = generation;
+            try {
+                const r = await fetch(apiUrl('/api/files', pageParams(nextCursor)), { cache: 'no-store' });
+                const data = await r.json();
+                if (gen === generation) {
+                    items = items.concat(data.files);
+                    nextCursor = data.next;
+                }
+            } catch (err) {
+                console.error('加载文件列表失败:', err);
+                return;
+            } finally {
+                loading = false;
+            }
+            if (gen === generation) renderFiles();
+        }
+
+        async function refreshFiles() {
+            // 重新加载当前查询已加载的范围，内容未变时服务端返回 304
+            const gen = ++generation;
+            const limit = Math.min(Math.max(items.length, PAGE_SIZE), {{ max_page_size|tojson }});
+            try {
+                const headers = listEtag ? { 'If-None-Match': listEtag } : {};
+                const r = await fetch(apiUrl('/api/files', pageParams(null, limit)), { headers, cache: 'no-store' });
+                if (r.status === 304 || gen !== generation) return;
+                const data = await r.json();
+                if (gen !== generation) return;
+                listEtag = r.headers.get('ETag');
+                listVersion = data.version;
+                items = data.files;
+                nextCursor = data.next;
+                total = data.total;
+                if (data.dirs) {
+                    dirs = data.dirs;
+                    renderDirs();
+                }
+                renderFiles();
+            } catch (err) {
+                console.error('刷新文件列表失败:', err);
+            }
+        }
+
+        function insertSorted(file) {
+            let lo = 0, hi = items.length;
+            while (lo < hi) {
+                const mid = (lo + hi) >> 1;
+                if (compareFiles(items[mid], file) < 0) lo = mid + 1; else hi = mid;
+            }
+            items.splice(lo, 0, file);
+        }
+
+        function applyChange(change) {
+            const gone = new Set(change.removed);
+            change.changed.forEach(file => gone.add(file.name));
+            items = items.filter(file => !gone.has(file.name));
+            for (const file of change.added.concat(change.changed)) {
+                if (!matchesFilter(file)) continue;
+                // 只插入已加载范围内的条目，范围之外的留给后续分页加载
+                const last = items[items.length - 1];
+                if (nextCursor && (!last || compareFiles(file, last) > 0)) continue;
+                insertSorted(file);
+            }
+            if (total !== null) total += change.added.length - change.removed.length;
+            if (change.dirs) {
+                dirs = change.dirs;
+                renderDirs();
+            }
+            listEtag = null;
+            renderFiles();
+        }
+
+        function navigate(path, push) {
+            // 进入子目录：用 history API 更新地址，前进/后退按钮同样可用
+            currentPath = path;
+            if (push) history.pushState({ path }, '', pageUrl(path));
+            items = [];
+            dirs = [];
+            nextCursor = null;
+            total = null;
+            listVersion = null;
+            listEtag = null;
+            fileList.scrollTop = 0;
+            renderDirs();
+            renderFiles();
+            refreshFiles();
+            connectEvents();
+        }
+
+        function changeQuery() {
+            const [sort, order] = fileSort.value.split(':');
+            query.sort = sort;
+            query.order = order;
+            query.q = fileFilter.value.trim();
+            items = [];
+            listEtag = null;
+            fileList.scrollTop = 0;
+            refreshFiles();
+        }
+
+        let filterTimer = null;
+        fileFilter.addEventListener('input', () => {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(changeQuery, 200);
+        });
+        fileSort.addEventListener('change', changeQuery);
+
+        // 打包下载：用表单 POST 提交文件名，浏览器直接接收流式生成的归档
+        const selected = new Set();
+        const archiveSelected = document.getElementById('archiveSelected');
+        const archiveFormat = document.getElementById('archiveFormat');
+
+        function updateSelection() {
+            archiveSelected.disabled = selected.size === 0;
+            archiveSelected.textContent = selected.size ? `打包下载选中 (${selected.size})` : '打包下载选中';
+        }
+
+        function downloadArchive(fields) {
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = apiUrl('/download-archive');
+            fields.push(['format', archiveFormat.value]);
+            for (const [name, value] of fields) {
+                const input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = name;
+                input.value = value;
+                form.appendChild(input);
+            }
+            document.body.appendChild(form);
+            form.submit();
+            form.remove();
+        }
+
+        function onCheck(e) {
+            if (!e.target.classList.contains('file-check')) return;
+            if (e.target.checked) selected.add(e.target.dataset.name);
+            else selected.delete(e.target.dataset.name);
+            updateSelection();
+        }
+
+        function onNavigate(e) {
+            const link = e.target.closest('[data-path]');
+            if (!link || e.ctrlKey || e.metaKey || e.shiftKey || e.button !== 0) return;
+            e.preventDefault();
+            navigate(link.dataset.path, true);
+        }
+
+        fileList.addEventListener('change', onCheck);
+        dirList.addEventListener('change', onCheck);
+        dirList.addEventListener('click', onNavigate);
+        breadcrumb.addEventListener('click', onNavigate);
+
+        // 搜索整个共享目录：边输入边查询服务端的文件名索引，有关键词时代替目录浏览
+        const searchBox = document.getElementById('searchBox');
+        const searchResults = document.getElementById('searchResults');
+        const searchCount = document.getElementById('searchCount');
+        const browser = document.getElementById('browser');
+        let searchTimer = null;
+        let searchGeneration = 0;
+
+        function renderResult(file) {
+            return `
+                <li class="file-item">
+                    <span class="file-name" title="${escapeHtml(file.path)}">${escapeHtml(file.name)}</span>
+                    <a class="search-dir" href="${escapeHtml(pageUrl(file.dir))}" data-path="${escapeHtml(file.dir)}" title="${escapeHtml(file.dir || '/')}">${escapeHtml(file.dir || '/')}</a>
+                    <span class="file-size">${escapeHtml(file.size)}</span>
+                    <div class="file-actions">
+                        <a href="/download/${encodePath(file.path)}?token=${encodeURIComponent(token)}" download>下载</a>
+                    </div>
+                </li>`;
+        }
+
+        function showSearch(active) {
+            searchResults.style.display = searchCount.style.display = active ? '' : 'none';
+            browser.style.display = active ? 'none' : '';
+        }
+
+        async function runSearch() {
+            const q = searchBox.value.trim();
+            const gen = ++searchGeneration;
+            if (!q) {
+                showSearch(false);
+                return;
+            }
+            try {
+                const r = await fetch(apiUrl('/api/search', { q }), { cache: 'no-store' });
+                const data = await r.json();
+                if (gen !== searchGeneration) return;
+                searchResults.innerHTML = data.results.map(renderResult).join('');
+                searchCount.textContent = `找到 ${data.total} 个文件` +
+                    (data.total > data.results.length ? `，显示前 ${data.results.length} 个` : '') +
+                    (data.ready ? '' : '（索引建立中，结果可能不完整）');
+                showSearch(true);
+            } catch (err) {
+                console.error('搜索失败:', err);
+            }
+        }
+
+        searchBox.addEventListener('input', () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(runSearch, 150);
+        });
+        searchResults.addEventListener('click', e => {
+            if (!e.target.closest('[data-path]') || e.ctrlKey || e.metaKey || e.shiftKey || e.button !== 0) return;
+            searchBox.value = '';
+            ++searchGeneration;
+            showSearch(false);
+            onNavigate(e);
+        });
+        window.addEventListener('popstate', e => {
+            navigate(e.state ? e.state.path : (new URLSearchParams(location.search).get('path') || ''), false);
+        });
+        history.replaceState({ path: currentPath }, '');
+        // 选中的文件和目录以相对于共享目录的路径提交，归档内的名称相对于当前目录
+        archiveSelected.addEventListener('click', () => {
+            downloadArchive(Array.from(selected, name => ['names', name]).concat([['path', currentPath]]));
+        });
+        document.getElementById('archiveAll').addEventListener('click', () => downloadArchive([['all', '1'], ['path', currentPath]]));
+        fileList.addEventListener('scroll', () => requestAnimationFrame(renderFiles));
+        window.addEventListener('resize', () => requestAnimationFrame(renderFiles));
+        renderDirs();
+        renderFiles();
+
+        let events = null;
+
+        function connectEvents() {
+            if (!window.EventSource) return;
+            if (events) events.close();
+            events = new EventSource(apiUrl('/api/events', currentPath ? { path: currentPath } : {}));
+            events.addEventListener('sync', e => {
+                if (JSON.parse(e.data).version !== listVersion) refreshFiles();
+            });
+            events.addEventListener('change', e => {
+                listVersion = Number(e.lastEventId);
+                applyChange(JSON.parse(e.data));
+            });
+            events.addEventListener('reset', () => refreshFiles());
+        }
+
+        if (window.EventSource) {
+            connectEvents();
+        } else {
+            setInterval(refreshFiles, 5000);
+        }
+    </script>
+</body>
+</html>
+"""
+# 模板在导入时编译一次，避免每个请求都重新解析
+MAIN_TEMPLATE = app.jinja_env.from_string(MAIN_PAGE)
+
+
+@app.before_request
+def start_request_timer():
+    request.environ['quickshare.started'] = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(resp):
+    """记录请求耗时；after_request 按注册的倒序执行，这里最后运行，包含压缩的时间"""
+    started = request.environ.get('quickshare.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        get_metrics().observe_request(route, request.method, resp.status_code, time.perf_counter() - started)
+    return resp
+
+
+@app.after_request
+def compress_response(resp):
+    """按 Accept-Encoding 压缩页面和 API 的响应（下载、SSE 等流式响应不经过这里压缩）"""
+    if resp.direct_passthrough or resp.is_streamed or 'Content-Encoding' in resp.headers:
+        return resp
+    if resp.mimetype not in COMPRESSIBLE_TYPES:
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None or resp.status_code not in (200, 304):
+        return resp
+    if resp.status_code == 200:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return resp
+        resp.set_data(compress_bytes(data, encoding))
+        resp.headers['Content-Encoding'] = encoding
+    # 压缩后的内容与原始内容不再逐字节相同，ETag 改为弱 ETag（与 nginx 的做法一致）
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+@app.route('/')
+@requires_auth
+def index():
+    """主页面（?path= 打开子目录）"""
+    path = safe_path(request.args.get('path', ''))
+    cache = get_listing(path) if path is not None else None
+    if cache is None:
+        path, cache = '', get_listing()
+    page = query_files(cache, {})
+    version = cache.version
+    token = request.cookies.get('auth_token') or request.args.get('token', '')
+    return MAIN_TEMPLATE.render(files=page['files'], next_cursor=page['next'],
+                                total=page['total'], version=version, path=path, dirs=cache.dirs(),
+                                page_size=PAGE_SIZE, max_page_size=MAX_PAGE_SIZE,
+                                chunk_size=UPLOAD_CHUNK_SIZE,
+                                instant_max=INSTANT_UPLOAD_MAX,
+                                current_dir=UPLOAD_DIR, token=token)
+
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """登录页面"""
+    if AUTH_TOKEN is None:
+        return '', 404
+    
+    error = request.args.get('error')
+    
+    if request.method == 'POST':
+        password = request.form.get('password')
+        if password == AUTH_TOKEN:
+            resp = Response('', 302)
+            resp.headers['Location'] = '/?token=' + AUTH_TOKEN
+            resp.set_cookie('auth_token', AUTH_TOKEN, max_age=3600)
+            return resp
+        else:
+            resp = Response('', 302)
+            resp.headers['Location'] = '/login?error=密码错误，请重试'
+            return resp
+    
+    return LOGIN_TEMPLATE.render(error=error)
+
+
+def admit_upload(size=None):
+    """为当前上传请求占用一个名额并预留 size 字节（默认为请求体长度）
+
+    异步引擎已经在读取请求体之前占用过名额时直接复用，预留量改为 size。
+    """
+    slot = request.environ.get('quickshare.upload_slot')
+    if slot is not None:
+        if size is not None:
+            slot.resize(size)
+        return nullcontext(slot)
+    return get_upload_admission().admit(request.remote_addr, request.content_length if size is None else size)
+
+
+@app.route('/upload', methods=['POST'])
+@requires_auth
+def upload():
+    """文件上传接口（multipart/form-data，字段名 files），请求体边接收边写盘
+
+    ?path= 指定保存到哪个子目录；文件名可以带相对路径，缺少的子目录会自动创建。
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': '没有文件'}), 400
+    
+    directory = safe_path(request.args.get('path', ''))
+    if directory is None:
+        return jsonify({'error': '无效的路径'}), 400
+    
+    try:
+        with admit_upload() as slot, open_flow(request.remote_addr, request.content_length, 'in') as flow:
+            uploaded = save_multipart_stream(ThrottledReader(CountingReader(request.stream, slot), flow),
+                                             boundary, overwrite=wants_overwrite(request.args),
+                                             directory=directory, uploader=request.remote_addr)
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}'}), 400
+    if uploaded is None:
+        return jsonify({'error': '没有文件'}), 400
+    
+    return jsonify({'message': '上传成功', 'files': uploaded})
+
+
+@app.route('/upload/<path:filename>', methods=['PUT'])
+@requires_auth
+def upload_raw(filename):
+    """原始数据上传接口：请求体即文件内容，例如 curl -T file http://host/upload/dir/file"""
+    filename = safe_path(filename)
+    if not filename or not check_parent(filename):
+        return jsonify({'error': '无效的文件名'}), 400
+    
+    try:
+        with admit_upload() as slot, UploadWriter(filename, request.remote_addr) as writer, \
+                open_flow(request.remote_addr, request.content_length, 'in') as flow:
+            writer.copy_from(ThrottledReader(CountingReader(request.stream, slot), flow))
+            if request.content_length is not None and writer.size != request.content_length:
+                writer.abort()
+                return jsonify({'error': '上传失败: 请求体不完整'}), 400
+            filename = writer.commit(wants_overwrite(request.args))
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}'}), 400
+    
+    return jsonify({'message': '上传成功', 'files': [filename]})
+
+
+@app.route('/upload-archive', methods=['POST', 'PUT'])
+@requires_auth
+def upload_archive():
+    """批量上传：请求体为 tar 流（可压缩），边接收边解包到 ?path= 指定的目录
+
+    例如 tar cz photos | curl -T - http://host/upload-archive?path=2024
+    """
+    directory = safe_path(request.args.get('path', ''))
+    if directory is None or (directory and not check_parent(posixpath.join(directory, ''))):
+        return jsonify({'error': '无效的路径'}), 400
+    
+    ingest = TarIngest(directory, wants_overwrite(request.args), request.remote_addr)
+    try:
+        with admit_upload() as slot, open_flow(request.remote_addr, request.content_length, 'in') as flow:
+            files, skipped = ingest.run(ThrottledReader(CountingReader(request.stream, slot), flow))
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}', 'files': ingest.files}), 400
+    if not files and not skipped:
+        return jsonify({'error': '没有文件'}), 400
+    
+    return jsonify({'message': '上传成功', 'files': files, 'skipped': skipped})
+
+
+@app.route('/api/uploads', methods=['POST'])
+@requires_auth
+def api_upload_create():
+    """创建分块上传会话，请求体为 {"name": ..., "size": ...}，name 可以是相对路径"""
+    data = request.get_json(silent=True) or {}
+    name = safe_path(data.get('name'))
+    size = data.get('size')
+    if not name or not check_parent(name) or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({'error': '无效的文件名或大小'}), 400
+    get_upload_admission().preflight(size)
+    try:
+        session = UploadSession.create(name, size)
+    except OSError as e:
+        return jsonify({'error': f'无法创建上传会话: {e.strerror}'}), 507
+    return jsonify(session.status()), 201
+
+
+@app.route('/api/uploads/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@requires_auth
+def api_upload_session(session_id):
+    """查询会话状态 (GET)、写入分块 (PUT ?offset=N)、放弃上传 (DELETE)"""
+    session = UploadSession.load(session_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在'}), 404
+    if request.method == 'DELETE':
+        session.discard()
+        return jsonify({'message': '已取消'})
+    if request.method == 'PUT':
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'error': '缺少 offset 参数'}), 400
+        try:
+            # 会话创建时已经预留了整个文件的空间
+            with admit_upload(0) as slot, open_flow(request.remote_addr, request.content_length, 'in') as flow:
+                session.write_chunk(offset, ThrottledReader(CountingReader(request.stream, slot), flow))
+        except ValueError:
+            return jsonify({'error': '分块超出文件范围'}), 416
+    return jsonify(session.status())
+
+
+@app.route('/api/uploads/<session_id>/finalize', methods=['POST'])
+@requires_auth
+def api_upload_finalize(session_id):
+    """所有分块到齐后完成上传"""
+    session = UploadSession.load(session_id)
+    if session is None:
+        return jsonify({'error': '上传会话不存在'}), 404
+    if not session.is_complete():
+        return jsonify({'error': '文件尚未上传完整', **session.status()}), 409
+    try:
+        name = session.finalize(session.name, wants_overwrite(request.args), request.remote_addr)
+    except FileNotFoundError:
+        # 并发的另一个 finalize 请求已经完成了这次上传
+        return jsonify({'error': '上传会话不存在'}), 404
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}'}), 400
+    return jsonify({'message': '上传成功', 'files': [name]})
+
+
+@app.route('/api/uploads/instant', methods=['POST'])
+@requires_auth
+def api_upload_instant():
+    """秒传：请求体为 {"name": ..., "size": ..., "sha256": ...}，服务器已有相同内容时直接生成文件"""
+    data = request.get_json(silent=True) or {}
+    name = safe_path(data.get('name'))
+    size = data.get('size')
+    digest = data.get('sha256')
+    if not name or not check_parent(name) or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({'error': '无效的文件名或大小'}), 400
+    if not isinstance(digest, str) or not re.fullmatch(r'[0-9a-fA-F]{64}', digest):
+        return jsonify({'error': '无效的 sha256'}), 400
+    digest = digest.lower()
+    overwrite = wants_overwrite(request.args)
+    source = get_content_index().find(digest, size)
+    if source is None:
+        return jsonify({'exists': False})
+    source_path = os.path.join(UPLOAD_DIR, source)
+    tmp_path = os.path.join(state_dir('tmp'), secrets.token_hex(16) + '.tmp')
+    try:
+        if clone_file(source_path, tmp_path):
+            name = store_file(tmp_path, name, digest, overwrite, request.remote_addr)
+        else:
+            # 不能共享数据块时退回服务器端复制，仍然省去了网络传输
+            with UploadWriter(name, request.remote_addr) as writer, open(source_path, 'rb') as f:
+                writer.copy_from(f)
+                name = writer.commit(overwrite)
+    except FileNotFoundError:
+        # 源文件刚好被删除
+        return jsonify({'exists': False})
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}'}), 400
+    return jsonify({'exists': True, 'message': '秒传成功', 'files': [name]})
+
+
+@app.route('/api/delta/<path:filename>', methods=['GET', 'POST'])
+@requires_auth
+def api_delta(filename):
+    """差量同步：只上传新版本中与服务器上旧版本不同的部分
+
+    GET 返回旧版本的块签名（?block_size= 指定块大小，须为 2 的幂）；POST 的请求体是
+    按签名算出的差量指令流（见 apply_delta），并用 If-Match 带上签名中的 etag。服务器
+    用旧版本的块和收到的新数据重建文件，sha256 校验通过后原子地替换旧版本。
+    """
+    filename = safe_path(filename)
+    path = resolve_file(filename) if filename else None
+    if path is None:
+        return jsonify({'error': '文件不存在'}), 404
+    
+    if request.method == 'GET':
+        block_size = request.args.get('block_size', type=int)
+        try:
+            if block_size is None:
+                block_size = delta_block_size(os.path.getsize(path))
+            elif not DELTA_MIN_BLOCK <= block_size <= DELTA_MAX_BLOCK or block_size & (block_size - 1):
+                return jsonify({'error': '无效的块大小'}), 400
+            signature, st = get_signature_cache().get(filename, path, block_size)
+        except OSError:
+            return jsonify({'error': '文件不存在'}), 404
+        etag = file_etag(st)
+        resp = jsonify({'name': filename, 'size': st.st_size, 'etag': etag, **signature})
+        resp.set_etag(f'{etag}-{block_size:x}')
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp.make_conditional(request)
+    
+    if not request.if_match:
+        return jsonify({'error': '缺少 If-Match（签名中的 etag）'}), 428
+    try:
+        base = open(path, 'rb')
+    except OSError:
+        return jsonify({'error': '文件不存在'}), 404
+    try:
+        with base:
+            st = os.fstat(base.fileno())
+            if not request.if_match.contains(file_etag(st)):
+                return jsonify({'error': '文件已被修改，请重新获取签名'}), 412
+            # 请求体只有差异部分，磁盘上却要写出完整的新版本，按旧版本的大小预留
+            builder = SignatureBuilder(delta_block_size(st.st_size))
+            with admit_upload(max(st.st_size, request.content_length or 0)) as slot, UploadWriter(filename, request.remote_addr) as writer, \
+                    open_flow(request.remote_addr, request.content_length, 'in') as flow:
+                def write(data):
+                    writer.write(data)
+                    builder.update(data)
+
+                copied, literal, digest = apply_delta(ThrottledReader(CountingReader(request.stream, slot), flow),
+                                                      base, st.st_size, write)
+                if writer.hexdigest() != digest:
+                    writer.abort()
+                    return jsonify({'error': '上传失败: 重建的文件与 sha256 不一致'}), 400
+                filename = writer.commit(overwrite=True)
+    except ValueError as e:
+        return jsonify({'error': f'上传失败: {e}'}), 400
+    
+    # 下次差量上传时不必再读一遍新文件
+    try:
+        st = os.stat(os.path.join(UPLOAD_DIR, filename))
+    except OSError:
+        st = None
+    if st is not None and st.st_size == builder.size and delta_block_size(st.st_size) == builder.block_size:
+        get_signature_cache().put(filename, st, builder.result())
+    return jsonify({'message': '上传成功', 'files': [filename], 'copied': copied, 'literal': literal})
+
+
+@app.route('/thumb/<path:filename>')
+@requires_auth
+def thumb(filename):
+    """图片缩略图（JPEG，长边不超过 THUMB_SIZE）"""
+    filename = safe_path(filename)
+    if not filename or resolve_file(filename) is None:
+        return jsonify({'error': '无效的文件名'}), 400
+    path, key = get_thumbnail_cache().get(filename)
+    if path is None:
+        return jsonify({'error': '无法生成预览'}), 404
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        # 刚好被其它进程淘汰
+        return jsonify({'error': '无法生成预览'}), 404
+    resp = Response(data, mimetype='image/jpeg')
+    resp.set_etag(key)
+    # 页面请求时带上 mtime 参数，原图变化后 URL 随之变化
+    resp.headers['Cache-Control'] = 'private, max-age=86400'
+    return resp.make_conditional(request)
+
+
+@app.route('/download/<path:filename>')
+@requires_auth
+def download(filename):
+    """文件下载接口（支持单区间/多区间 Range、If-Range 和条件请求，?compress=1 时压缩传输）"""
+    # 防止路径遍历攻击（包括经符号链接目录逃出共享目录）
+    filename = safe_path(filename)
+    if CLUSTER is not None and filename and not arg_flag(request.args, 'local'):
+        target = CLUSTER.redirect(filename, request.args, 'Range' not in request.headers)
+        if target is not None:
+            return redirect(target, 307)
+    filepath = resolve_file(filename) if filename else None
+    if filepath is None:
+        return jsonify({'error': '文件不存在'}), 404
+    
+    try:
+        plan = DownloadPlan.build(filepath, filename, request.headers, HOT_CACHE, arg_flag(request.args, 'compress'))
+    except OSError:
+        return jsonify({'error': '文件不存在'}), 404
+    
+    if CATALOG is not None and request.method == 'GET' and plan.status == 200:
+        CATALOG.record_download(filename)
+    flow = open_flow(request.remote_addr, None if plan.stream is not None else plan.length)
+    return download_response(plan, request.environ, flow)
+
+
+@app.route('/api/cache')
+@requires_auth
+def api_cache():
+    """热点文件缓存的状态和命中率"""
+    if HOT_CACHE is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **HOT_CACHE.stats()})
+
+
+@app.route('/api/metrics')
+@requires_auth
+def api_metrics():
+    """请求耗时、传输和缓存指标：默认为 Prometheus 文本格式，?format=json 或 Accept: application/json 时返回 JSON"""
+    metrics = get_metrics()
+    if request.args.get('format') == 'json' or \
+            request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json':
+        return jsonify(metrics.snapshot())
+    resp = Response(metrics.render(), mimetype='text/plain')
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+class _ArchiveBuffer:
+    """只写、不可 seek 的文件对象，收集 zipfile 写出的数据供生成器逐块取走"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _is_compressed(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def iter_zip(entries, compress=True):
+    """边读文件边生成 ZIP 流（使用数据描述符，不需要回写文件头）
+
+    entries 为 [(路径, 归档内名称)]；已压缩的媒体和归档文件直接存储，
+    其余文件用最快的 deflate 级别压缩。
+    """
+    import zipfile
+
+    buf = _ArchiveBuffer()
+    with zipfile.ZipFile(buf, 'w', allowZip64=True) as zf:
+        for path, arcname in entries:
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                continue
+            with f:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                if compress and not _is_compressed(arcname):
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    # ZipFile.open(ZipInfo) 不会套用 ZipFile 的 compresslevel，只能设在 ZipInfo 上
+                    info._compresslevel = ARCHIVE_COMPRESSLEVEL
+                else:
+                    info.compress_type = zipfile.ZIP_STORED
+                with zf.open(info, 'w') as dest:
+                    while True:
+                        data = f.read(COPY_BUFFER)
+                        if not data:
+                            break
+                        dest.write(data)
+                        chunk = buf.take()
+                        if chunk:
+                            yield chunk
+            chunk = buf.take()
+            if chunk:
+                yield chunk
+    yield buf.take()
+
+
+def iter_tar(entries):
+    """边读文件边生成 TAR 流（PAX 格式，支持长文件名和中文文件名）
+
+    tarfile.addfile 会一次把整个文件写进输出，这里手工写成员头和数据块，
+    保证内存占用与文件大小无关。
+    """
+    import tarfile
+
+    for path, arcname in entries:
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            continue
+        with f:
+            st = os.fstat(f.fileno())
+            info = tarfile.TarInfo(arcname)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            remaining = info.size
+            while remaining > 0:
+                data = f.read(min(COPY_BUFFER, remaining))
+                if not data:
+                    # 打包期间文件被截短，用零补齐以保持归档结构完整
+                    data = bytes(min(COPY_BUFFER, remaining))
+                remaining -= len(data)
+                yield data
+            if info.size % tarfile.BLOCKSIZE:
+                yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield bytes(tarfile.BLOCKSIZE * 2)
+
+
+def walk_files(rel):
+    """递归列出子目录 rel 下的所有文件，生成 (路径, 相对路径)；不进入符号链接目录和内部状态目录"""
+    top = resolve_dir(rel)
+    if top is None:
+        return
+    for root, dirs, files in os.walk(top):
+        sub = os.path.relpath(root, top)
+        prefix = rel if sub == '.' else posixpath.join(rel, *sub.split(os.sep))
+        dirs[:] = sorted(d for d in dirs if d != STATE_DIR_NAME)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                yield path, posixpath.join(prefix, name)
+
+
+@app.route('/download-archive', methods=['GET', 'POST'])
+@requires_auth
+def download_archive():
+    """把多个文件或整个目录打包成 ZIP/TAR 流式下载
+
+    参数 names（可重复，相对于共享目录）指定文件或目录，目录递归打包；all=1 表示
+    path 指定的整个目录（默认为共享目录本身）。归档内的名称相对于 path。
+    format 为 zip（默认）或 tar，compress=0 时 ZIP 内所有文件都只存储不压缩。
+    """
+    params = request.values
+    fmt = params.get('format', 'zip')
+    if fmt not in ('zip', 'tar'):
+        return jsonify({'error': '不支持的归档格式'}), 400
+    base = safe_path(params.get('path', ''))
+    if base is None:
+        return jsonify({'error': '无效的路径'}), 400
+    sources = []
+    if params.get('all') in ('1', 'true'):
+        sources.extend(walk_files(base))
+    for name in params.getlist('names'):
+        # 防止路径遍历攻击
+        name = safe_path(name)
+        if not name:
+            continue
+        if resolve_dir(name) is not None:
+            sources.extend(walk_files(name))
+            continue
+        path = resolve_file(name)
+        if path is not None and os.path.isfile(path):
+            sources.append((path, name))
+    entries = []
+    seen = set()
+    for path, name in sources:
+        if name in seen:
+            continue
+        seen.add(name)
+        if base and name.startswith(base + '/'):
+            name = name[len(base) + 1:]
+        entries.append((path, name))
+    if not entries:
+        return jsonify({'error': '没有可下载的文件'}), 404
+
+    if fmt == 'zip':
+        body = iter_zip(entries, compress=params.get('compress', '1') != '0')
+        mimetype = 'application/zip'
+    else:
+        body = iter_tar(entries)
+        mimetype = 'application/x-tar'
+    if len(entries) == 1:
+        download_name = posixpath.basename(entries[0][1])
+    elif base and params.get('all') in ('1', 'true'):
+        download_name = posixpath.basename(base)
+    else:
+        download_name = time.strftime('quickshare-%Y%m%d-%H%M%S')
+    flow = open_flow(request.remote_addr)
+    resp = Response(throttle_iter(body, flow), mimetype=mimetype, direct_passthrough=True)
+    # 响应体一次都没被迭代（如客户端提前断开）时生成器的 finally 不会执行
+    resp.call_on_close(flow.close)
+    resp.headers['Content-Disposition'] = content_disposition(f'{download_name}.{fmt}')
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+def query_files(cache, args):
+    """按请求参数分页查询目录 cache 中的文件列表，参数无效时抛出 ValueError"""
+    sort = args.get('sort', 'name')
+    if sort not in SORT_FIELDS:
+        raise ValueError('sort')
+    reverse = args.get('order', 'asc') == 'desc'
+    limit = min(max(int(args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    cursor = args.get('cursor')
+    cursor = decode_cursor(cursor, sort) if cursor else None
+    items, next_key, total = cache.page(
+        sort=sort, reverse=reverse, cursor=cursor, limit=limit,
+        prefix=args.get('prefix', ''), query=args.get('q', ''))
+    return {
+        'files': items,
+        'next': encode_cursor(sort, next_key) if next_key is not None else None,
+        'total': total,
+    }
+
+
+PAGE_PARAMS = ('limit', 'cursor', 'sort', 'order', 'prefix', 'q')
+
+
+@app.route('/api/files')
+@requires_auth
+def api_files():
+    """获取文件列表 API（支持分页、排序、过滤以及 ETag / If-None-Match）
+
+    ?path= 指定子目录。不带分页参数时返回完整列表；带 limit/cursor/sort/order/prefix/q
+    中任一参数时返回一页结果和下一页游标 next。第一页和完整列表同时返回子目录 dirs。
+    集群模式下合并其它节点上的文件，这些文件带 nodes 字段。
+    """
+    path = safe_path(request.args.get('path', ''))
+    cache = get_listing(path) if path is not None else None
+    if cache is None:
+        return jsonify({'error': '目录不存在'}), 404
+    paged = any(name in request.args for name in PAGE_PARAMS)
+    if paged:
+        # 分页结果的 ETag 只依赖版本号和查询参数，不必为整个目录计算摘要
+        cache.refresh()
+        version = cache.version
+        params = '&'.join(f'{k}={request.args[k]}' for k in PAGE_PARAMS if k in request.args)
+        digest = hashlib.blake2b(params.encode(), digest_size=6).hexdigest()
+        etag = f'{cache.epoch}.{version}.{digest}'
+    else:
+        files, etag, version = cache.snapshot()
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    elif paged:
+        try:
+            result = query_files(cache, request.args)
+        except ValueError:
+            return jsonify({'error': '无效的分页参数'}), 400
+        result['version'] = version
+        result['path'] = path
+        if not request.args.get('cursor'):
+            result['dirs'] = cache.dirs()
+        resp = jsonify(result)
+    else:
+        resp = jsonify({'files': files, 'dirs': cache.dirs(), 'path': path, 'version': version})
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@app.route('/api/cluster')
+@requires_auth
+def api_cluster():
+    """集群状态：本节点 ID、当前下载数以及发现的其它节点"""
+    if CLUSTER is None:
+        return jsonify({'error': '未启用 --cluster'}), 404
+    resp = jsonify(CLUSTER.status())
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+@app.route('/api/cluster/catalog')
+@requires_auth
+def api_cluster_catalog():
+    """本节点的完整文件清单（含已知的 sha256），供集群中的其它节点拉取"""
+    if CLUSTER is None:
+        return jsonify({'error': '未启用 --cluster'}), 404
+    version, files = CLUSTER.catalog()
+    etag = f'{CLUSTER.node}.{version}'
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify({'node': CLUSTER.node, 'version': version, 'files': files})
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@app.route('/api/search')
+@requires_auth
+def api_search():
+    """在整个共享目录（含子目录）中按文件名搜索
+
+    q 为空格分隔的关键词，path 限定子目录，limit 为最多返回的结果数。索引尚未
+    遍历完整个目录树时 ready 为 false，结果可能不完整。
+    """
+    query = request.args.get('q', '').strip()
+    path = safe_path(request.args.get('path', ''))
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_LIMIT)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': '无效的 limit 参数'}), 400
+    if path is None:
+        return jsonify({'error': '无效的路径'}), 400
+    index = get_search_index()
+    started = time.perf_counter()
+    results, total = index.search(query, limit, path)
+    resp = jsonify({'query': query, 'results': results, 'total': total, 'ready': index.ready.is_set(),
+                    'took_ms': round((time.perf_counter() - started) * 1000, 3)})
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+@app.route('/api/info/<path:filename>')
+@requires_auth
+def api_info(filename):
+    """文件目录数据库中的文件记录：sha256、上传时间、上传者和下载次数（需要 --catalog）"""
+    import sqlite3
+
+    if CATALOG is None:
+        return jsonify({'error': '未启用 --catalog'}), 404
+    filename = safe_path(filename)
+    if not filename or resolve_file(filename) is None:
+        return jsonify({'error': '文件不存在'}), 404
+    try:
+        info = CATALOG.info(filename)
+    except sqlite3.Error as e:
+        return jsonify({'error': f'读取文件目录数据库失败: {e}'}), 500
+    if info is None:
+        return jsonify({'error': '文件尚未登记，请稍后再试'}), 404
+    info['ready'] = CATALOG.ready.is_set()
+    resp = jsonify(info)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+def sse_message(event, data, event_id=None):
+    """编码一条 Server-Sent Events 消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+
+def pending_events(cache, version):
+    """返回 version 之后需要推送的 SSE 消息列表和推送后的版本号"""
+    pending = cache.changes_since(version)
+    if pending is None:
+        version = cache.version
+        return [sse_message('reset', {'version': version}, version)], version
+    messages = [sse_message('change', changes, v) for v, changes in pending]
+    if pending:
+        version = pending[-1][0]
+    return messages, version
+
+
+@app.route('/api/events')
+@requires_auth
+def api_events():
+    """文件列表变更推送（Server-Sent Events）
+
+    ?path= 指定子目录。客户端重连时通过 Last-Event-ID 续传增量；服务端无法
+    提供增量时发送 reset 事件，由客户端重新拉取 /api/files。
+    """
+    path = safe_path(request.args.get('path', ''))
+    cache = get_file_cache(path) if path is not None else None
+    if cache is None:
+        return jsonify({'error': '目录不存在'}), 404
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        version = int(last_id)
+    except (TypeError, ValueError):
+        version = None
+
+    def stream():
+        nonlocal version
+        yield 'retry: 3000\n\n'
+        cache.refresh()
+        if version is None:
+            version = cache.version
+            yield sse_message('sync', {'version': version}, version)
+        while not SHUTDOWN.is_set():
+            messages, version = pending_events(cache, version)
+            # 没有变化时定期发送注释行，及时发现已断开的连接
+            yield ''.join(messages) or ': ping\n\n'
+            cache.wait_for_change(version, timeout=SSE_HEARTBEAT)
+
+    resp = Response(stream(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+def format_size(size):
+    """格式化文件大小"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024.0:
+            return f"{size:.1f} {unit}"
+        size /= 1024.0
+    return f"{size:.1f} TB"
+
+
+# ---------------------------------------------------------------------------
+# 生产模式 WSGI 服务器（--server threaded / prefork）
+# ---------------------------------------------------------------------------
+
+class SendfileWrapper:
+    """wsgi.file_wrapper 实现：由 WSGIServer 识别后用 socket.sendfile 发送
+
+    发送长度以响应的 Content-Length 为准，因此可以先 seek 到区间起点再包装。
+    """
+
+    def __init__(self, filelike, blksize=COPY_BUFFER):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.flow = Flow(None, None)
+
+    def __iter__(self):
+        while True:
+            buf = self.filelike.read(self.blksize)
+            if not buf:
+                return
+            self.flow.throttle(len(buf))
+            yield buf
+
+    def close(self):
+        self.filelike.close()
+        self.flow.close()
+
+
+class _RequestBody:
+    """按 Content-Length 限制读取的请求体，响应结束后可丢弃剩余部分以复用连接
+
+    客户端发送了 Expect: 100-continue 时，直到应用第一次读取请求体才回复
+    100 Continue，这样在准入检查中被拒绝的上传不会先把数据发过来。
+    """
+
+    def __init__(self, rfile, length, wfile=None):
+        self.rfile = rfile
+        self.remaining = length
+        self._continue = wfile
+
+    def _send_continue(self):
+        if self._continue is not None:
+            self._continue.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            self._continue = None
+
+    def awaiting_continue(self):
+        """还没有回复 100 Continue 而请求体没有读完，此时连接无法复用"""
+        return self._continue is not None and self.remaining > 0
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        self._send_continue()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readline(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        self._send_continue()
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        """读掉剩余请求体，超过 limit 字节时放弃并返回 False"""
+        if self.remaining > limit or self.awaiting_continue():
+            # 没有回复 100 Continue 时客户端可能根本不会发送请求体，只能关闭连接
+            return False
+        while self.remaining > 0:
+            if not self.read(COPY_BUFFER):
+                return False
+        return True
+
+
+class _ChunkedBody(_RequestBody):
+    """Transfer-Encoding: chunked 请求体（与 _AsyncBody 相同，忽略分块扩展并丢弃 trailer）"""
+
+    def __init__(self, rfile, wfile=None):
+        super().__init__(rfile, 0, wfile)
+        self.done = False
+        self._chunk_left = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(COPY_BUFFER), b''))
+        if self.done:
+            return b''
+        self._send_continue()
+        if self._chunk_left == 0:
+            line = self.rfile.readline(65537)
+            try:
+                self._chunk_left = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ConnectionError('invalid chunk')
+            if self._chunk_left < 0:
+                raise ConnectionError('invalid chunk')
+            if self._chunk_left == 0:
+                # 丢弃 trailer 直到空行
+                while self.rfile.readline(65537).strip():
+                    pass
+                self.done = True
+                return b''
+        data = self.rfile.read(min(size, self._chunk_left))
+        if not data:
+            raise ConnectionError('body truncated')
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            self.rfile.read(2)
+        return data
+
+    def readline(self, size=-1):
+        # 按块返回即可满足 WSGI 的用法
+        return self.read(COPY_BUFFER if size is None or size < 0 else size)
+
+    def awaiting_continue(self):
+        return self._continue is not None and not self.done
+
+    def drain(self, limit):
+        if self.awaiting_continue():
+            return False
+        while not self.done:
+            data = self.read(COPY_BUFFER)
+            limit -= len(data)
+            if limit < 0:
+                return False
+        return True
+
+
+class _Connection:
+    """一个客户端连接，在多次 keep-alive 请求之间保持读写缓冲"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rfile = sock.makefile('rb', COPY_BUFFER)
+        self.wfile = sock.makefile('wb', 0)
+        self.idle_since = time.monotonic()
 
-        uploadArea.addEventListener('dragover', (e) => {
-            e.preventDefault();
-            uploadArea.classList.add('dragover');
-        });
+    def has_buffered_data(self):
+        """读缓冲里是否已有下一个请求（HTTP 流水线），不阻塞"""
+        self.sock.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except (BlockingIOError, OSError, ValueError):
+            return False
+        finally:
+            try:
+                self.sock.setblocking(True)
+            except OSError:
+                pass
 
-        uploadArea.addEventListener('dragleave', () => {
-            uploadArea.classList.remove('dragover');
-        });
+    def close(self):
+        for f in (self.rfile, self.wfile):
+            try:
+                f.close()
+            except OSError:
+                pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
 
-        uploadArea.addEventListener('drop', (e) => {
-            e.preventDefault();
-            uploadArea.classList.remove('dragover');
-            handleFiles(e.dataTransfer.files);
-        });
 
-        fileInput.addEventListener('change', (e) => {
-            handleFiles(e.target.files);
-        });
+def make_wsgi_environ(method, target, version, headers, body, client_address,
+                      server_name, server_port, multiprocess=False):
+    """由已解析的请求行和请求头构造 WSGI environ"""
+    path, _, query = target.partition('?')
+    environ = {
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': multiprocess,
+        'wsgi.run_once': False,
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': url_unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': str(server_name),
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': client_address[0],
+        'REMOTE_PORT': str(client_address[1]),
+    }
+    for key, value in headers:
+        key = key.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+            continue
+        key = 'HTTP_' + key
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    if environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+        environ['wsgi.input_terminated'] = True
+    return environ
 
-        async function handleFiles(files) {
-            if (files.length === 0) return;
 
-            progressBar.style.display = 'block';
-            uploadStatus.style.display = 'none';
-            progressFill.style.width = '0%';
+class WSGIRequestHandler(http.server.BaseHTTPRequestHandler):
+    """处理连接上的一个 HTTP/1.1 请求并调用 WSGI 应用"""
 
-            const formData = new FormData();
-            for (let file of files) {
-                formData.append('files', file);
-            }
+    protocol_version = 'HTTP/1.1'
+    server_version = 'QuickShare'
+    # 不支持 HTTP/0.9：无法解析的请求行也回复带状态行的 400，而不是只有 HTML 的 0.9 响应
+    default_request_version = 'HTTP/1.0'
 
-            try {
-                const xhr = new XMLHttpRequest();
-                xhr.upload.addEventListener('progress', (e) => {
-                    if (e.lengthComputable) {
-                        const percent = (e.loaded / e.total) * 100;
-                        progressFill.style.width = percent + '%';
-                    }
-                });
+    def __init__(self, conn, server):
+        # 不调用 StreamRequestHandler 的构造函数：连接由 WSGIServer 管理
+        self.conn = conn
+        self.request = self.connection = conn.sock
+        self.client_address = conn.addr
+        self.server = server
+        self.rfile = conn.rfile
+        self.wfile = conn.wfile
+        self.detached = False
 
-                xhr.addEventListener('load', () => {
-                    progressFill.style.width = '100%';
-                    if (xhr.status === 200) {
-                        uploadStatus.className = 'upload-status success';
-                        uploadStatus.textContent = '上传成功！页面将自动刷新...';
-                        setTimeout(() => location.reload(), 1000);
-                    } else {
-                        uploadStatus.className = 'upload-status error';
-                        uploadStatus.textContent = '上传失败: ' + xhr.responseText;
-                    }
-                });
+    def handle_request(self):
+        """处理一个请求，返回连接是否可以继续复用"""
+        self.close_connection = True
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            return False
+        if not self.raw_requestline:
+            return False
+        if len(self.raw_requestline) > 65536:
+            # 与 BaseHTTPRequestHandler.handle_one_request 相同，send_error 要用到这几个属性
+            self.requestline = self.command = ''
+            self.request_version = self.default_request_version
+            self.send_error(414)
+            return False
+        if not self.parse_request():
+            return False
+        self.run_wsgi()
+        return not self.close_connection and not self.server.stopping
 
-                xhr.addEventListener('error', () => {
-                    uploadStatus.className = 'upload-status error';
-                    uploadStatus.textContent = '上传失败，请重试';
-                });
+    def handle_expect_100(self):
+        # 推迟到应用读取请求体时再回复 100 Continue，见 _RequestBody
+        return True
 
-                const url = '/upload' + (token ? '?token=' + token : '');
-                xhr.open('POST', url);
-                xhr.send(formData);
-            } catch (error) {
-                uploadStatus.className = 'upload-status error';
-                uploadStatus.textContent = '上传失败: ' + error.message;
-            }
-        }
+    def make_environ(self):
+        expect = self.request_version >= 'HTTP/1.1' and \
+            self.headers.get('Expect', '').lower() == '100-continue'
+        wfile = self.wfile if expect else None
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = _ChunkedBody(self.rfile, wfile)
+        else:
+            try:
+                length = max(int(self.headers.get('Content-Length') or 0), 0)
+            except ValueError:
+                length = 0
+            body = _RequestBody(self.rfile, length, wfile)
+        environ = make_wsgi_environ(self.command, self.path, self.request_version, self.headers.items(),
+                                    body, self.client_address, self.server.server_name,
+                                    self.server.server_port, self.server.multiprocess)
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+        return environ
 
-        // 定期刷新文件列表
-        setInterval(() => {
-            fetch('/api/files' + (token ? '?token=' + token : ''))
-                .then(r => r.json())
-                .then(data => {
-                    const fileList = document.getElementById('fileList');
-                    fileList.innerHTML = data.files.map(file => `
-                        <li class="file-item">
-                            <span class="file-name">${file.name}</span>
-                            <span class="file-size">${file.size}</span>
-                            <div class="file-actions">
-                                <a href="/download/${encodeURIComponent(file.name)}?token=${token}" download>下载</a>
-                            </div>
-                        </li>
-                    `).join('');
-                })
-                .catch(err => console.error('刷新文件列表失败:', err));
-        }, 5000);
-    </script>
-</body>
-</html>
-"""
+    def run_wsgi(self):
+        environ = self.make_environ()
+        state = {'status': None, 'headers': None, 'sent': False, 'chunked': False, 'length': None}
 
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            state['status'], state['headers'] = status, headers
+            return write
 
-@app.route('/')
-@requires_auth
-def index():
-    """主页面"""
-    files = []
-    for item in os.listdir(UPLOAD_DIR):
-        item_path = os.path.join(UPLOAD_DIR, item)
-        if os.path.isfile(item_path):
-            size = os.path.getsize(item_path)
-            size_str = format_size(size)
-            files.append({'name': item, 'size': size_str})
-    
-    token = request.cookies.get('auth_token') or request.args.get('token', '')
-    return render_template_string(MAIN_PAGE, files=files, current_dir=UPLOAD_DIR, token=token)
+        def send_headers():
+            code, _, reason = state['status'].partition(' ')
+            code = int(code)
+            self.send_response(code, reason)
+            names = set()
+            for key, value in state['headers']:
+                if key.lower() == 'connection':
+                    continue
+                self.send_header(key, value)
+                names.add(key.lower())
+            if 'content-length' in names:
+                state['length'] = int(dict((k.lower(), v) for k, v in state['headers'])['content-length'])
+            elif not (self.command == 'HEAD' or code < 200 or code in (204, 304)):
+                if self.request_version >= 'HTTP/1.1':
+                    state['chunked'] = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                else:
+                    self.close_connection = True
+            if self.close_connection or self.server.stopping or environ['wsgi.input'].awaiting_continue():
+                self.close_connection = True
+                self.send_header('Connection', 'close')
+            elif self.request_version < 'HTTP/1.1':
+                self.send_header('Connection', 'keep-alive')
+            self.end_headers()
+            state['sent'] = True
 
+        def write(data):
+            if not state['sent']:
+                send_headers()
+            if not data:
+                return
+            if state['chunked']:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    """登录页面"""
-    if AUTH_TOKEN is None:
-        return '', 404
-    
-    error = request.args.get('error')
-    
-    if request.method == 'POST':
-        password = request.form.get('password')
-        if password == AUTH_TOKEN:
-            resp = Response('', 302)
-            resp.headers['Location'] = '/?token=' + AUTH_TOKEN
-            resp.set_cookie('auth_token', AUTH_TOKEN, max_age=3600)
-            return resp
+        try:
+            result = self.server.app(environ, start_response)
+        except Exception:
+            self.log_error('应用异常')
+            traceback.print_exc()
+            self.close_connection = True
+            return
+        content_type = next((v for k, v in state['headers'] or () if k.lower() == 'content-type'), '')
+        if content_type.startswith('text/event-stream'):
+            # SSE 长连接不占用线程池：交给独立线程推送，结束后关闭连接
+            self.close_connection = self.detached = True
+            self.server.detach(self.conn, lambda: self.send_result(environ, state, result, send_headers, write))
+            return
+        self.send_result(environ, state, result, send_headers, write)
+
+    def send_result(self, environ, state, result, send_headers, write):
+        """把应用返回的响应体写到连接上"""
+        try:
+            if isinstance(result, SendfileWrapper) and self.command != 'HEAD':
+                send_headers()
+                if state['length'] is not None and not state['chunked']:
+                    sendfile_throttled(self.connection, result.filelike, result.filelike.tell(),
+                                       state['length'], result.flow)
+                else:
+                    for data in result:
+                        write(data)
+            else:
+                for data in result:
+                    write(data)
+            if not state['sent']:
+                send_headers()
+            if state['chunked']:
+                self.wfile.write(b'0\r\n\r\n')
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+        except Exception:
+            self.log_error('应用异常')
+            traceback.print_exc()
+            self.close_connection = True
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not self.close_connection and not environ['wsgi.input'].drain(COPY_BUFFER):
+            self.close_connection = True
+
+
+class WSGIServer:
+    """带有界线程池和 keep-alive 轮询的 WSGI 服务器
+
+    主线程只负责 accept 和监视空闲的 keep-alive 连接，连接上有请求到达时才
+    交给线程池处理，所以空闲连接不占用工作线程。shutdown() 之后停止接受
+    新连接、关闭空闲连接，等待进行中的传输完成（最多 graceful_timeout 秒）。
+    """
+
+    def __init__(self, app, listener, threads=32, keepalive=5.0, timeout=60.0,
+                 graceful_timeout=30.0, multiprocess=False):
+        self.app = app
+        self.listener = listener
+        self.threads = threads
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.graceful_timeout = graceful_timeout
+        self.multiprocess = multiprocess
+        self.server_name, self.server_port = listener.getsockname()[:2]
+        self.stopping = False
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='quickshare')
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._active = set()
+        self._idle = set()
+        self._returned = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+
+    def shutdown(self):
+        """开始优雅退出（可在信号处理函数或其他线程中调用）"""
+        self.stopping = True
+        SHUTDOWN.set()
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def _serve_connection(self, conn):
+        """在工作线程中处理连接上的请求，可复用时把连接交回主线程等待"""
+        keep = False
+        try:
+            while True:
+                conn.sock.settimeout(self.timeout)
+                handler = WSGIRequestHandler(conn, self)
+                keep = handler.handle_request()
+                if handler.detached:
+                    return
+                if not keep or not conn.has_buffered_data():
+                    break
+        except Exception:
+            keep = False
+        with self._lock:
+            self._active.discard(conn)
+            if keep and not self.stopping:
+                conn.idle_since = time.monotonic()
+                self._returned.append(conn)
+        if keep and not self.stopping:
+            self._wake()
         else:
-            resp = Response('', 302)
-            resp.headers['Location'] = '/login?error=密码错误，请重试'
-            return resp
-    
-    return render_template_string(LOGIN_PAGE, error=error)
+            conn.close()
+            if self.stopping:
+                self._wake()
 
+    def detach(self, conn, respond):
+        """在线程池之外的独立线程中完成长连接响应（SSE），不受 threads 限制"""
 
-@app.route('/upload', methods=['POST'])
-@requires_auth
-def upload():
-    """文件上传接口"""
-    if 'files' not in request.files:
-        return jsonify({'error': '没有文件'}), 400
-    
-    files = request.files.getlist('files')
-    uploaded = []
-    
-    for file in files:
-        if file.filename:
-            filename = file.filename
-            # 防止路径遍历攻击
-            filename = os.path.basename(filename)
-            filepath = os.path.join(UPLOAD_DIR, filename)
-            file.save(filepath)
-            uploaded.append(filename)
-    
-    return jsonify({'message': '上传成功', 'files': uploaded})
+        def run():
+            try:
+                respond()
+            finally:
+                with self._lock:
+                    self._active.discard(conn)
+                conn.close()
+                if self.stopping:
+                    self._wake()
 
+        threading.Thread(target=run, name='quickshare-stream', daemon=True).start()
 
-@app.route('/download/<filename>')
-@requires_auth
-def download(filename):
-    """文件下载接口"""
-    # 防止路径遍历攻击
-    filename = os.path.basename(filename)
-    filepath = os.path.join(UPLOAD_DIR, filename)
-    
-    if not os.path.isfile(filepath):
-        return jsonify({'error': '文件不存在'}), 404
-    
-    return send_file(filepath, as_attachment=True)
+    def _dispatch(self, conn):
+        with self._lock:
+            self._active.add(conn)
+        self._pool.submit(self._serve_connection, conn)
 
+    def serve_forever(self):
+        self.listener.setblocking(False)
+        self._selector.register(self.listener, selectors.EVENT_READ, 'accept')
+        self._selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+        listening = True
+        deadline = None
+        try:
+            while True:
+                try:
+                    events = self._selector.select(timeout=1.0)
+                except KeyboardInterrupt:
+                    if self.stopping:
+                        raise
+                    self.shutdown()
+                    continue
+                for key, _ in events:
+                    if key.data == 'accept':
+                        self._accept()
+                    elif key.data == 'wake':
+                        try:
+                            while self._wake_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        conn = key.data
+                        self._selector.unregister(conn.sock)
+                        self._idle.discard(conn)
+                        self._dispatch(conn)
+                with self._lock:
+                    returned = list(self._returned)
+                    self._returned.clear()
+                for conn in returned:
+                    self._idle.add(conn)
+                    self._selector.register(conn.sock, selectors.EVENT_READ, conn)
+                now = time.monotonic()
+                for conn in [c for c in self._idle if self.stopping or now - c.idle_since > self.keepalive]:
+                    self._selector.unregister(conn.sock)
+                    self._idle.discard(conn)
+                    conn.close()
+                if self.stopping:
+                    if listening:
+                        self._selector.unregister(self.listener)
+                        listening = False
+                        deadline = now + self.graceful_timeout
+                    with self._lock:
+                        active = list(self._active)
+                    if not active:
+                        break
+                    if now >= deadline:
+                        # 超时仍未完成的传输只能中断
+                        for conn in active:
+                            try:
+                                conn.sock.shutdown(socket.SHUT_RDWR)
+                            except OSError:
+                                pass
+                        break
+        finally:
+            self._selector.close()
+            self._pool.shutdown(wait=True)
+            self.listener.close()
 
-@app.route('/api/files')
-@requires_auth
-def api_files():
-    """获取文件列表 API"""
-    files = []
-    for item in os.listdir(UPLOAD_DIR):
-        item_path = os.path.join(UPLOAD_DIR, item)
-        if os.path.isfile(item_path):
-            size = os.path.getsize(item_path)
-            size_str = format_size(size)
-            files.append({'name': item, 'size': size_str})
-    
-    return jsonify({'files': files})
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            sock.setblocking(True)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._dispatch(_Connection(sock, addr))
 
 
-def format_size(size):
-    """格式化文件大小"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size < 1024.0:
-            return f"{size:.1f} {unit}"
-        size /= 1024.0
-    return f"{size:.1f} TB"
+def create_listener(host, port, backlog):
+    """创建监听套接字"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def serve_threaded(app, host, port, threads, keepalive, backlog, graceful_timeout, timeout):
+    """单进程、有界线程池模式"""
+    server = WSGIServer(app, create_listener(host, port, backlog), threads=threads,
+                        keepalive=keepalive, timeout=timeout, graceful_timeout=graceful_timeout)
+
+    def stop(signum, frame):
+        # 第一次 Ctrl+C 优雅退出，再按一次立即退出
+        if server.stopping:
+            raise KeyboardInterrupt
+        print("\n正在等待进行中的传输完成，再按一次 Ctrl+C 立即退出...")
+        server.shutdown()
+
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+
+
+def serve_prefork(app, host, port, workers, threads, keepalive, backlog, graceful_timeout, timeout):
+    """预派生多进程模式：父进程创建监听套接字后 fork 出 workers 个子进程共同 accept
+
+    Ctrl+C / SIGTERM 会转发给所有子进程，各自优雅退出；子进程意外退出时自动补上。
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError('当前平台不支持 prefork 模式，请使用 --server threaded')
+    listener = create_listener(host, port, backlog)
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            server = WSGIServer(app, listener, threads=threads, keepalive=keepalive, timeout=timeout,
+                                graceful_timeout=graceful_timeout, multiprocess=True)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+            signal.signal(signal.SIGINT, lambda signum, frame: server.shutdown())
+            code = 0
+            try:
+                server.serve_forever()
+            except BaseException:
+                code = 1
+            os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    deadline = None
+    while children:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + graceful_timeout + 5
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in list(children):
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            time.sleep(0.2)
+            continue
+        children.pop(pid, None)
+        if not stopping:
+            # 子进程意外退出时补上一个
+            spawn()
+    listener.close()
+
+
+# ---------------------------------------------------------------------------
+# asyncio 传输引擎（--server async）
+# ---------------------------------------------------------------------------
+
+class _AsyncBody:
+    """从 asyncio.StreamReader 读取请求体（Content-Length 或 chunked）"""
+
+    def __init__(self, reader, headers, timeout, writer=None):
+        self.reader = reader
+        self.timeout = timeout
+        self.chunked = headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        try:
+            self.remaining = max(int(headers.get('Content-Length') or 0), 0)
+        except ValueError:
+            self.remaining = 0
+        self._chunk_left = 0
+        self.done = not self.chunked and self.remaining == 0
+        # 与 _RequestBody 相同，第一次读取请求体时才回复 100 Continue
+        expect = headers.get('Expect', '').lower() == '100-continue'
+        self._continue = writer if expect and not self.done else None
+
+    async def _read(self, coro):
+        import asyncio
+
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def read(self, size=COPY_BUFFER):
+        """读取最多 size 字节，结束时返回 b''；连接提前断开时抛出 ConnectionError"""
+        if self.done:
+            return b''
+        if self._continue is not None:
+            self._continue.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            self._continue = None
+        if self.chunked:
+            if self._chunk_left == 0:
+                line = await self._read(self.reader.readline())
+                try:
+                    self._chunk_left = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ConnectionError('invalid chunk')
+                if self._chunk_left == 0:
+                    # 丢弃 trailer 直到空行
+                    while (await self._read(self.reader.readline())).strip():
+                        pass
+                    self.done = True
+                    return b''
+            data = await self._read(self.reader.read(min(size, self._chunk_left)))
+            if not data:
+                raise ConnectionError('body truncated')
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._read(self.reader.readexactly(2))
+            return data
+        data = await self._read(self.reader.read(min(size, self.remaining)))
+        if not data:
+            raise ConnectionError('body truncated')
+        self.remaining -= len(data)
+        self.done = self.remaining == 0
+        return data
+
+    def awaiting_continue(self):
+        """还没有回复 100 Continue 而请求体没有读完，此时连接无法复用"""
+        return self._continue is not None
+
+    async def drain(self, limit):
+        """读掉剩余请求体，超过 limit 字节时返回 False"""
+        if self.awaiting_continue():
+            return False
+        while not self.done:
+            data = await self.read()
+            limit -= len(data)
+            if limit < 0:
+                return False
+        return True
+
+
+# 异步引擎自己处理的请求：(路由, 方法, 开始时间)，每个连接的任务各有一份
+_REQUEST_TIMING = contextvars.ContextVar('quickshare_request_timing', default=None)
+
+
+class AsyncServer:
+    """基于 asyncio 的传输引擎
+
+    套接字 I/O 全部非阻塞：下载用 loop.sendfile 发送文件区间，上传边收边交给
+    小线程池写盘，/api/events 用定时器轮询目录缓存，因此成千上万个慢速连接
+    只占用协程而不占用线程。其他路由（页面、登录、列表等）交给 Flask 应用在
+    app 线程池中处理，请求体经有界的 ChunkPipe 边收边读，响应逐块写回。
+    """
+
+    def __init__(self, app, host, port, threads=32, io_threads=4, keepalive=5.0, timeout=60.0,
+                 backlog=1024, graceful_timeout=30.0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.io_pool = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='quickshare-io')
+        self.app_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='quickshare-app')
+        self.stopping = False
+        self._busy = 0
+        self._idle = set()
+        self._stop_event = None
+        self._loop = None
+        self._refreshing = {}  # DirectoryCache -> 进行中的 refresh
+
+    def run(self):
+        import asyncio
+
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """停止服务（可以从其他线程调用）"""
+        if self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def serve(self):
+        import asyncio
+
+        loop = self._loop = asyncio.get_running_loop()
+        loop.set_default_executor(self.io_pool)
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                            backlog=self.backlog, limit=65536)
+        for signum in (signal.SIGINT, getattr(signal, 'SIGTERM', None)):
+            if signum is None:
+                continue
+            try:
+                loop.add_signal_handler(signum, self._on_signal)
+            except (NotImplementedError, RuntimeError):
+                pass
+        async with server:
+            await self._stop_event.wait()
+            self.stopping = True
+            SHUTDOWN.set()
+            server.close()
+            for writer in list(self._idle):
+                writer.close()
+            deadline = loop.time() + self.graceful_timeout
+            while self._busy and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+        self.app_pool.shutdown(wait=False)
+        self.io_pool.shutdown(wait=False)
+
+    def _on_signal(self):
+        if self.stopping:
+            # 第二次 Ctrl+C 立即退出
+            os._exit(1)
+        print("\n正在等待进行中的传输完成，再按一次 Ctrl+C 立即退出...")
+        self._stop_event.set()
+
+    async def _handle_client(self, reader, writer):
+        import asyncio
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        client = writer.get_extra_info('peername') or ('', 0)
+        first = True
+        try:
+            while not self.stopping:
+                self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  self.timeout if first else self.keepalive)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    self._idle.discard(writer)
+                first = False
+                self._busy += 1
+                try:
+                    keep = await self._handle_request(reader, writer, head, client)
+                except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    keep = False
+                except Exception:
+                    traceback.print_exc()
+                    keep = False
+                finally:
+                    self._busy -= 1
+                if not keep:
+                    break
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader, writer, head, client):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            await self._send_simple(writer, 400, 'HTTP/1.0', False, b'Bad Request')
+            return False
+        headers = Headers()
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers.add(key.strip(), value.strip())
+        connection = headers.get('Connection', '').lower()
+        keep = (version == 'HTTP/1.1' and 'close' not in connection) or \
+               (version == 'HTTP/1.0' and 'keep-alive' in connection)
+        body = _AsyncBody(reader, headers, self.timeout, writer if version == 'HTTP/1.1' else None)
+
+        path, _, query = target.partition('?')
+        path = url_unquote(path)
+        args = dict(parse_qsl(query, keep_blank_values=True))
+        token = parse_cookie(headers.get('Cookie', '')).get('auth_token') or args.get('token')
+        authorized = AUTH_TOKEN is None or bool(token and check_auth(token)) or check_ticket(path, args.get('ticket'))
+
+        handled = None
+        if authorized:
+            # 与 Flask 路由相同的路由名，响应头发出时由 _head 记录耗时
+            started = time.perf_counter()
+            if method in ('GET', 'HEAD') and path.startswith('/download/'):
+                _REQUEST_TIMING.set(('/download/<path:filename>', method, started))
+                handled = await self._download(writer, method, version, path[len('/download/'):], headers, args,
+                                               client, keep)
+            elif method == 'POST' and path == '/upload':
+                _REQUEST_TIMING.set(('/upload', method, started))
+                handled = await self._upload_multipart(writer, version, headers, body, args, client, keep)
+            elif method in ('POST', 'PUT') and path == '/upload-archive':
+                _REQUEST_TIMING.set(('/upload-archive', method, started))
+                handled = await self._upload_archive(writer, version, headers, body, args, client, keep)
+            elif method == 'PUT' and path.startswith('/upload/'):
+                _REQUEST_TIMING.set(('/upload/<path:filename>', method, started))
+                handled = await self._upload_raw(writer, version, path[len('/upload/'):], headers, body, args,
+                                                 client, keep)
+            elif method == 'GET' and path == '/api/events':
+                _REQUEST_TIMING.set(('/api/events', method, started))
+                handled = await self._events(writer, version, headers, args)
+            _REQUEST_TIMING.set(None)
+        if handled is None:
+            # 其余请求（以及需要登录页、404 等标准响应的情况）交给 Flask 处理
+            handled = await self._call_wsgi(writer, method, target, version, headers, body, client, keep)
+        if handled and not self.stopping:
+            return await body.drain(COPY_BUFFER)
+        return False
+
+    def _head(self, status, version, headers, keep):
+        timing = _REQUEST_TIMING.get()
+        if timing is not None:
+            _REQUEST_TIMING.set(None)
+            route, method, started = timing
+            get_metrics().observe_request(route, method, status, time.perf_counter() - started)
+        lines = [f'{version if version == "HTTP/1.0" else "HTTP/1.1"} {status} {HTTPStatus(status).phrase}',
+                 f'Date: {http_date()}', 'Server: QuickShare']
+        lines.extend(f'{key}: {value}' for key, value in headers)
+        lines.append('Connection: ' + ('keep-alive' if keep and not self.stopping else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _send_simple(self, writer, status, version, keep, body, content_type='text/plain; charset=utf-8',
+                           headers=()):
+        writer.write(self._head(status, version, [('Content-Type', content_type),
+                                                  ('Content-Length', str(len(body))), *headers], keep) + body)
+        await writer.drain()
+        return keep
+
+    async def _send_json(self, writer, status, version, keep, data, headers=()):
+        body = json.dumps(data).encode()
+        return await self._send_simple(writer, status, version, keep, body, 'application/json', headers)
+
+    async def _send_rejected(self, writer, version, keep, error):
+        return await self._send_json(writer, error.status, version, keep, {'error': error.message},
+                                     error.headers())
+
+    async def _download(self, writer, method, version, name, headers, args, client, keep):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        filename = safe_path(name)
+        # 边压缩边发送的响应长度未知，交给 WSGI 路径分块发送
+        if not filename or arg_flag(args, 'compress'):
+            return None
+        if CLUSTER is not None and not arg_flag(args, 'local'):
+            target = CLUSTER.redirect(filename, args, 'Range' not in headers)
+            if target is not None:
+                return await self._send_simple(writer, 307, version, keep, b'', headers=[('Location', target)])
+        path = resolve_file(filename)
+        if path is None:
+            return None
+        try:
+            plan = await loop.run_in_executor(None, DownloadPlan.build, path, filename, headers, HOT_CACHE)
+        except OSError:
+            return None
+        if CATALOG is not None and method == 'GET' and plan.status == 200:
+            # 定期批量写入 SQLite 的 flush 可能等待写锁，不能在事件循环里做
+            loop.run_in_executor(None, CATALOG.record_download, filename)
+        writer.write(self._head(plan.status, version, plan.headers, keep))
+        await writer.drain()
+        if method == 'HEAD' or not plan.segments:
+            return keep
+        with open_flow(client[0], plan.length) as flow:
+            if plan.data is not None:
+                for chunk in plan.iter_memory():
+                    await flow.athrottle(len(chunk))
+                    writer.write(chunk)
+                    await writer.drain()
+                return keep
+            f = await loop.run_in_executor(None, open, plan.path, 'rb')
+            try:
+                for segment in plan.segments:
+                    if isinstance(segment, bytes):
+                        writer.write(segment)
+                        await writer.drain()
+                        continue
+                    offset, count = segment
+                    step = SCHED_QUANTUM if flow.limited else count
+                    while count > 0:
+                        n = min(count, step)
+                        await flow.athrottle(n)
+                        await loop.sendfile(writer.transport, f, offset, n)
+                        offset += n
+                        count -= n
+            finally:
+                await loop.run_in_executor(None, f.close)
+        return keep
+
+    async def _upload_multipart(self, writer, version, headers, body, args, client, keep):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        mimetype, params = parse_options_header(headers.get('Content-Type', ''))
+        directory = safe_path(args.get('path', ''))
+        if mimetype != 'multipart/form-data' or not params.get('boundary') or directory is None:
+            return None
+        size = None if body.chunked else body.remaining
+        try:
+            slot = await get_upload_admission().aadmit(client[0], size)
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, keep and not body.awaiting_continue(), e)
+        upload = MultipartUpload(params['boundary'], overwrite=wants_overwrite(args), directory=directory,
+                                 uploader=client[0])
+        flow = open_flow(client[0], size, 'in')
+        try:
+            while True:
+                chunk = await body.read()
+                slot.count(len(chunk))
+                await flow.athrottle(len(chunk))
+                # 解析和写盘都放到 I/O 线程池中，事件循环只负责收数据
+                if await loop.run_in_executor(None, upload.feed, chunk):
+                    break
+        except ValueError as e:
+            return await self._send_json(writer, 400, version, False, {'error': f'上传失败: {e}'})
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, False, e)
+        finally:
+            flow.close()
+            slot.release()
+            await loop.run_in_executor(None, upload.close)
+        uploaded = upload.result()
+        if uploaded is None:
+            return await self._send_json(writer, 400, version, keep, {'error': '没有文件'})
+        return await self._send_json(writer, 200, version, keep, {'message': '上传成功', 'files': uploaded})
+
+    async def _upload_archive(self, writer, version, headers, body, args, client, keep):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        directory = safe_path(args.get('path', ''))
+        if directory is None or (directory and not check_parent(posixpath.join(directory, ''))):
+            return None
+        size = None if body.chunked else body.remaining
+        try:
+            slot = await get_upload_admission().aadmit(client[0], size)
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, keep and not body.awaiting_continue(), e)
+        ingest = TarIngest(directory, wants_overwrite(args), client[0])
+        pipe = ChunkPipe()
+
+        def run():
+            try:
+                return ingest.run(pipe)
+            finally:
+                pipe.close()
+
+        # 解包在 I/O 线程池中进行，事件循环只负责收数据并通过有界管道交给它
+        task = loop.run_in_executor(None, run)
+        flow = open_flow(client[0], size, 'in')
+        try:
+            while not pipe.closed:
+                chunk = await body.read()
+                slot.count(len(chunk))
+                await flow.athrottle(len(chunk))
+                await loop.run_in_executor(None, pipe.put, chunk)
+                if not chunk:
+                    break
+            files, skipped = await task
+        except ValueError as e:
+            return await self._send_json(writer, 400, version, False,
+                                         {'error': f'上传失败: {e}', 'files': ingest.files})
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, False, e)
+        finally:
+            flow.close()
+            slot.release()
+            if not task.done():
+                # 请求体没有读完就出错（如连接断开）：让解包线程读到结束，清理临时文件
+                pipe.close()
+                await asyncio.wait([task])
+                task.exception()
+        if not files and not skipped:
+            return await self._send_json(writer, 400, version, keep, {'error': '没有文件'})
+        return await self._send_json(writer, 200, version, keep,
+                                     {'message': '上传成功', 'files': files, 'skipped': skipped})
+
+    async def _upload_raw(self, writer, version, name, headers, body, args, client, keep):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        filename = safe_path(name)
+        if not filename or not check_parent(filename):
+            return None
+        size = None if body.chunked else body.remaining
+        try:
+            slot = await get_upload_admission().aadmit(client[0], size)
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, keep and not body.awaiting_continue(), e)
+        upload = await loop.run_in_executor(None, UploadWriter, filename, client[0])
+        flow = open_flow(client[0], size, 'in')
+        try:
+            while True:
+                chunk = await body.read()
+                if not chunk:
+                    break
+                slot.count(len(chunk))
+                await flow.athrottle(len(chunk))
+                await loop.run_in_executor(None, upload.write, chunk)
+            filename = await loop.run_in_executor(None, upload.commit, wants_overwrite(args))
+        except ValueError as e:
+            return await self._send_json(writer, 400, version, keep, {'error': f'上传失败: {e}'})
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, False, e)
+        finally:
+            flow.close()
+            slot.release()
+            await loop.run_in_executor(None, upload.__exit__, None, None, None)
+        return await self._send_json(writer, 200, version, keep, {'message': '上传成功', 'files': [filename]})
+
+    def _refresh(self, cache):
+        """在 I/O 线程池中刷新目录缓存（扫描目录和 on_change 回调都不在事件循环里运行）
+
+        同一目录的所有 SSE 连接共用一次进行中的刷新。
+        """
+        import asyncio
+
+        future = self._refreshing.get(cache)
+        if future is None:
+            future = self._refreshing[cache] = asyncio.get_running_loop().run_in_executor(None, cache.refresh)
+            future.add_done_callback(lambda _: self._refreshing.pop(cache, None))
+        return asyncio.shield(future)
+
+    async def _events(self, writer, version, headers, args):
+        import asyncio
+
+        path = safe_path(args.get('path', ''))
+        # 第一次打开目录时可能要从文件目录数据库加载列表
+        cache = await asyncio.get_running_loop().run_in_executor(None, get_file_cache, path) \
+            if path is not None else None
+        if cache is None:
+            return None
+        last_id = headers.get('Last-Event-ID') or args.get('since')
+        try:
+            event_version = int(last_id)
+        except (TypeError, ValueError):
+            event_version = None
+        writer.write(self._head(200, version, [
+            ('Content-Type', 'text/event-stream; charset=utf-8'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+        ], False))
+        writer.write(b'retry: 3000\n\n')
+        await self._refresh(cache)
+        if event_version is None:
+            event_version = cache.version
+            writer.write(sse_message('sync', {'version': event_version}, event_version).encode())
+        await writer.drain()
+        last_sent = time.monotonic()
+        while not self.stopping:
+            await asyncio.sleep(cache.check_interval)
+            await self._refresh(cache)
+            messages, event_version = pending_events(cache, event_version)
+            if not messages and time.monotonic() - last_sent < SSE_HEARTBEAT:
+                continue
+            writer.write((''.join(messages) or ': ping\n\n').encode())
+            await writer.drain()
+            last_sent = time.monotonic()
+        return False
+
+    async def _call_wsgi(self, writer, method, target, version, headers, body, client, keep):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        slot = None
+        if (method == 'PUT' and target.startswith('/api/uploads/')) or \
+                (method == 'POST' and target.startswith('/api/delta/')):
+            # 分块上传和差量上传的请求体要先落盘再交给应用，所以在读取之前就占用上传名额
+            try:
+                # 分块的空间在创建会话时已经预留；差量上传由应用按目标文件大小调整预留量
+                size = 0 if method == 'PUT' else None if body.chunked else body.remaining
+                slot = await get_upload_admission().aadmit(client[0], size)
+            except UploadRejected as e:
+                return await self._send_rejected(writer, version, keep and not body.awaiting_continue(), e)
+        try:
+            return await self._call_wsgi_admitted(writer, method, target, version, headers, body, client,
+                                                  keep, slot)
+        except UploadRejected as e:
+            return await self._send_rejected(writer, version, False, e)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    async def _call_wsgi_admitted(self, writer, method, target, version, headers, body, client, keep, slot):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        # 请求体经有界的 ChunkPipe 边收边交给应用，不先落盘：分块和差量上传只在应用里写一次
+        pipe = ChunkPipe()
+        environ = make_wsgi_environ(method, target, version, headers.items(), pipe, client,
+                                    self.host, self.port, multiprocess=False)
+        if slot is not None:
+            environ['quickshare.upload_slot'] = slot
+
+        async def feed():
+            """把请求体送进 pipe，读完时返回 True；客户端断开时返回 False"""
+            try:
+                while True:
+                    chunk = await body.read()
+                    await loop.run_in_executor(None, pipe.put, chunk)
+                    if not chunk:
+                        return True
+            except (ConnectionError, EOFError, asyncio.TimeoutError):
+                # 应用读到 b'' 后按请求体不完整处理
+                pipe.close()
+                return False
+            except BaseException:
+                pipe.close()
+                raise
+
+        feeder = asyncio.ensure_future(feed())
+        state = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            state['status'], state['headers'] = status, response_headers
+            return lambda data: None
+
+        def call():
+            result = self.app(environ, start_response)
+            return result, iter(result)
+
+        try:
+            result, iterator = await loop.run_in_executor(self.app_pool, call)
+        except BaseException:
+            pipe.close()
+            feeder.cancel()
+            raise
+        try:
+            first = await loop.run_in_executor(self.app_pool, next, iterator, None)
+            status = int(state['status'].split(None, 1)[0])
+            response_headers = [(k, v) for k, v in state['headers'] if k.lower() != 'connection']
+            names = {k.lower() for k, _ in response_headers}
+            chunked = False
+            if 'content-length' not in names and not (method == 'HEAD' or status < 200 or status in (204, 304)):
+                if version == 'HTTP/1.1':
+                    chunked = True
+                    response_headers.append(('Transfer-Encoding', 'chunked'))
+                else:
+                    keep = False
+            writer.write(self._head(status, version, response_headers, keep))
+            chunk = first
+            while chunk is not None:
+                if chunk:
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain()
+                chunk = await loop.run_in_executor(self.app_pool, next, iterator, None)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.app_pool, result.close)
+            pipe.close()
+            if not feeder.done() and not body.done:
+                # 应用没有读完请求体（如提前返回错误）：不再接收，连接也不能复用
+                feeder.cancel()
+                keep = False
+        if keep:
+            keep = await feeder
+        return keep
+
+
+def serve_async(app, host, port, threads, keepalive, backlog, graceful_timeout, timeout):
+    """单进程 asyncio 模式"""
+    AsyncServer(app, host, port, threads=threads, keepalive=keepalive, timeout=timeout,
+                backlog=backlog, graceful_timeout=graceful_timeout).run()
+
+
+# 命令行客户端：python quickshare.py push / pull
+
+class ClientError(Exception):
+    """服务器返回错误，或多次重试后仍然失败"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class TransferProgress:
+    """汇总所有并发传输的进度，在终端定期刷新文件数、总量和总吞吐量"""
+
+    def __init__(self, total_files, total_bytes, stream=None, interval=0.5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.interval = interval
+        self.files = 0
+        self.transferred = 0  # 实际经过网络的字节数
+        self.skipped = 0  # 无需传输的字节数（已存在、续传、差量上传复用的部分）
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, nbytes):
+        with self._lock:
+            self.transferred += nbytes
+
+    def skip(self, nbytes):
+        with self._lock:
+            self.skipped += nbytes
+
+    def file_done(self):
+        with self._lock:
+            self.files += 1
+
+    def line(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            done = min(self.transferred + self.skipped, self.total_bytes)
+            return (f'[{self.files}/{self.total_files}] {format_size(done)} / {format_size(self.total_bytes)}'
+                    f'  已传输 {format_size(self.transferred)}，{format_size(self.transferred / elapsed)}/s')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.stream.write('\r' + self.line() + '    ')
+            self.stream.flush()
+
+    def __enter__(self):
+        if self.stream is not None and self.stream.isatty():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.stream is not None:
+            self.stream.write('\r' + self.line() + '    \n')
+            self.stream.flush()
+
+
+class _TaskGroup:
+    """在共享的线程池中运行一组任务（任务可以继续添加子任务），记录失败的任务"""
+
+    def __init__(self, pool, cancelled):
+        self.pool = pool
+        self.cancelled = cancelled
+        self.errors = []
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def submit(self, label, fn, *args):
+        with self._cond:
+            self._pending += 1
+        self.pool.submit(self._run, label, fn, args)
+
+    def _run(self, label, fn, args):
+        try:
+            if not self.cancelled.is_set():
+                fn(*args)
+        except (ClientError, OSError, ValueError) as e:
+            with self._cond:
+                self.errors.append((label, str(e)))
+        finally:
+            with self._cond:
+                self._pending -= 1
+                if not self._pending:
+                    self._cond.notify_all()
+
+    def wait(self):
+        """等待所有任务结束；Ctrl+C 时让正在进行的传输尽快停下，排队的任务不再开始"""
+        try:
+            with self._cond:
+                while self._pending:
+                    self._cond.wait()
+        except KeyboardInterrupt:
+            self.cancelled.set()
+            raise
+
+
+class _FileParts:
+    """一个大文件被拆成的若干个并行传输的区间，全部成功后调用 on_done"""
+
+    def __init__(self, count, on_done):
+        self.remaining = count
+        self.failed = False
+        self.on_done = on_done
+        self._lock = threading.Lock()
+
+    def finish(self, ok):
+        with self._lock:
+            self.remaining -= 1
+            self.failed = self.failed or not ok
+            last = self.remaining == 0 and not self.failed
+        if last:
+            self.on_done()
+
+
+class _PartWriter:
+    """把下载的数据写入本地临时文件，同时计入进度
+
+    span 为 None 时写入整个文件，否则为 (start, end)，写入已经预分配好的文件中的这个区间。
+    """
+
+    def __init__(self, path, span, progress):
+        self.span = span
+        self.progress = progress
+        self.received = 0
+        if span is None:
+            self._file = open(path, 'wb')
+        else:
+            self._file = open(path, 'r+b')
+            self._file.seek(span[0])
+
+    def write(self, data):
+        if self.span is not None and self.received + len(data) > self.span[1] - self.span[0]:
+            raise ClientError('服务器返回的数据超出请求的区间')
+        self._file.write(data)
+        self.received += len(data)
+        self.progress.add(len(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+
+
+class QuickShareClient:
+    """命令行客户端：复用一组 keep-alive 连接，多个文件以及大文件的各个区间并发传输
+
+    url 为服务器地址，可以带子目录和 ?token=，如 http://192.168.1.10:8000/2024?token=mypass；
+    令牌也可以用 token 参数或环境变量 QUICKSHARE_TOKEN 给出，与网页相同以 Cookie 发送。
+    """
+
+    def __init__(self, url, token=None, jobs=CLIENT_JOBS, timeout=60.0):
+        parts = urlsplit(url if '://' in url else 'http://' + url)
+        root = safe_path(url_unquote(parts.path))
+        if parts.scheme not in ('http', 'https') or not parts.hostname or root is None:
+            raise ClientError(f'无效的服务器地址: {url}')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.root = root
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        token = token or dict(parse_qsl(parts.query)).get('token') or os.environ.get('QUICKSHARE_TOKEN')
+        self.headers = {'Cookie': f'auth_token={token}'} if token else {}
+        self.state_path = os.path.join(os.path.expanduser('~'), '.cache', 'quickshare', 'uploads.json')
+        self.cancelled = threading.Event()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    # 连接池与重试
+
+    @contextmanager
+    def connection(self):
+        """从连接池取一个连接，用完后放回；出错的连接直接关闭"""
+        import http.client
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=self.timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.jobs:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _checked(self, chunks):
+        for chunk in chunks:
+            if self.cancelled.is_set():
+                raise ClientError('已取消')
+            yield chunk
+
+    def request(self, method, path, params=None, body=None, headers=None, sink=None, expect=(200,)):
+        """发送请求，返回 (状态码, 响应头, 响应体)
+
+        body 为 bytes 或无参函数（每次尝试时调用，返回请求体的可迭代对象）；sink 为无参函数
+        时，状态码在 expect 中的响应体逐块写入 sink() 返回的 _PartWriter，不读入内存。连接错误、
+        5xx（507 除外）、408 和 429 按指数退避重试，其余错误状态抛出 ClientError。
+        """
+        import http.client
+
+        url = url_quote(path)
+        if params:
+            url += '?' + urlencode(params)
+        headers = {**self.headers, **(headers or {})}
+        for attempt in itertools.count():
+            if self.cancelled.is_set():
+                raise ClientError('已取消')
+            retry_after = 0.0
+            try:
+                with self.connection() as conn:
+                    conn.request(method, url, body=self._checked(body()) if callable(body) else body, headers=headers)
+                    resp = conn.getresponse()
+                    data = b''
+                    if sink is not None and resp.status in expect:
+                        with sink() as out:
+                            while True:
+                                buf = resp.read(COPY_BUFFER)
+                                if not buf:
+                                    break
+                                if self.cancelled.is_set():
+                                    raise ClientError('已取消')
+                                out.write(buf)
+                    else:
+                        data = resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                error = ClientError(f'网络错误: {e}')
+            else:
+                if resp.status in expect:
+                    return resp.status, resp.headers, data
+                try:
+                    message = json.loads(data)['error']
+                except (ValueError, KeyError, TypeError):
+                    message = resp.reason
+                error = ClientError(f'{resp.status} {message}', resp.status)
+                if not (resp.status >= 500 and resp.status != 507 or resp.status in (408, 429)):
+                    raise error
+                try:
+                    retry_after = float(resp.headers.get('Retry-After') or 0)
+                except ValueError:
+                    pass
+            if attempt >= CLIENT_RETRIES:
+                raise error
+            time.sleep(max(retry_after, min(30.0, 0.5 * 2 ** attempt)))
+
+    def request_json(self, method, path, data=None, **kwargs):
+        if data is not None:
+            kwargs['body'] = json.dumps(data).encode()
+            kwargs['headers'] = {'Content-Type': 'application/json', **kwargs.get('headers', {})}
+        status, headers, body = self.request(method, path, **kwargs)
+        return status, json.loads(body) if body else None
+
+    @staticmethod
+    def file_body(path, offset, length, progress):
+        """返回请求体工厂：每次调用从头读取 path 的 [offset, offset + length)，并撤销上次尝试计入的进度"""
+        sent = 0
+
+        def chunks():
+            nonlocal sent
+            progress.add(-sent)
+            sent = 0
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    buf = f.read(min(COPY_BUFFER, remaining))
+                    if not buf:
+                        raise ClientError(f'{path} 在上传过程中被修改')
+                    remaining -= len(buf)
+                    sent += len(buf)
+                    progress.add(len(buf))
+                    yield buf
+        return chunks
+
+    # 上传
+
+    def _load_sessions(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_session(self, key, session_id):
+        """记住分块上传会话，中断后再次 push 同一文件时从断点继续"""
+        with self._lock:
+            sessions = self._load_sessions()
+            if session_id is None:
+                sessions.pop(key, None)
+            else:
+                sessions[key] = session_id
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp = f'{self.state_path}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.state_path)
+
+    def _push_delta(self, local, remote, size, progress):
+        """服务器上已有 remote 时只上传差异（见 /api/delta），成功时返回 True"""
+        status, signature = self.request_json('GET', '/api/delta/' + remote, expect=(200, 404))
+        if status == 404:
+            return False
+        with open(local, 'rb') as f:
+            plan = delta_plan(f, signature, max_literal=size // 2)
+        if plan is None:
+            return False
+        ops, digest, literal = plan
+        if size == signature['size'] and ops == [('C', 0, len(signature['weak']))]:
+            # 内容相同，无需上传
+            progress.skip(size)
+            return True
+        sent = 0
+
+        def body():
+            nonlocal sent
+            progress.add(-sent)
+            sent = 0
+            with open(local, 'rb') as f:
+                for chunk in iter_delta(f, signature['block_size'], ops, digest):
+                    sent += len(chunk)
+                    progress.add(len(chunk))
+                    yield chunk
+
+        status, _, _ = self.request('POST', '/api/delta/' + remote, body=body, expect=(200, 412),
+                                    headers={'If-Match': quote_etag(signature['etag']),
+                                             'Content-Length': str(delta_length(ops))})
+        if status == 412:
+            # 服务器上的文件刚好被修改，改为完整上传
+            progress.add(-sent)
+            return False
+        progress.skip(size - literal)
+        return True
+
+    def _push_file(self, group, local, remote, overwrite, progress):
+        st = os.stat(local)
+        size = st.st_size
+        params = {'overwrite': 1} if overwrite else None
+        if size < CLIENT_SPLIT_SIZE:
+            self.request('PUT', '/upload/' + remote, params=params, body=self.file_body(local, 0, size, progress),
+                         headers={'Content-Length': str(size)})
+            progress.file_done()
+            return
+        if overwrite and self._push_delta(local, remote, size, progress):
+            progress.file_done()
+            return
+        # 大文件：创建（或恢复）分块上传会话，各分块并行上传，全部完成后 finalize
+        key = '\0'.join([f'{self.host}:{self.port}', remote, local, str(size), str(st.st_mtime_ns)])
+        session = None
+        session_id = self._load_sessions().get(key)
+        if session_id:
+            status, session = self.request_json('GET', '/api/uploads/' + session_id, expect=(200, 404))
+            if status != 200:
+                session = None
+        if session is None:
+            _, session = self.request_json('POST', '/api/uploads', {'name': remote, 'size': size}, expect=(201,))
+            self._save_session(key, session['id'])
+        chunk_size = session['chunk_size']
+        pending = []
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size)
+            if any(a <= start and end <= b for a, b in session['received']):
+                progress.skip(end - start)
+            else:
+                pending.append((start, end))
+        url = '/api/uploads/' + session['id']
+
+        def finalize():
+            self.request('POST', url + '/finalize', params=params)
+            self._save_session(key, None)
+            progress.file_done()
+
+        parts = _FileParts(len(pending), finalize)
+        if not pending:
+            finalize()
+        for start, end in pending:
+            group.submit(local, self._push_part, parts, url, local, start, end, progress)
+
+    def _push_part(self, parts, url, local, start, end, progress):
+        ok = False
+        try:
+            self.request('PUT', url, params={'offset': start}, body=self.file_body(local, start, end - start, progress),
+                         headers={'Content-Length': str(end - start)})
+            ok = True
+        finally:
+            parts.finish(ok)
+
+    def push(self, paths, overwrite=False, stream=None):
+        """把本地文件和目录（含子目录）上传到服务器地址中的目录，返回失败的 [(本地路径, 原因)]"""
+        items = []
+        for path in paths:
+            path = os.path.abspath(path)
+            if os.path.isdir(path):
+                top = os.path.basename(path.rstrip(os.sep)) or 'root'
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames[:] = sorted(d for d in dirnames if d != STATE_DIR_NAME)
+                    rel = os.path.relpath(dirpath, path)
+                    prefix = [top] if rel == os.curdir else [top, *rel.split(os.sep)]
+                    items.extend((os.path.join(dirpath, name), posixpath.join(self.root, *prefix, name))
+                                 for name in sorted(filenames))
+            else:
+                items.append((path, posixpath.join(self.root, os.path.basename(path))))
+        errors = []
+        files = []
+        for local, remote in items:
+            try:
+                size = os.path.getsize(local)
+            except OSError as e:
+                errors.append((local, e.strerror))
+                continue
+            if safe_path(remote) is None:
+                errors.append((local, '无效的文件名'))
+                continue
+            files.append((local, remote, size))
+        with TransferProgress(len(files), sum(size for _, _, size in files), stream) as progress, \
+                ThreadPoolExecutor(self.jobs, thread_name_prefix='quickshare-push') as pool:
+            group = _TaskGroup(pool, self.cancelled)
+            # 大文件先开始，各分块与小文件一起占满所有连接
+            for local, remote, _ in sorted(files, key=lambda item: -item[2]):
+                group.submit(local, self._push_file, group, local, remote, overwrite, progress)
+            group.wait()
+        return errors + group.errors
+
+    # 下载
+
+    def _listing(self, path):
+        """返回目录 path 中的 (文件列表, 子目录列表)，path 不是目录时返回 None"""
+        files, dirs, cursor = [], [], None
+        while True:
+            params = {'path': path, 'limit': MAX_PAGE_SIZE}
+            if cursor:
+                params['cursor'] = cursor
+            status, page = self.request_json('GET', '/api/files', params=params, expect=(200, 404))
+            if status == 404:
+                return None
+            files.extend(page['files'])
+            dirs.extend(page.get('dirs', ()))
+            cursor = page.get('next')
+            if not cursor:
+                return files, dirs
+
+    def _pull_file(self, group, remote, local, size, mtime, progress):
+        try:
+            st = os.stat(local)
+        except OSError:
+            st = None
+        if st is not None and st.st_size == size and abs(st.st_mtime - mtime) < 0.001:
+            # 已经下载过（大小和修改时间都相同）
+            progress.skip(size)
+            progress.file_done()
+            return
+        os.makedirs(os.path.dirname(local) or os.curdir, exist_ok=True)
+        part, meta_path = local + '.part', local + '.part.json'
+
+        def finish():
+            if os.path.getsize(part) != size:
+                raise ClientError(f'{remote} 下载不完整')
+            os.replace(part, local)
+            os.utime(local, (mtime, mtime))
+            try:
+                os.remove(meta_path)
+            except OSError:
+                pass
+            progress.file_done()
+
+        url = '/download/' + remote
+        if size < CLIENT_SPLIT_SIZE:
+            writers = []
+
+            def sink():
+                if writers:
+                    progress.add(-writers[-1].received)
+                writers.append(_PartWriter(part, None, progress))
+                return writers[-1]
+
+            self.request('GET', url, sink=sink)
+            finish()
+            return
+        # 大文件：按 ETag 记录已完成的区间，中断后从断点继续；多个区间并行下载
+        _, headers, _ = self.request('HEAD', url)
+        etag = headers.get('ETag')
+        size = int(headers.get('Content-Length', size))
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+        if not meta or meta.get('etag') != etag or meta.get('size') != size or not os.path.exists(part):
+            meta = {'etag': etag, 'size': size, 'done': []}
+            with open(part, 'wb') as f:
+                f.truncate(size)
+        else:
+            # .part 可能在中断时被截短，超出文件实际长度的区间要重新下载
+            length = os.path.getsize(part)
+            meta['done'] = [start for start in meta['done'] if min(start + CLIENT_PART_SIZE, size) <= length]
+        done = set(meta['done'])
+        pending = []
+        for start in range(0, size, CLIENT_PART_SIZE):
+            end = min(start + CLIENT_PART_SIZE, size)
+            if start in done:
+                progress.skip(end - start)
+            else:
+                pending.append((start, end))
+        lock = threading.Lock()
+
+        def completed(start):
+            with lock:
+                meta['done'].append(start)
+                with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                os.replace(meta_path + '.tmp', meta_path)
+
+        parts = _FileParts(len(pending), finish)
+        if not pending:
+            finish()
+        for start, end in pending:
+            group.submit(remote, self._pull_part, parts, url, part, etag, start, end, completed, progress)
+
+    def _pull_part(self, parts, url, part, etag, start, end, completed, progress):
+        ok = False
+        writers = []
+
+        def sink():
+            if writers:
+                progress.add(-writers[-1].received)
+            writers.append(_PartWriter(part, (start, end), progress))
+            return writers[-1]
+
+        try:
+            # If-Range：文件在下载期间被替换时服务器返回 200 而不是 206，这里当作失败
+            self.request('GET', url, sink=sink, expect=(206,),
+                         headers={'Range': f'bytes={start}-{end - 1}', 'If-Range': etag})
+            if writers[-1].received != end - start:
+                raise ClientError('连接中断')
+            completed(start)
+            ok = True
+        finally:
+            parts.finish(ok)
+
+    def pull(self, remotes, dest, stream=None):
+        """把服务器上的文件或目录（含子目录）下载到本地目录 dest，返回失败的 [(远程路径, 原因)]"""
+        errors = []
+        files = []  # (远程路径, 本地路径, 大小, mtime)
+        for remote in remotes or ['']:
+            name = safe_path(posixpath.join(self.root, remote))
+            if name is None:
+                errors.append((remote, '无效的路径'))
+                continue
+            listing = self._listing(name)
+            if listing is not None:
+                base = os.path.join(dest, posixpath.basename(name)) if name != self.root else dest
+                stack = [(name, base, listing)]
+                while stack:
+                    path, local_dir, (entries, dirs) = stack.pop()
+                    files.extend((posixpath.join(path, item['name']), os.path.join(local_dir, item['name']),
+                                  item['bytes'], item['mtime']) for item in entries)
+                    for item in dirs:
+                        sub = posixpath.join(path, item['name'])
+                        listing = self._listing(sub)
+                        if listing is not None:
+                            stack.append((sub, os.path.join(local_dir, item['name']), listing))
+                continue
+            parent, _, base = name.rpartition('/')
+            listing = self._listing(parent)
+            entry = next((item for item in listing[0] if item['name'] == base), None) if listing else None
+            if entry is None:
+                errors.append((remote, '文件不存在'))
+                continue
+            files.append((name, os.path.join(dest, base), entry['bytes'], entry['mtime']))
+        with TransferProgress(len(files), sum(item[2] for item in files), stream) as progress, \
+                ThreadPoolExecutor(self.jobs, thread_name_prefix='quickshare-pull') as pool:
+            group = _TaskGroup(pool, self.cancelled)
+            for remote, local, size, mtime in sorted(files, key=lambda item: -item[2]):
+                group.submit(remote, self._pull_file, group, remote, local, size, mtime, progress)
+            group.wait()
+        return errors + group.errors
+
+
+def client_main(argv):
+    """python quickshare.py push/pull 的入口，返回退出状态"""
+    parser = argparse.ArgumentParser(
+        prog='quickshare.py',
+        description='QuickShare 命令行客户端：多连接并发上传/下载，大文件分段并行传输并支持断点续传',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  python quickshare.py push http://192.168.1.10:8000 video.mp4 photos/   # 上传文件和文件夹
+  python quickshare.py push http://192.168.1.10:8000/2024 a.iso --overwrite  # 覆盖同名文件（只传输变化部分）
+  python quickshare.py pull http://192.168.1.10:8000 2024/旅行 -o ~/Downloads  # 下载子目录
+  python quickshare.py pull "http://192.168.1.10:8000?token=mypass"      # 下载整个共享目录
+        """
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    push = commands.add_parser('push', help='上传本地文件或目录')
+    push.add_argument('url', help='服务器地址，可带子目录和 ?token=')
+    push.add_argument('paths', nargs='+', help='要上传的文件或目录')
+    push.add_argument('--overwrite', action='store_true',
+                      help='覆盖服务器上的同名文件；大文件只上传与旧版本不同的部分')
+    pull = commands.add_parser('pull', help='下载服务器上的文件或目录')
+    pull.add_argument('url', help='服务器地址，可带子目录和 ?token=')
+    pull.add_argument('paths', nargs='*', help='要下载的远程文件或目录（默认: 整个目录）')
+    pull.add_argument('-o', '--output', default=os.curdir, help='保存到哪个本地目录 (默认: 当前目录)')
+    for sub in (push, pull):
+        sub.add_argument('--token', help='访问密码（也可以用环境变量 QUICKSHARE_TOKEN）')
+        sub.add_argument('-j', '--jobs', type=int, default=CLIENT_JOBS,
+                         help=f'并发连接数 (默认: {CLIENT_JOBS})')
+    args = parser.parse_args(argv)
+    try:
+        client = QuickShareClient(args.url, args.token, args.jobs)
+    except ClientError as e:
+        print(f'错误: {e}', file=sys.stderr)
+        return 2
+    try:
+        if args.command == 'push':
+            errors = client.push(args.paths, args.overwrite, sys.stderr)
+        else:
+            errors = client.pull(args.paths, args.output, sys.stderr)
+    except ClientError as e:
+        print(f'错误: {e}', file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        print('\n已中断，再次运行同一命令可从断点继续', file=sys.stderr)
+        return 130
+    finally:
+        client.close()
+    for name, reason in errors:
+        print(f'失败: {name}: {reason}', file=sys.stderr)
+    return 1 if errors else 0
 
 
 def main():
-    global UPLOAD_DIR, AUTH_TOKEN
+    global UPLOAD_DIR, AUTH_TOKEN, FILE_CACHE, DEDUP_MODE, THUMB_CACHE_MB, HOT_CACHE, COMPRESS_CACHE_MB, SCHEDULER, \
+        ADMISSION, CATALOG, CLUSTER
+    
+    if len(sys.argv) > 1 and sys.argv[1] in ('push', 'pull'):
+        sys.exit(client_main(sys.argv[1:]))
     
     parser = argparse.ArgumentParser(
         description='局域网文件快传工具 - 支持上传和下载的临时 Web 服务器',
@@ -596,6 +8174,8 @@ def main():
   python quickshare.py --auth mypass      # 启动服务器（需要密码）
   python quickshare.py --port 8080        # 指定端口
   python quickshare.py --dir /path/to/dir # 指定目录
+  python quickshare.py --server prefork --workers 4 --threads 16  # 多进程生产模式
+  python quickshare.py --cluster party     # 与局域网内同名集群的其它节点合并文件列表
         """
     )
     parser.add_argument('--port', type=int, default=8000, help='服务器端口 (默认: 8000)')
@@ -603,9 +8183,60 @@ def main():
     parser.add_argument('--dir', type=str, help='文件目录 (默认: 当前目录)')
     parser.add_argument('--auth', type=str, help='访问密码（设置后需要密码才能访问）')
     parser.add_argument('--no-qr', action='store_true', help='不显示二维码')
+    parser.add_argument('--listing-ttl', type=float, default=LISTING_TTL,
+                        help=f'文件列表缓存最长有效期，秒 (默认: {LISTING_TTL:g})')
+    parser.add_argument('--server', choices=['dev', 'threaded', 'prefork', 'async'], default='dev',
+                        help='服务器引擎: dev 为 Flask 开发服务器，threaded 为有界线程池，'
+                             'prefork 为预派生多进程，async 为 asyncio 引擎 (默认: dev)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2,
+                        help='prefork 模式的工作进程数 (默认: CPU 核数)')
+    parser.add_argument('--threads', type=int, default=32, help='每个进程的工作线程数 (默认: 32)')
+    parser.add_argument('--keepalive', type=float, default=5.0,
+                        help='keep-alive 空闲连接保持时间，秒 (默认: 5)')
+    parser.add_argument('--backlog', type=int, default=1024, help='监听队列长度 (默认: 1024)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='单次读写的超时时间，秒 (默认: 60)')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='退出时等待进行中传输完成的最长时间，秒 (默认: 30)')
+    parser.add_argument('--dedup', choices=['auto', 'reflink', 'hardlink', 'off'], default=DEDUP_MODE,
+                        help='重复内容的存储方式: auto/reflink 在支持写时复制的文件系统上共享数据块，'
+                             '不支持时保存独立副本；hardlink 用硬链接，同内容的文件会互为别名，'
+                             '被其他程序原地修改时一起变化；off 总是保存独立副本 (默认: auto)')
+    parser.add_argument('--rate-limit', type=parse_size, default=0, metavar='RATE',
+                        help='所有上传下载的总带宽上限，如 20M 表示 20 MiB/s (默认: 0，不限)')
+    parser.add_argument('--client-rate-limit', type=parse_size, default=0, metavar='RATE',
+                        help='每个客户端（按 IP）的带宽上限 (默认: 0，不限)')
+    parser.add_argument('--max-uploads', type=int, default=MAX_UPLOADS,
+                        help=f'同时进行的上传数上限，超出的请求排队，排不上时返回 503 (默认: {MAX_UPLOADS}，0 为不限)')
+    parser.add_argument('--max-upload-size', type=parse_size, default=0, metavar='SIZE',
+                        help='单次上传请求的大小上限，如 4G (默认: 0，不限)')
+    parser.add_argument('--min-free-space', type=parse_size, default=MIN_FREE_SPACE, metavar='SIZE',
+                        help='上传后磁盘至少保留的剩余空间，不足时拒绝上传 (默认: 256M)')
+    parser.add_argument('--cache-mb', type=int, default=0,
+                        help='热点小文件内存缓存大小，MB，prefork 模式下为每个进程的大小 (默认: 0，不缓存)')
+    parser.add_argument('--compress-cache-mb', type=int, default=COMPRESS_CACHE_MB,
+                        help=f'压缩下载（?compress=1）结果的磁盘缓存上限，MB (默认: {COMPRESS_CACHE_MB})')
+    parser.add_argument('--thumb-cache-mb', type=int, default=THUMB_CACHE_MB,
+                        help=f'缩略图磁盘缓存上限，MB (默认: {THUMB_CACHE_MB})')
+    parser.add_argument('--catalog', action='store_true',
+                        help=f'启用 SQLite 文件目录数据库（{STATE_DIR_NAME}/{CATALOG_NAME}），重启后无需重新扫描和计算哈希')
+    
+    parser.add_argument('--cluster', type=str, metavar='NAME',
+                        help='加入名为 NAME 的集群：通过 UDP 广播发现局域网内的其它节点，合并文件列表，'
+                             '下载重定向到负载最低的节点（不支持 prefork 模式）')
+    parser.add_argument('--cluster-port', type=int, default=CLUSTER_PORT,
+                        help=f'集群广播使用的 UDP 端口 (默认: {CLUSTER_PORT})')
+    parser.add_argument('--cluster-broadcast', type=str, default='<broadcast>', metavar='ADDR',
+                        help='集群广播地址，同一台机器上测试时可用 127.255.255.255 (默认: 255.255.255.255)')
+    parser.add_argument('--replicate', action='store_true',
+                        help=f'集群模式下把被请求 {CLUSTER_REPLICATE_HITS} 次以上、只在其它节点上的文件复制到本机')
     
     args = parser.parse_args()
     
+    if args.cluster and args.server == 'prefork':
+        print("错误: --cluster 不支持 prefork 模式")
+        sys.exit(1)
+    
     if args.dir:
         UPLOAD_DIR = os.path.abspath(args.dir)
         if not os.path.isdir(UPLOAD_DIR):
@@ -614,6 +8245,34 @@ def main():
     else:
         UPLOAD_DIR = os.getcwd()
     
+    FILE_CACHE = TreeIndex(UPLOAD_DIR, ttl=args.listing_ttl)
+    DEDUP_MODE = args.dedup
+    THUMB_CACHE_MB = args.thumb_cache_mb
+    COMPRESS_CACHE_MB = args.compress_cache_mb
+    HOT_CACHE = HotFileCache(args.cache_mb * 1024 * 1024) if args.cache_mb > 0 else None
+    if args.rate_limit or args.client_rate_limit:
+        SCHEDULER = TransferScheduler(args.rate_limit, args.client_rate_limit)
+    ADMISSION = UploadAdmission(args.max_uploads, args.max_upload_size, args.min_free_space)
+    if args.catalog:
+        import sqlite3
+
+        try:
+            CATALOG = Catalog(UPLOAD_DIR)
+        except (OSError, sqlite3.Error) as e:
+            print(f"错误: 无法打开文件目录数据库: {e}")
+            sys.exit(1)
+        CATALOG.start()
+    # 后台开始为已有文件建立哈希索引和文件名索引
+    get_content_index()
+    get_search_index()
+    if args.cluster:
+        try:
+            CLUSTER = Cluster(args.cluster, args.port, None if args.host in ('0.0.0.0', '') else args.host,
+                              args.cluster_port, args.cluster_broadcast, args.replicate)
+        except OSError as e:
+            print(f"错误: 无法监听集群广播端口 {args.cluster_port}: {e}")
+            sys.exit(1)
+    
     if args.auth:
         AUTH_TOKEN = args.auth
         print(f"🔒 已启用密码保护，密码: {AUTH_TOKEN}")
@@ -635,6 +8294,8 @@ def main():
     print(f"{'='*60}")
     print(f" 服务目录: {UPLOAD_DIR}")
     print(f" 访问地址: {url}")
+    if CLUSTER is not None:
+        print(f" 集群: {CLUSTER.name}（节点 {CLUSTER.node}，UDP 端口 {CLUSTER.port}）")
     if AUTH_TOKEN:
         print(f" 访问密码: {AUTH_TOKEN}")
         print(f" 完整链接: {url_with_auth}")
@@ -647,11 +8308,29 @@ def main():
     
     print("按 Ctrl+C 停止服务器\n")
     
+    options = dict(threads=args.threads, keepalive=args.keepalive, backlog=args.backlog,
+                   graceful_timeout=args.graceful_timeout, timeout=args.timeout)
+    if CLUSTER is not None:
+        CLUSTER.start()
     try:
-        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+        if args.server == 'threaded':
+            serve_threaded(app, args.host, args.port, **options)
+        elif args.server == 'prefork':
+            serve_prefork(app, args.host, args.port, workers=args.workers, **options)
+        elif args.server == 'async':
+            serve_async(app, args.host, args.port, **options)
+        else:
+            app.run(host=args.host, port=args.port, debug=False, threaded=True)
     except KeyboardInterrupt:
-        print("\n\n服务器已停止")
-        sys.exit(0)
+        pass
+    except (RuntimeError, OSError) as e:
+        print(f"错误: {e}")
+        sys.exit(1)
+    finally:
+        if CLUSTER is not None:
+            CLUSTER.stop()
+    print("\n\n服务器已停止")
+    sys.exit(0)
 
 
 if __name__ == '__main__':
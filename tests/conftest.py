@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quickshare  # noqa: E402
+
+
+@pytest.fixture
+def share(tmp_path, monkeypatch):
+    """以 tmp_path 作为共享目录，关闭密码保护并重置各类全局缓存"""
+    monkeypatch.setattr(quickshare, 'UPLOAD_DIR', str(tmp_path))
+    monkeypatch.setattr(quickshare, 'AUTH_TOKEN', None)
+    monkeypatch.setattr(quickshare, 'FILE_CACHE', None)
+    monkeypatch.setattr(quickshare, 'ADMISSION', None)
+    monkeypatch.setattr(quickshare, 'CLUSTER', None)
+    quickshare.SHUTDOWN.clear()
+    yield tmp_path
+    quickshare.SHUTDOWN.clear()
+
+
+@pytest.fixture
+def client(share):
+    quickshare.app.config['TESTING'] = True
+    return quickshare.app.test_client()
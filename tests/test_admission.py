@@ -0,0 +1,72 @@
+import collections
+
+import pytest
+
+import quickshare
+
+Usage = collections.namedtuple('Usage', 'total used free')
+
+
+@pytest.fixture
+def disk(share, monkeypatch):
+    state = {'free': 0}
+    monkeypatch.setattr(quickshare.shutil, 'disk_usage', lambda path: Usage(0, 0, state['free']))
+    return state
+
+
+def test_reservation_is_checked_atomically(disk):
+    admission = quickshare.UploadAdmission(max_active=4, reserve=0)
+    disk['free'] = 150
+    first = admission.admit('a', 100)
+    with pytest.raises(quickshare.UploadRejected) as excinfo:
+        admission.admit('b', 100)
+    assert excinfo.value.status == 507
+    assert admission.active == 1
+    first.release()
+    assert admission.active == 0
+    admission.admit('b', 100).release()
+
+
+def test_undeclared_size_rechecks_disk(disk):
+    admission = quickshare.UploadAdmission(max_active=4, reserve=10)
+    disk['free'] = 100
+    slot = admission.admit('a', None)
+    slot.count(quickshare.SPACE_CHECK_BYTES - 1)
+    disk['free'] = 5
+    with pytest.raises(quickshare.UploadRejected) as excinfo:
+        slot.count(1)
+    assert excinfo.value.status == 507
+    slot.release()
+
+
+def test_sessions_reserve_declared_size_until_finished(client, disk, monkeypatch):
+    # 稀疏文件：空间要等分块写入时才真正占用
+    monkeypatch.delattr(quickshare.os, 'posix_fallocate', raising=False)
+    quickshare.ADMISSION = quickshare.UploadAdmission(reserve=0)
+    disk['free'] = 150
+    first = client.post('/api/uploads', json={'name': 'a.bin', 'size': 100})
+    assert first.status_code == 201
+    assert client.post('/api/uploads', json={'name': 'b.bin', 'size': 100}).status_code == 507
+
+    session = first.get_json()['id']
+    # 分块写入不再重复占用空间
+    assert client.put(f'/api/uploads/{session}?offset=0', data=b'x' * 100).status_code == 200
+    assert client.post(f'/api/uploads/{session}/finalize').status_code == 200
+    assert quickshare.ADMISSION._reserved == 0
+    assert client.post('/api/uploads', json={'name': 'b.bin', 'size': 100}).status_code == 201
+
+
+def test_delta_reserves_output_size(client, share, disk, monkeypatch):
+    quickshare.ADMISSION = quickshare.UploadAdmission(reserve=0)
+    disk['free'] = 10 ** 9
+    (share / 'f.bin').write_bytes(b'a' * 10000)
+    etag = client.get('/api/delta/f.bin').get_json()['etag']
+    reserved = []
+
+    def apply_delta(stream, base, base_size, write):
+        reserved.append(quickshare.ADMISSION._reserved)
+        raise ValueError('stop')
+
+    monkeypatch.setattr(quickshare, 'apply_delta', apply_delta)
+    client.post('/api/delta/f.bin', data=b'tiny', headers={'If-Match': f'"{etag}"'})
+    assert reserved == [10000]
@@ -0,0 +1,84 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import quickshare
+
+
+def make_tar(*members, mode='w'):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, data, kind in members:
+            info = tarfile.TarInfo(name)
+            if kind == 'file':
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            else:
+                info.type = kind
+                info.linkname = data
+                tar.addfile(info)
+    return buf.getvalue()
+
+
+def test_unpacks_files(client, share):
+    body = make_tar(('a.txt', b'a', 'file'), ('sub/b.txt', b'b', 'file'), mode='w:gz')
+    resp = client.put('/upload-archive?path=up', data=body)
+    assert resp.status_code == 200
+    assert sorted(resp.get_json()['files']) == ['up/a.txt', 'up/sub/b.txt']
+    assert (share / 'up' / 'sub' / 'b.txt').read_bytes() == b'b'
+
+
+def test_traversal_members_are_skipped(client, share):
+    body = make_tar(('../escape.txt', b'x', 'file'), ('a/../../escape2.txt', b'x', 'file'),
+                    ('ok.txt', b'ok', 'file'))
+    data = client.put('/upload-archive', data=body).get_json()
+    assert data['files'] == ['ok.txt']
+    assert sorted(data['skipped']) == ['../escape.txt', 'a/../../escape2.txt']
+    assert not (share.parent / 'escape.txt').exists()
+    assert not (share.parent / 'escape2.txt').exists()
+
+
+def test_absolute_members_stay_inside_share(client, share):
+    body = make_tar(('/tmp/abs.txt', b'x', 'file'))
+    data = client.put('/upload-archive', data=body).get_json()
+    assert data['files'] == ['tmp/abs.txt']
+    assert (share / 'tmp' / 'abs.txt').read_bytes() == b'x'
+
+
+def test_links_are_skipped(client, share, tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside')
+    body = make_tar(('link', str(outside), tarfile.SYMTYPE), ('hard', '/etc/passwd', tarfile.LNKTYPE),
+                    ('ok.txt', b'ok', 'file'))
+    data = client.put('/upload-archive', data=body).get_json()
+    assert data['files'] == ['ok.txt']
+    assert sorted(data['skipped']) == ['hard', 'link']
+    assert not (share / 'link').exists()
+
+
+def test_existing_symlink_directory_is_not_followed(client, share, tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside')
+    (share / 'link').symlink_to(outside)
+    data = client.put('/upload-archive', data=make_tar(('link/evil.txt', b'x', 'file'))).get_json()
+    assert data['skipped'] == ['link/evil.txt']
+    assert not (outside / 'evil.txt').exists()
+
+
+def test_failed_commit_removes_remaining_temp_files(share, monkeypatch):
+    real_store = quickshare.store_file
+    calls = []
+
+    def store_file(*args, **kwargs):
+        calls.append(args[1])
+        if len(calls) == 2:
+            raise OSError(28, 'No space left on device')
+        return real_store(*args, **kwargs)
+
+    monkeypatch.setattr(quickshare, 'store_file', store_file)
+    body = make_tar(*[(f'f{i}.txt', b'x', 'file') for i in range(4)])
+    ingest = quickshare.TarIngest()
+    with pytest.raises(OSError):
+        ingest.run(io.BytesIO(body))
+    assert os.listdir(quickshare.state_dir('tmp')) == []
+    assert sorted(os.listdir(share)) == ['.quickshare', 'f0.txt']
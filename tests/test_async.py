@@ -0,0 +1,91 @@
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import quickshare
+
+DATA = bytes(range(256)) * 400
+
+
+@pytest.fixture
+def server(share):
+    """在后台线程中运行 --server async 模式的服务器"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    srv = quickshare.AsyncServer(quickshare.app, '127.0.0.1', port, threads=4, io_threads=2,
+                                 timeout=10.0, graceful_timeout=2.0)
+    thread = threading.Thread(target=srv.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            assert time.monotonic() < deadline, '服务器没有启动'
+            time.sleep(0.02)
+    yield port
+    srv.shutdown()
+    thread.join(10)
+    quickshare.SHUTDOWN.clear()
+
+
+def request(conn, method, url, body=None, headers={}, **kwargs):
+    conn.request(method, url, body=body, headers=headers, **kwargs)
+    resp = conn.getresponse()
+    return resp, resp.read()
+
+
+def test_ranged_download(server, share):
+    (share / 'data.bin').write_bytes(DATA)
+    conn = http.client.HTTPConnection('127.0.0.1', server, timeout=10)
+    resp, body = request(conn, 'GET', '/download/data.bin', headers={'Range': 'bytes=1000-1999'})
+    assert resp.status == 206
+    assert resp.getheader('Content-Range') == f'bytes 1000-1999/{len(DATA)}'
+    assert body == DATA[1000:2000]
+
+    # 同一连接上继续请求（keep-alive）
+    resp, body = request(conn, 'GET', '/download/data.bin', headers={'Range': 'bytes=-10'})
+    assert (resp.status, body) == (206, DATA[-10:])
+    resp, body = request(conn, 'GET', '/download/data.bin')
+    assert (resp.status, body) == (200, DATA)
+    conn.close()
+
+
+def test_uploads(server, share):
+    conn = http.client.HTTPConnection('127.0.0.1', server, timeout=10)
+    resp, body = request(conn, 'PUT', '/upload/raw.bin', body=DATA)
+    assert resp.status == 200
+    assert (share / 'raw.bin').read_bytes() == DATA
+
+    # 分块会话的块经 ChunkPipe 边收边交给应用，其中一块用 chunked 编码发送
+    resp, body = request(conn, 'POST', '/api/uploads', body=json.dumps({'name': 's.bin', 'size': len(DATA)}),
+                         headers={'Content-Type': 'application/json'})
+    assert resp.status == 201
+    session = json.loads(body)['id']
+    half = len(DATA) // 2
+    resp, _ = request(conn, 'PUT', f'/api/uploads/{session}?offset=0', body=DATA[:half])
+    assert resp.status == 200
+    resp, _ = request(conn, 'PUT', f'/api/uploads/{session}?offset={half}', body=iter([DATA[half:]]),
+                      encode_chunked=True)
+    assert resp.status == 200
+    resp, body = request(conn, 'POST', f'/api/uploads/{session}/finalize')
+    assert json.loads(body)['files'] == ['s.bin']
+    assert (share / 's.bin').read_bytes() == DATA
+
+    boundary = 'qsboundary'
+    form = (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="form.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + DATA + f'\r\n--{boundary}--\r\n'.encode()
+    resp, body = request(conn, 'POST', '/upload', body=form,
+                         headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    assert resp.status == 200
+    assert (share / 'form.bin').read_bytes() == DATA
+
+    resp, body = request(conn, 'GET', '/api/files')
+    assert sorted(f['name'] for f in json.loads(body)['files']) == ['form.bin', 'raw.bin', 's.bin']
+    conn.close()
@@ -0,0 +1,36 @@
+import hashlib
+import os
+
+import quickshare
+
+
+def test_catalog_survives_restart_and_reconciles(client, share, monkeypatch):
+    (share / 'a').mkdir()
+    (share / 'a' / 'old.txt').write_text('old')
+    (share / 'b').mkdir()
+    (share / 'b' / 'keep.txt').write_text('keep')
+    catalog = quickshare.Catalog(str(share))
+    catalog.reconcile()
+    catalog.fill_hashes()
+    monkeypatch.setattr(quickshare, 'CATALOG', catalog)
+    assert client.put('/upload/a/new.txt', data=b'new').status_code == 200
+    assert client.get('/download/a/new.txt').status_code == 200
+    catalog.flush()
+
+    # 重启：新的实例读同一个数据库，只重新扫描 mtime 变化过的目录
+    (share / 'a' / 'old.txt').unlink()
+    catalog = quickshare.Catalog(str(share))
+    monkeypatch.setattr(quickshare, 'CATALOG', catalog)
+    assert catalog.listing('a') is None
+    catalog.reconcile()
+    assert catalog.rescanned == 1
+    files, dirs, _ = catalog.listing('')
+    assert files == {} and set(dirs) == {'a', 'b'}
+    assert set(catalog.listing('a')[0]) == {'new.txt'}
+    assert set(catalog.listing('b')[0]) == {'keep.txt'}
+
+    info = client.get('/api/info/a/new.txt').get_json()
+    assert info['uploader'] == '127.0.0.1'
+    assert info['downloads'] == 1
+    assert info['sha256'] == hashlib.sha256(b'new').hexdigest()
+    assert client.get('/api/info/a/old.txt').status_code == 404
@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import quickshare
+
+BIG = os.urandom(100 * 1024)
+
+
+@pytest.fixture
+def server(share):
+    """在后台线程中运行线程池 WSGI 服务器"""
+    listener = quickshare.create_listener('127.0.0.1', 0, 16)
+    srv = quickshare.WSGIServer(quickshare.app, listener, threads=4, graceful_timeout=2.0, timeout=10.0)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    thread.join(10)
+    quickshare.SHUTDOWN.clear()
+
+
+@pytest.fixture
+def client(server, tmp_path_factory, monkeypatch):
+    # 调小分段阈值，让 100 KB 的文件也按区间并行传输
+    monkeypatch.setattr(quickshare, 'CLIENT_SPLIT_SIZE', 64 * 1024)
+    monkeypatch.setattr(quickshare, 'CLIENT_PART_SIZE', 16 * 1024)
+    client = quickshare.QuickShareClient(f'http://127.0.0.1:{server.server_port}/up')
+    client.state_path = str(tmp_path_factory.mktemp('state') / 'uploads.json')
+    yield client
+    client.close()
+
+
+def test_push_pull_round_trip(client, share, tmp_path_factory):
+    src = tmp_path_factory.mktemp('src')
+    (src / 'photos' / 'sub').mkdir(parents=True)
+    (src / 'photos' / 'a.txt').write_bytes(b'a')
+    (src / 'photos' / 'sub' / 'b.txt').write_bytes(b'b' * 1000)
+    (src / 'big.bin').write_bytes(BIG)
+    assert client.push([str(src / 'photos'), str(src / 'big.bin')], stream=io.StringIO()) == []
+    assert (share / 'up' / 'photos' / 'sub' / 'b.txt').read_bytes() == b'b' * 1000
+    assert (share / 'up' / 'big.bin').read_bytes() == BIG
+
+    dest = tmp_path_factory.mktemp('dest')
+    assert client.pull([], str(dest), stream=io.StringIO()) == []
+    assert (dest / 'photos' / 'a.txt').read_bytes() == b'a'
+    assert (dest / 'photos' / 'sub' / 'b.txt').read_bytes() == b'b' * 1000
+    assert (dest / 'big.bin').read_bytes() == BIG
+    assert not list(dest.glob('*.part*'))
+
+
+def test_pull_resumes_truncated_part(client, share, tmp_path_factory, monkeypatch):
+    (share / 'up').mkdir()
+    (share / 'up' / 'big.bin').write_bytes(BIG)
+    dest = tmp_path_factory.mktemp('dest')
+    _, headers, _ = client.request('HEAD', '/download/up/big.bin')
+    # 上次下载完成了前三个区间，但 .part 在中断时被截短到第三个区间中间
+    part = dest / 'big.bin.part'
+    part.write_bytes(BIG[:40 * 1024])
+    (dest / 'big.bin.part.json').write_text(json.dumps(
+        {'etag': headers['ETag'], 'size': len(BIG), 'done': [0, 16 * 1024, 32 * 1024]}))
+
+    ranges = []
+    request = client.request
+
+    def spy(method, path, **kwargs):
+        if 'Range' in (kwargs.get('headers') or {}):
+            ranges.append(kwargs['headers']['Range'])
+        return request(method, path, **kwargs)
+
+    monkeypatch.setattr(client, 'request', spy)
+    assert client.pull(['big.bin'], str(dest), stream=io.StringIO()) == []
+    assert (dest / 'big.bin').read_bytes() == BIG
+    assert not part.exists() and not (dest / 'big.bin.part.json').exists()
+    # 完整保存下来的前两个区间不再下载
+    assert sorted(ranges) == sorted(f'bytes={start}-{min(start + 16 * 1024, len(BIG)) - 1}'
+                                    for start in range(32 * 1024, len(BIG), 16 * 1024))
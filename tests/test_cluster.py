@@ -0,0 +1,55 @@
+import json
+import time
+
+import pytest
+
+import quickshare
+
+
+@pytest.fixture
+def cluster(share):
+    node = quickshare.Cluster('test', 8000, port=0)
+    yield node
+    node._sock.close()
+
+
+def announcement(node, **extra):
+    info = {'cluster': 'test', 'node': 'peer1', 'port': 9000, 'version': 1, 'load': 0, 'time': time.time()}
+    info.update(extra)
+    body = json.dumps(info)
+    return json.dumps({'body': body, 'mac': node._sign(body)}).encode()
+
+
+def test_unsigned_host_is_ignored(cluster):
+    cluster._receive(announcement(cluster, host='203.0.113.9'), ('192.168.1.5', 8765))
+    assert cluster._peers['peer1'].addr == ('192.168.1.5', 9000)
+
+
+def test_signed_host_is_trusted(cluster, monkeypatch):
+    monkeypatch.setattr(quickshare, 'AUTH_TOKEN', 'secret')
+    cluster._receive(announcement(cluster, host='192.168.1.6'), ('192.168.1.5', 8765))
+    assert cluster._peers['peer1'].addr == ('192.168.1.6', 9000)
+
+
+def test_stale_and_replayed_announcements_are_dropped(cluster, monkeypatch):
+    monkeypatch.setattr(quickshare, 'AUTH_TOKEN', 'secret')
+    cluster._receive(announcement(cluster, time=time.time() - 60), ('192.168.1.5', 8765))
+    assert 'peer1' not in cluster._peers
+    packet = announcement(cluster)
+    cluster._receive(packet, ('192.168.1.5', 8765))
+    cluster._receive(announcement(cluster, load=5, time=time.time() - 1), ('192.168.1.5', 8765))
+    assert cluster._peers['peer1'].load == 0
+    cluster._receive(announcement(cluster, bye=True, time=time.time() - 1), ('192.168.1.5', 8765))
+    assert 'peer1' in cluster._peers
+
+
+def test_download_ticket(client, share, monkeypatch):
+    monkeypatch.setattr(quickshare, 'AUTH_TOKEN', 'secret')
+    (share / 'a.txt').write_text('hello')
+    (share / 'b.txt').write_text('other')
+    ticket = quickshare.download_ticket('/download/a.txt')
+    assert 'secret' not in ticket
+    assert client.get('/download/a.txt?ticket=' + ticket).data == b'hello'
+    assert client.get('/download/b.txt?ticket=' + ticket).status_code == 401
+    expired = quickshare.download_ticket('/download/a.txt', ttl=-1)
+    assert client.get('/download/a.txt?ticket=' + expired).status_code == 401
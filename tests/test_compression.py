@@ -0,0 +1,52 @@
+import gzip
+
+import quickshare
+
+
+def test_choose_encoding():
+    assert quickshare.choose_encoding(None) is None
+    assert quickshare.choose_encoding('identity') is None
+    assert quickshare.choose_encoding('gzip;q=0, deflate') is None
+    assert quickshare.choose_encoding('gzip, deflate') == 'gzip'
+    assert quickshare.choose_encoding('*') == next(
+        e for e in quickshare.ENCODING_PREFERENCE if e in quickshare.COMPRESSORS)
+
+
+def test_page_and_api_are_negotiated(client, share):
+    for i in range(50):
+        (share / f'file-{i}.txt').write_text('x')
+    plain = client.get('/api/files')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    resp = client.get('/api/files', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert gzip.decompress(resp.data) == plain.data
+    assert resp.headers['ETag'].startswith('W/')
+
+    resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert b'<html' in gzip.decompress(resp.data)
+
+
+def test_download_compression_is_opt_in(client, share):
+    text = b'line of a log file\n' * 1000
+    (share / 'app.log').write_bytes(text)
+    (share / 'photo.jpg').write_bytes(text)
+    headers = {'Accept-Encoding': 'gzip'}
+
+    resp = client.get('/download/app.log', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == text
+
+    for _ in range(2):
+        # 第二次走压缩版本缓存
+        resp = client.get('/download/app.log?compress=1', headers=headers)
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in resp.headers['Vary']
+        assert gzip.decompress(resp.data) == text
+
+    resp = client.get('/download/photo.jpg?compress=1', headers=headers)
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == text
@@ -0,0 +1,20 @@
+import os
+
+import quickshare
+
+
+def test_auto_dedup_never_hardlinks(share, monkeypatch):
+    monkeypatch.setattr(quickshare, 'DEDUP_MODE', 'auto')
+    monkeypatch.setattr(quickshare, 'fcntl', None)
+    source = share / 'a.bin'
+    source.write_bytes(b'x' * 100)
+    assert quickshare.clone_file(str(source), str(share / 'b.bin')) is None
+    assert not (share / 'b.bin').exists()
+
+
+def test_hardlink_only_when_requested(share, monkeypatch):
+    monkeypatch.setattr(quickshare, 'DEDUP_MODE', 'hardlink')
+    source = share / 'a.bin'
+    source.write_bytes(b'x' * 100)
+    assert quickshare.clone_file(str(source), str(share / 'b.bin')) == 'hardlink'
+    assert os.stat(source).st_ino == os.stat(share / 'b.bin').st_ino
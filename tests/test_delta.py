@@ -0,0 +1,29 @@
+import io
+
+import quickshare
+
+
+def delta_body(old, new, signature):
+    ops, digest, _ = quickshare.delta_plan(io.BytesIO(new), signature)
+    return b''.join(quickshare.iter_delta(io.BytesIO(new), signature['block_size'], ops, digest))
+
+
+def test_delta_requires_current_etag(client, share):
+    old = b'a' * 5000 + b'b' * 5000
+    new = b'a' * 5000 + b'c' * 100 + b'b' * 5000
+    (share / 'f.bin').write_bytes(old)
+    signature = client.get('/api/delta/f.bin').get_json()
+    body = delta_body(old, new, signature)
+
+    assert client.post('/api/delta/f.bin', data=body).status_code == 428
+    resp = client.post('/api/delta/f.bin', data=body, headers={'If-Match': '"stale"'})
+    assert resp.status_code == 412
+    assert (share / 'f.bin').read_bytes() == old
+
+    resp = client.post('/api/delta/f.bin', data=body, headers={'If-Match': f'"{signature["etag"]}"'})
+    assert resp.status_code == 200
+    assert (share / 'f.bin').read_bytes() == new
+
+    # 旧签名在文件替换之后失效
+    resp = client.post('/api/delta/f.bin', data=body, headers={'If-Match': f'"{signature["etag"]}"'})
+    assert resp.status_code == 412
@@ -0,0 +1,132 @@
+import io
+import os
+import tarfile
+import wsgiref.util
+import zipfile
+
+import pytest
+
+import quickshare
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def sample(share):
+    (share / 'data.bin').write_bytes(DATA)
+    return '/download/data.bin'
+
+
+def test_full_download(client, sample):
+    resp = client.get(sample)
+    assert resp.status_code == 200
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+    assert resp.data == DATA
+
+
+def test_single_range(client, sample):
+    resp = client.get(sample, headers={'Range': 'bytes=100-199'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+    assert resp.data == DATA[100:200]
+
+    resp = client.get(sample, headers={'Range': 'bytes=-10'})
+    assert resp.status_code == 206
+    assert resp.data == DATA[-10:]
+
+
+def test_unsatisfiable_range(client, sample):
+    resp = client.get(sample, headers={'Range': f'bytes={len(DATA)}-'})
+    assert resp.status_code == 416
+    assert resp.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_multiple_ranges(client, sample):
+    resp = client.get(sample, headers={'Range': 'bytes=0-9,1000-1009'})
+    assert resp.status_code == 206
+    content_type = resp.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('boundary=', 1)[1].encode()
+    parts = resp.data.split(b'--' + boundary)
+    assert parts[-1].strip() == b'--'
+    bodies = [part.split(b'\r\n\r\n', 1) for part in parts[1:-1]]
+    assert [b'Content-Range: bytes 0-9/' in head for head, _ in bodies] == [True, False]
+    assert b'Content-Range: bytes 1000-1009/' in bodies[1][0]
+    assert [body[:-2] for _, body in bodies] == [DATA[0:10], DATA[1000:1010]]
+
+
+def test_if_range_mismatch_returns_full_file(client, sample):
+    resp = client.get(sample, headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert resp.status_code == 200
+    assert resp.data == DATA
+
+
+def test_foreign_file_wrapper_is_only_used_for_full_files(client, sample):
+    environ = {'wsgi.file_wrapper': wsgiref.util.FileWrapper}
+    resp = client.get(sample, headers={'Range': 'bytes=100-109'}, environ_overrides=environ)
+    assert resp.status_code == 206
+    assert resp.data == DATA[100:110]
+
+    before = quickshare.get_metrics()._collect()
+    resp = client.get(sample, environ_overrides=environ)
+    assert resp.data == DATA
+    resp.close()
+    after = quickshare.get_metrics()._collect()
+    assert after[2]['out'] - before[2]['out'] == len(DATA)
+
+
+@pytest.fixture
+def tree(share):
+    (share / 'docs').mkdir()
+    (share / 'docs' / 'a.txt').write_bytes(b'a' * 1000)
+    (share / 'docs' / 'b.jpg').write_bytes(DATA)
+    (share / 'top.txt').write_bytes(b'top')
+    return share
+
+
+def test_zip_archive_of_selected_names(client, tree):
+    resp = client.post('/download-archive', data={'names': ['docs', 'top.txt', 'missing', '../x']})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        assert sorted(zf.namelist()) == ['docs/a.txt', 'docs/b.jpg', 'top.txt']
+        assert zf.read('docs/b.jpg') == DATA
+        # 已压缩的媒体只存储，其余文件 deflate
+        assert zf.getinfo('docs/b.jpg').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('docs/a.txt').compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_tar_archive_of_whole_directory(client, tree):
+    resp = client.get('/download-archive?all=1&path=docs&format=tar')
+    assert resp.status_code == 200
+    assert 'docs.tar' in resp.headers['Content-Disposition']
+    with tarfile.open(fileobj=io.BytesIO(resp.data)) as tar:
+        assert sorted(tar.getnames()) == ['a.txt', 'b.jpg']
+        assert tar.extractfile('a.txt').read() == b'a' * 1000
+
+
+def test_archive_errors(client, tree):
+    assert client.get('/download-archive?all=1&format=rar').status_code == 400
+    assert client.get('/download-archive?names=missing').status_code == 404
+
+
+def test_hot_cache_is_invalidated_by_mtime(client, share, monkeypatch):
+    monkeypatch.setattr(quickshare, 'HOT_CACHE', quickshare.HotFileCache(1024 * 1024))
+    path = share / 'handout.txt'
+    path.write_bytes(b'v1' * 1000)
+    os.utime(path, ns=(1_000_000_000, 1_000_000_000))
+    for _ in range(3):
+        assert client.get('/download/handout.txt').data == b'v1' * 1000
+    stats = client.get('/api/cache').get_json()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+    etag = client.get('/download/handout.txt').headers['ETag']
+
+    # 大小不变、只有 mtime 变化也要重新读取
+    path.write_bytes(b'v2' * 1000)
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    resp = client.get('/download/handout.txt')
+    assert resp.data == b'v2' * 1000
+    assert resp.headers['ETag'] != etag
+    assert client.get('/download/handout.txt').data == b'v2' * 1000
+    stats = client.get('/api/cache').get_json()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (3, 3, 1)
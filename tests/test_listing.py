@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+
+import quickshare
+
+
+def test_on_change_runs_outside_cache_lock(share):
+    seen = []
+
+    def on_change(changes):
+        # 回调中再次访问同一个缓存：持有 _cond 调用时会死锁
+        seen.append((changes, cache.dirs()))
+
+    cache = quickshare.DirectoryCache(str(share), on_change=on_change)
+    (share / 'a.txt').write_text('a')
+    (share / 'sub').mkdir()
+    thread = threading.Thread(target=cache.refresh, kwargs={'force': True}, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [c['name'] for c in seen[0][0]['added']] == ['a.txt']
+    assert seen[0][1] == [{'name': 'sub', 'mtime': (share / 'sub').stat().st_mtime}]
+
+    (share / 'b.txt').write_text('b')
+    cache.update('b.txt')
+    assert [c['name'] for c in seen[1][0]['added']] == ['b.txt']
+
+
+def test_update_does_not_hide_external_changes(share):
+    cache = quickshare.DirectoryCache(str(share), ttl=3600, check_interval=0)
+    cache.refresh(force=True)
+    scans = cache.scans
+
+    # 只有自己的写入：写入后的目录 mtime 记为已扫描，不必重新扫描
+    before = cache.dir_mtime()
+    (share / 'own.txt').write_text('own')
+    os.utime(share, ns=(before + 10**9, before + 10**9))
+    cache.update('own.txt', before)
+    cache.refresh()
+    assert cache.scans == scans
+
+    # 写入之前目录已经被别的程序改过：下次 refresh 必须重新扫描
+    (share / 'external.txt').write_text('ext')
+    os.utime(share, ns=(before + 2 * 10**9, before + 2 * 10**9))
+    before = cache.dir_mtime()
+    (share / 'own2.txt').write_text('own')
+    os.utime(share, ns=(before + 10**9, before + 10**9))
+    cache.update('own2.txt', before)
+    cache.refresh()
+    assert cache.scans == scans + 1
+    assert {item['name'] for item in cache.files()} == {'own.txt', 'own2.txt', 'external.txt'}
+
+
+def make_files(share):
+    # 大小有重复，游标必须靠名称区分同一大小的文件
+    for i in range(10):
+        path = share / f'f{i}.txt'
+        path.write_bytes(b'x' * (i % 3))
+        os.utime(path, (1000 + (i * 7) % 10, 1000 + (i * 7) % 10))
+
+
+def test_cursor_round_trip_across_sorts(client, share):
+    make_files(share)
+    for sort in ('name', 'size', 'mtime'):
+        for order in ('asc', 'desc'):
+            full = client.get(f'/api/files?sort={sort}&order={order}&limit=1000').get_json()
+            assert full['next'] is None
+            names, cursor = [], ''
+            while True:
+                page = client.get(f'/api/files?sort={sort}&order={order}&limit=3&cursor={cursor}').get_json()
+                names.extend(item['name'] for item in page['files'])
+                cursor = page['next']
+                if cursor is None:
+                    break
+            assert names == [item['name'] for item in full['files']]
+            key = {'name': lambda p: p.name, 'size': lambda p: (p.stat().st_size, p.name),
+                   'mtime': lambda p: (p.stat().st_mtime, p.name)}[sort]
+            expected = sorted(share.glob('f*.txt'), key=key, reverse=order == 'desc')
+            assert names == [p.name for p in expected]
+
+
+def test_invalid_cursor(client, share):
+    make_files(share)
+    cursor = client.get('/api/files?sort=size&limit=3').get_json()['next']
+    assert client.get(f'/api/files?sort=size&limit=3&cursor={cursor}').status_code == 200
+    for bad in (f'sort=name&cursor={cursor}', 'cursor=!!!', 'cursor=bm90IGpzb24', 'sort=color', 'limit=x'):
+        resp = client.get(f'/api/files?{bad}')
+        assert resp.status_code == 400, bad
+        assert 'error' in resp.get_json()
+
+
+def test_etag_revalidation(client, share):
+    (share / 'a.txt').write_text('a')
+    for query in ('', '?limit=10&sort=name'):
+        resp = client.get(f'/api/files{query}')
+        etag = resp.headers['ETag']
+        assert client.get(f'/api/files{query}', headers={'If-None-Match': etag}).status_code == 304
+
+    etags = {query: client.get(f'/api/files{query}').headers['ETag'] for query in ('', '?limit=10&sort=name')}
+    assert client.put('/upload/b.txt', data=b'b').status_code == 200
+    for query, etag in etags.items():
+        resp = client.get(f'/api/files{query}', headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+        assert [item['name'] for item in resp.get_json()['files']] == ['a.txt', 'b.txt']
+
+
+def read_events(resp, count):
+    """从 SSE 响应中读出 count 条事件，返回 [(event, data)]"""
+    events, buf = [], ''
+    chunks = iter(resp.response)
+    while len(events) < count:
+        chunk = next(chunks)
+        buf += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while '\n\n' in buf and len(events) < count:
+            block, buf = buf.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line)
+            if 'event' in fields:
+                events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def test_events_send_deltas(client, share):
+    (share / 'a.txt').write_text('a')
+    version = client.get('/api/files').get_json()['version']
+    assert client.put('/upload/b.txt', data=b'b').status_code == 200
+    (share / 'a.txt').unlink()
+    quickshare.get_file_cache().refresh(force=True)
+
+    resp = client.get(f'/api/events?since={version}', buffered=False)
+    assert resp.mimetype == 'text/event-stream'
+    try:
+        added, removed = read_events(resp, 2)
+    finally:
+        resp.close()
+    assert added[0] == 'change' and [item['name'] for item in added[1]['added']] == ['b.txt']
+    assert removed[0] == 'change' and removed[1]['removed'] == ['a.txt']
+
+    resp = client.get('/api/events?since=999999', buffered=False)
+    try:
+        assert read_events(resp, 1)[0][0] == 'reset'
+    finally:
+        resp.close()
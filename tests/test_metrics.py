@@ -0,0 +1,49 @@
+import re
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+
+
+def parse(text):
+    """解析 Prometheus 文本格式，返回 ({指标族: 类型}, [(名称, 标签, 值)])"""
+    types, samples = {}, []
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert name not in types
+            types[name] = kind
+        elif line and not line.startswith('#'):
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.group(1), match.group(2) or '', float(match.group(3))
+            family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in types else name
+            assert family in types, line
+            samples.append((name, labels, value))
+    return types, samples
+
+
+def test_prometheus_format(client, share):
+    (share / 'a.txt').write_text('abc')
+    client.get('/download/a.txt')
+    resp = client.get('/api/metrics')
+    assert resp.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    types, samples = parse(resp.get_data(as_text=True))
+    assert types['quickshare_http_request_duration_seconds'] == 'histogram'
+    assert types['quickshare_http_requests_total'] == 'counter'
+
+    route = 'route="/download/<path:filename>",method="GET"'
+    buckets = [(labels, value) for name, labels, value in samples
+               if name == 'quickshare_http_request_duration_seconds_bucket' and route in labels]
+    assert buckets[-1][0].endswith('le="+Inf"}')
+    values = [value for _, value in buckets]
+    assert values == sorted(values)
+    count = [value for name, labels, value in samples
+             if name == 'quickshare_http_request_duration_seconds_count' and route in labels]
+    assert count == [values[-1]] and count[0] >= 1
+    out = [value for name, labels, value in samples
+           if name == 'quickshare_transfer_bytes_total' and 'direction="out"' in labels]
+    assert out and out[0] >= 3
+
+
+def test_json_format(client, share):
+    assert client.get('/api/metrics?format=json').is_json
+    assert client.get('/api/metrics', headers={'Accept': 'application/json'}).is_json
@@ -0,0 +1,17 @@
+import quickshare
+
+
+def test_index_lists_files(client, share):
+    (share / 'hello.txt').write_text('hi')
+    resp = client.get('/')
+    assert resp.status_code == 200
+    assert b'hello.txt' in resp.data
+
+
+def test_login_page_when_unauthorized(client, monkeypatch):
+    monkeypatch.setattr(quickshare, 'AUTH_TOKEN', 'secret')
+    resp = client.get('/')
+    assert resp.status_code == 401
+    assert b'password' in resp.data
+    assert client.get('/?token=secret').status_code == 200
+    assert client.get('/api/files').status_code == 401
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+
+import quickshare
+
+MB = 1024 * 1024
+QUANTUM = quickshare.SCHED_QUANTUM
+
+
+def test_flow_closed_while_queued_keeps_scheduler_running():
+    scheduler = quickshare.TransferScheduler(client_rate=1 * MB)
+
+    async def stalled():
+        flow = scheduler.open('a')
+        task = asyncio.ensure_future(drain(flow, 20))
+        await asyncio.sleep(0.1)
+        # 客户端断开：等待额度的任务被取消，随后关闭 Flow
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        flow.close()
+
+    async def drain(flow, count):
+        for _ in range(count):
+            await flow.athrottle(QUANTUM)
+
+    asyncio.run(stalled())
+    assert not scheduler._queue
+
+    # 另一个客户端的传输仍然可以拿到额度
+    done = threading.Event()
+
+    def transfer():
+        with scheduler.open('b') as flow:
+            flow.throttle(QUANTUM)
+            flow.throttle(QUANTUM)
+        done.set()
+
+    threading.Thread(target=transfer, daemon=True).start()
+    assert done.wait(5)
+    assert scheduler._thread.is_alive()
+
+
+def test_close_drops_queued_waiters():
+    scheduler = quickshare.TransferScheduler(client_rate=1 * MB)
+    flow = scheduler.open('a')
+    flow.throttle(QUANTUM)
+    scheduler._enqueue(flow, QUANTUM, lambda: None)
+    flow.close()
+    assert not scheduler._queue
+    assert 'a' not in scheduler._clients or scheduler._clients['a'].flows == 0
+
+
+def test_per_client_rate_is_enforced():
+    scheduler = quickshare.TransferScheduler(client_rate=2 * MB)
+    started = time.monotonic()
+    with scheduler.open('a') as flow:
+        for _ in range(6):
+            flow.throttle(QUANTUM)
+    elapsed = time.monotonic() - started
+    # 突发额度 512 KB，之后每 256 KB 需要 0.125 秒
+    assert 0.3 < elapsed < 2.0
+
+    # 不同客户端各有自己的额度，不受 a 已经透支的影响
+    started = time.monotonic()
+    with scheduler.open('b') as flow:
+        flow.throttle(QUANTUM)
+    assert time.monotonic() - started < 0.1
+
+
+def test_fair_sharing_between_clients():
+    scheduler = quickshare.TransferScheduler(rate=4 * MB)
+    grants = []
+    barrier = threading.Barrier(2)
+
+    def transfer(client):
+        with scheduler.open(client) as flow:
+            barrier.wait()
+            for _ in range(12):
+                flow.throttle(QUANTUM)
+                grants.append(client)
+
+    threads = [threading.Thread(target=transfer, args=(client,)) for client in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len(grants) == 24
+    # 两个客户端轮流拿到额度，任何时候领先的一方最多多出几个分段
+    lead = 0
+    for client in grants:
+        lead += 1 if client == 'a' else -1
+        assert abs(lead) <= 3
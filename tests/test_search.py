@@ -0,0 +1,33 @@
+import quickshare
+
+
+def search(client, q):
+    return [r['path'] for r in client.get(f'/api/search?q={q}').get_json()['results']]
+
+
+def test_index_follows_uploads_and_deletes(client, share):
+    (share / 'docs').mkdir()
+    (share / 'docs' / 'old-report.txt').write_text('x')
+    assert quickshare.get_search_index().ready.wait(5)
+    assert search(client, 'report') == ['docs/old-report.txt']
+
+    # 上传完成即写入索引，不必等下一轮后台同步
+    assert client.put('/upload/docs/report.txt', data=b'new').status_code == 200
+    assert search(client, 'report') == ['docs/report.txt', 'docs/old-report.txt']
+
+    # 已加载目录的列表缓存发现文件被删除时同步到索引
+    cache = quickshare.get_file_cache('docs')
+    cache.refresh(force=True)
+    (share / 'docs' / 'old-report.txt').unlink()
+    cache.refresh(force=True)
+    assert search(client, 'report') == ['docs/report.txt']
+
+
+def test_ranking_and_scope(client, share):
+    (share / 'a').mkdir()
+    for name in ('notes.md', 'a/notes.md', 'a/my-notes.md', 'a/notes-old.md'):
+        (share / name).write_text('x')
+    assert quickshare.get_search_index().ready.wait(5)
+    assert search(client, 'notes') == ['notes.md', 'a/notes.md', 'a/notes-old.md', 'a/my-notes.md']
+    data = client.get('/api/search?q=no&path=a').get_json()
+    assert [r['path'] for r in data['results']] == ['a/notes.md', 'a/notes-old.md']
@@ -0,0 +1,164 @@
+import http.client
+import socket
+import threading
+
+import pytest
+
+import quickshare
+
+
+@pytest.fixture
+def server(share):
+    """在后台线程中运行线程池 WSGI 服务器（2 个工作线程）"""
+    listener = quickshare.create_listener('127.0.0.1', 0, 16)
+    srv = quickshare.WSGIServer(quickshare.app, listener, threads=2, graceful_timeout=2.0, timeout=10.0)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    thread.join(10)
+    quickshare.SHUTDOWN.clear()
+
+
+def open_event_stream(port):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    sock.sendall(b'GET /api/events HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n')
+    head = b''
+    while b'retry:' not in head:
+        data = sock.recv(4096)
+        assert data, 'SSE 连接被提前关闭'
+        head += data
+    assert b'text/event-stream' in head
+    return sock
+
+
+def test_event_streams_do_not_exhaust_pool(server):
+    streams = [open_event_stream(server.server_port) for _ in range(server.threads + 1)]
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=5)
+        conn.request('GET', '/api/files')
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert 'files' in resp.read().decode()
+        conn.close()
+    finally:
+        for sock in streams:
+            sock.close()
+
+
+def read_response(f):
+    """从连接的文件对象读一个响应，返回 (状态码, 小写名称的响应头, 响应体)"""
+    status_line = f.readline()
+    if not status_line:
+        return None
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = f.readline().rstrip(b'\r\n')
+        if not line:
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if status < 200 or status in (204, 304):
+        return status, headers, b''
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int(f.readline().split(b';')[0], 16)
+            if not size:
+                f.readline()
+                return status, headers, body
+            body += f.read(size)
+            f.readline()
+    return status, headers, f.read(int(headers.get('content-length', 0)))
+
+
+@pytest.fixture
+def conn(server):
+    sock = socket.create_connection(('127.0.0.1', server.server_port), timeout=5)
+    yield sock, sock.makefile('rb')
+    sock.close()
+
+
+def test_pipelined_requests(conn, share):
+    sock, f = conn
+    (share / 'a.txt').write_bytes(b'aaa')
+    sock.sendall(b'GET /download/a.txt HTTP/1.1\r\nHost: x\r\n\r\n'
+                 b'GET /download/missing HTTP/1.1\r\nHost: x\r\n\r\n'
+                 b'GET /download/a.txt HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+    assert read_response(f)[::2] == (200, b'aaa')
+    assert read_response(f)[0] == 404
+    assert read_response(f)[::2] == (200, b'aaa')
+    assert f.read() == b''
+
+
+def test_keep_alive_and_http10(conn, share, server):
+    sock, f = conn
+    for _ in range(3):
+        sock.sendall(b'GET /api/files HTTP/1.1\r\nHost: x\r\n\r\n')
+        status, headers, _ = read_response(f)
+        assert status == 200 and headers.get('connection') != 'close'
+
+    # HTTP/1.0 不带 keep-alive 时响应后关闭连接
+    with socket.create_connection(('127.0.0.1', server.server_port), timeout=5) as other:
+        other.sendall(b'GET /api/files HTTP/1.0\r\n\r\n')
+        data = b''
+        while chunk := other.recv(65536):
+            data += chunk
+        assert data.startswith(b'HTTP/1.0 200') or data.startswith(b'HTTP/1.1 200')
+
+
+def test_chunked_request_body(conn, share):
+    sock, f = conn
+    sock.sendall(b'PUT /upload/c.bin HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+    assert read_response(f)[0] == 200
+    assert (share / 'c.bin').read_bytes() == b'hello world'
+    # 请求体完整读完，同一连接可以继续使用
+    sock.sendall(b'GET /download/c.bin HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert read_response(f)[::2] == (200, b'hello world')
+
+
+def test_expect_continue(conn, share, server):
+    sock, f = conn
+    sock.sendall(b'PUT /upload/e.bin HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\nExpect: 100-continue\r\n\r\n')
+    assert read_response(f)[0] == 100
+    sock.sendall(b'data')
+    assert read_response(f)[0] == 200
+    assert (share / 'e.bin').read_bytes() == b'data'
+
+    # 不读请求体就拒绝的请求不回复 100 Continue，并且关闭连接
+    with socket.create_connection(('127.0.0.1', server.server_port), timeout=5) as other:
+        other.sendall(b'PUT /upload/.quickshare/x HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\n'
+                      b'Expect: 100-continue\r\n\r\n')
+        of = other.makefile('rb')
+        assert read_response(of)[0] == 400
+        assert of.read() == b''
+
+
+def test_malformed_requests(server):
+    for request, status in ((b'GET /' + b'a' * 70000 + b' HTTP/1.1\r\n\r\n', 414),
+                            (b'NONSENSE\r\n\r\n', 400),
+                            (b'GET / HTTP/1.x\r\n\r\n', 400),
+                            (b'GET / HTTP/9.9\r\n\r\n', 505)):
+        with socket.create_connection(('127.0.0.1', server.server_port), timeout=5) as sock:
+            sock.sendall(request)
+            f = sock.makefile('rb')
+            assert read_response(f)[0] == status
+            assert f.read() == b''
+
+
+def test_head_has_no_body(conn, share):
+    sock, f = conn
+    (share / 'h.bin').write_bytes(b'x' * 1000)
+    sock.sendall(b'HEAD /download/h.bin HTTP/1.1\r\nHost: x\r\n\r\n'
+                 b'GET /download/h.bin HTTP/1.1\r\nHost: x\r\nRange: bytes=0-1\r\n\r\n')
+    status_line = f.readline()
+    assert status_line.startswith(b'HTTP/1.1 200')
+    headers = {}
+    while (line := f.readline().rstrip(b'\r\n')):
+        name, _, value = line.decode().partition(':')
+        headers[name.lower()] = value.strip()
+    assert headers['content-length'] == '1000'
+    # 紧接着的就是下一个响应，说明 HEAD 没有发送响应体
+    assert read_response(f)[::2] == (206, b'xx')
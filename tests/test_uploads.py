@@ -0,0 +1,61 @@
+import io
+import os
+
+import quickshare
+
+
+def create_session(client, name, size):
+    resp = client.post('/api/uploads', json={'name': name, 'size': size})
+    assert resp.status_code == 201
+    return resp.get_json()['id']
+
+
+def test_chunks_out_of_range(client):
+    session = create_session(client, 'a.bin', 10)
+    assert client.put(f'/api/uploads/{session}?offset=11', data=b'x').status_code == 416
+    assert client.put(f'/api/uploads/{session}?offset=-1', data=b'x').status_code == 416
+    assert client.put(f'/api/uploads/{session}?offset=8', data=b'xyz').status_code == 416
+    assert client.put(f'/api/uploads/{session}', data=b'x').status_code == 400
+
+
+def test_overlapping_chunks_and_incomplete_finalize(client, share):
+    data = bytes(range(100))
+    session = create_session(client, 'a.bin', len(data))
+    assert client.put(f'/api/uploads/{session}?offset=0', data=data[:60]).status_code == 200
+    status = client.put(f'/api/uploads/{session}?offset=40', data=data[40:80]).get_json()
+    assert status['received'] == [[0, 80]]
+    assert not status['complete']
+
+    resp = client.post(f'/api/uploads/{session}/finalize')
+    assert resp.status_code == 409
+    assert not (share / 'a.bin').exists()
+
+    assert client.put(f'/api/uploads/{session}?offset=70', data=data[70:]).get_json()['complete']
+    assert client.post(f'/api/uploads/{session}/finalize').get_json()['files'] == ['a.bin']
+    assert (share / 'a.bin').read_bytes() == data
+
+
+
+def test_multipart_upload(client, share):
+    # 数据跨过读缓冲区边界，并且含有与分隔符相似的字节
+    big = (b'\r\n--' + b'x' * 97) * (quickshare.COPY_BUFFER // 100 + 3)
+    files = [(io.BytesIO(big), 'big.bin'), (io.BytesIO(b'hello'), 'sub/a.txt')]
+    resp = client.post('/upload?path=up', data={'files': files}, content_type='multipart/form-data')
+    assert resp.status_code == 200
+    assert resp.get_json()['files'] == ['up/big.bin', 'up/sub/a.txt']
+    assert (share / 'up' / 'big.bin').read_bytes() == big
+    assert (share / 'up' / 'sub' / 'a.txt').read_bytes() == b'hello'
+
+    resp = client.post('/upload?path=up', data={'files': [(io.BytesIO(b'again'), 'sub/a.txt')]},
+                       content_type='multipart/form-data')
+    assert resp.get_json()['files'] == ['up/sub/a (1).txt']
+
+
+def test_multipart_upload_rejects_bad_requests(client, share):
+    assert client.post('/upload', data=b'x', content_type='text/plain').status_code == 400
+    resp = client.post('/upload', data={'other': 'x'}, content_type='multipart/form-data')
+    assert resp.status_code == 400
+    resp = client.post('/upload?path=../x', data={'files': [(io.BytesIO(b'x'), 'a.txt')]},
+                       content_type='multipart/form-data')
+    assert resp.status_code == 400
+    assert os.listdir(share) in ([], ['.quickshare'])